@@ -0,0 +1,281 @@
+"""Actuator worker for the solenoid valve and syringe pump of a chamber.
+
+Delivering a drop takes time: the solenoid is held open for
+SOLENOID_OPEN_TIME, and a drug drop steps the syringe pump SYRINGE_STEPS
+times (see stepper.py). The lick callback only queues the drop ('water' or
+'drug') with an ActuatorWorker, whose own thread runs the commands in order,
+so licks keep being detected and logged while a drop is being delivered.
+Every command records when it was queued, started and finished. A command
+that raises (e.g. a pigpio or GPIO error) is logged and counted as failed,
+and the worker goes on to the next one.
+
+On the simulated cage (threaded=False), commands are run as events on the
+virtual clock instead, so simulations stay on one thread and repeatable.
+
+"""
+
+import queue
+import logging
+import threading
+import collections
+import tracing
+
+log = logging.getLogger('piDose.actuator')
+
+
+class ActuatorCommand(object):
+    """One queued drop, with the times (datetime.datetime() objects) it was
+    queued, started and finished (None until it happens). For drug drops
+    delivered on the worker thread, timing is the stepper's timing report
+    (see stepper.timing_report()). error is the exception that stopped the
+    drop being delivered, or None."""
+
+    def __init__(self, kind, queued, queued_ns, requested_ns=None, tag=None,
+                 extra=None):
+        self.kind = kind
+        self.queued = queued
+        self.tag = tag
+        self.extra = extra
+        self.started = None
+        self.finished = None
+        self.timing = None
+        self.error = None
+        self._requested_ns = (queued_ns if requested_ns is None
+                              else requested_ns)
+        self._queued_ns = queued_ns
+        self._started_ns = None
+        self._finished_ns = None
+
+    def latency_ms(self):
+        """Time from the request (e.g. the lick) to the start of delivery
+        (the valve opening or the first step) in milliseconds."""
+
+        return (self._started_ns - self._requested_ns) / 1e6
+
+    def wait_ms(self):
+        """Time spent in the queue in milliseconds."""
+
+        return (self._started_ns - self._queued_ns) / 1e6
+
+    def run_ms(self):
+        """Time taken to deliver the drop in milliseconds."""
+
+        return (self._finished_ns - self._started_ns) / 1e6
+
+
+class ActuatorWorker(object):
+    """Runs water and drug drop commands, in order, away from the caller."""
+
+    WATER = 'water'
+    DRUG = 'drug'
+
+    def __init__(self, gpio, clock, pin_solenoid, stepper,
+                 solenoid_open_time, syringe_steps, reverse_solenoid=False,
+                 on_done=None, threaded=True, name='Actuator'):
+        """Starts the worker.
+
+        Args:
+            gpio is the RPi.GPIO module (or an object with the same
+            interface), with the pins already set up as outputs.
+            clock is the clock to time the commands on (a timing.SystemClock()
+            or simulator.SimClock()).
+            pin_solenoid is the GPIO pin of the solenoid valve.
+            stepper is the stepper.StepperDriver() of the syringe pump.
+            solenoid_open_time is the time in seconds to open the solenoid
+            for.
+            syringe_steps is the number of steps for a drug drop.
+            reverse_solenoid is True if the solenoid is open when its pin is
+            low.
+            on_done is an optional function called with each ActuatorCommand
+            once it has finished (on the worker thread).
+            threaded is False to run commands as events on the clock (which
+            must then have schedule() and seconds(), as SimClock does).
+            name is the name of the worker thread.
+        """
+
+        self._gpio = gpio
+        self._clock = clock
+        self.pin_solenoid = pin_solenoid
+        self.stepper = stepper
+        self.solenoid_open_time = solenoid_open_time
+        self.syringe_steps = syringe_steps
+        self.reverse_solenoid = reverse_solenoid
+        self.on_done = on_done
+        self.threaded = threaded
+        self._lock = threading.Lock()
+        self._closed = False
+        self.reset_stats()
+        if threaded:
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name=name,
+                                            daemon=True)
+            self._thread.start()
+        else:
+            self._pending = collections.deque()
+            self._current = None
+
+    def submit(self, kind, requested_ns=None, tag=None, extra=None):
+        """Queues a drop.
+
+        Args:
+            kind is ActuatorWorker.WATER or ActuatorWorker.DRUG.
+            requested_ns is the monotonic time (ns) of whatever asked for
+            the drop (e.g. the lick), if earlier than now.
+            tag is the RFID of the mouse the drop is for, and extra the
+            structured log fields (see diagnostics.py), both used to log
+            the drop if it fails.
+
+        Returns:
+            The ActuatorCommand() object for the drop.
+
+        Raises:
+            ValueError: kind is not a known command.
+        """
+
+        if kind not in (ActuatorWorker.WATER, ActuatorWorker.DRUG):
+            raise ValueError("Unknown actuator command %s." % (kind))
+        command = ActuatorCommand(kind, self._clock.now(),
+                                  self._clock.monotonic_ns(), requested_ns,
+                                  tag, extra)
+        if self.threaded:
+            self._queue.put(command)
+        else:
+            self._pending.append(command)
+            if self._current is None:
+                self._advance()
+        return command
+
+    def _steps(self, kind):
+        """The (pin, value, seconds to wait afterwards) outputs of a
+        command."""
+
+        if kind == ActuatorWorker.DRUG:
+            for output in self.stepper.outputs(self.syringe_steps):
+                yield output
+        else:
+            yield (self.pin_solenoid, not self.reverse_solenoid,
+                   self.solenoid_open_time)
+            yield self.pin_solenoid, self.reverse_solenoid, 0
+
+    def _start(self, command):
+        command.started = self._clock.now()
+        command._started_ns = self._clock.monotonic_ns()
+        return None
+
+    def _finish(self, command):
+        command.finished = self._clock.now()
+        command._finished_ns = self._clock.monotonic_ns()
+        with self._lock:
+            if command.error is not None:
+                self._failed += 1
+            self._commands += 1
+            self._wait_sum += command.wait_ms()
+            self._wait_max = max(self._wait_max, command.wait_ms())
+            self._run_sum += command.run_ms()
+            self._run_max = max(self._run_max, command.run_ms())
+        if self.on_done is not None:
+            try:
+                self.on_done(command)
+            except Exception as e:
+                log.error("Error reporting %s drop: %s", command.kind, e)
+        return None
+
+    def _run(self):
+        while True:
+            command = self._queue.get()
+            if command is None:
+                return None
+            self._start(command)
+            try:
+                with tracing.span('deliver_drop'):
+                    if command.kind == ActuatorWorker.DRUG:
+                        command.timing = self.stepper.move(self.syringe_steps)
+                    else:
+                        for pin, value, wait in self._steps(command.kind):
+                            self._gpio.output(pin, value)
+                            if wait > 0:
+                                self._clock.sleep(wait)
+            except Exception as e:
+                self._failed_command(command, e)
+            self._finish(command)
+
+    def _failed_command(self, command, error):
+        """Logs a command that raised. Called from the except block."""
+
+        command.error = error
+        log.exception("%s drop for %s failed.", command.kind.capitalize(),
+                      command.tag, extra=command.extra)
+        return None
+
+    def _advance(self):
+        """Runs outputs of the current command (starting the next one if
+        there is none) until one needs a wait, which is scheduled on the
+        clock. Used when not threaded."""
+
+        while not self._closed:
+            if self._current is None:
+                if not self._pending:
+                    return None
+                command = self._pending.popleft()
+                self._start(command)
+                self._current = (command, self._steps(command.kind))
+            command, steps = self._current
+            try:
+                for pin, value, wait in steps:
+                    self._gpio.output(pin, value)
+                    if wait > 0:
+                        self._clock.schedule(self._clock.seconds() + wait,
+                                             self._advance)
+                        return None
+            except Exception as e:
+                self._failed_command(command, e)
+            self._current = None
+            self._finish(command)
+        return None
+
+    def reset_stats(self):
+        """Clears the command statistics."""
+
+        with self._lock:
+            self._commands = 0
+            self._failed = 0
+            self._wait_sum = 0.0
+            self._wait_max = 0.0
+            self._run_sum = 0.0
+            self._run_max = 0.0
+        return None
+
+    def stats(self):
+        """Statistics of the commands finished since the last reset.
+
+        Returns:
+            A dict with 'commands' and 'failed' (those that raised), and
+            'mean_wait_ms', 'max_wait_ms' (time spent queued), 'mean_run_ms'
+            and 'max_run_ms' (time taken to deliver) as floats.
+        """
+
+        with self._lock:
+            n = self._commands
+            return {'commands': n, 'failed': self._failed,
+                    'mean_wait_ms': self._wait_sum / n if n else 0.0,
+                    'max_wait_ms': self._wait_max,
+                    'mean_run_ms': self._run_sum / n if n else 0.0,
+                    'max_run_ms': self._run_max}
+
+    def close(self):
+        """Finishes the queued commands and stops the worker. When not
+        threaded, commands that have not finished are abandoned.
+
+        Returns:
+            None.
+        """
+
+        if self.threaded:
+            if not self._closed:
+                self._queue.put(None)
+                self._thread.join()
+        elif self._current is not None or self._pending:
+            log.warning("%i drop(s) not delivered.", len(self._pending) +
+                        (self._current is not None))
+        self._closed = True
+        return None
@@ -0,0 +1,219 @@
+"""Asynchronous, structured, rotated diagnostics logging for PiDose.
+
+PiDose's diagnostics go through the standard logging module, to one logger
+per subsystem under 'piDose':
+
+    piDose - Mice entering and leaving, rollover and the program itself.
+    piDose.licks - Every lick and the decision made on it.
+    piDose.drops - Drops delivered (and their timing).
+    piDose.scale - Weighing and re-taring.
+    piDose.camera - Video clips and pictures.
+    piDose.actuator, piDose.storage, piDose.hardware - Errors from those
+        modules.
+
+Each subsystem can have its own level (see setup()). A log call only stamps
+the record and puts it on a queue (a QueueHandler), so logging from the lick
+callback costs tens of microseconds rather than a write to the SD card. A
+QueueListener thread formats the records and writes them to the log file,
+which is rotated when it reaches a size or an age and the old files gzipped,
+so the log can neither hold up the cage nor fill the SD card.
+
+Records are written one JSON object per line, e.g.
+
+    {"time": "2020-01-01 08:05:49.158760", "monotonic_ns": 51337015000,
+     "level": "INFO", "subsystem": "piDose.licks", "chamber": "Chamber 1",
+     "mouse": "M1", "event": "01", "message": "Lick detected."}
+
+where chamber, mouse and event are given with the extra argument of the log
+call (they are null otherwise). time and monotonic_ns come from the
+program's clock, so simulated runs are logged in simulated time.
+
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import queue
+import shutil
+import logging
+import logging.handlers
+import tracing
+
+ROOT = 'piDose'
+FIELDS = ('chamber', 'mouse', 'event')
+
+
+class ContextFilter(logging.Filter):
+    """Stamps each record with the clock's time and the structured fields,
+    in the thread that made the log call."""
+
+    def __init__(self, clock):
+        logging.Filter.__init__(self)
+        self._clock = clock
+
+    def filter(self, record):
+        record.clock_time = str(self._clock.now())
+        record.monotonic_ns = self._clock.monotonic_ns()
+        for name in FIELDS:
+            if not hasattr(record, name):
+                setattr(record, name, None)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one line of JSON."""
+
+    def format(self, record):
+        fields = {'time': record.clock_time,
+                  'monotonic_ns': record.monotonic_ns,
+                  'level': record.levelname, 'subsystem': record.name}
+        for name in FIELDS:
+            fields[name] = getattr(record, name)
+        fields['message'] = record.getMessage()
+        return json.dumps(fields)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records (and counts them) rather than block
+    or raise when its bounded queue is full."""
+
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def handle(self, record):
+        with tracing.span('log'):
+            return logging.handlers.QueueHandler.handle(self, record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        return None
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler that also rotates when the file reaches an age,
+    and gzips the rotated files (log.txt.1.gz, log.txt.2.gz...)."""
+
+    def __init__(self, path, max_bytes, backup_count, max_age=None):
+        """Args:
+            path is a string containing the location of the log file.
+            max_bytes is the size at which the file is rotated.
+            backup_count is the number of rotated files kept.
+            max_age is the time in seconds after which the file is rotated,
+            or None.
+        """
+
+        logging.handlers.RotatingFileHandler.__init__(
+            self, path, maxBytes=max_bytes, backupCount=backup_count)
+        self.max_age = max_age
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._compress
+        self._rotate_at = None if max_age is None else time.time() + max_age
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, 'rb') as file_in, gzip.open(dest, 'wb') as file_out:
+            shutil.copyfileobj(file_in, file_out)
+        os.remove(source)
+        return None
+
+    def shouldRollover(self, record):
+        if self._rotate_at is not None and time.time() >= self._rotate_at:
+            return True
+        return logging.handlers.RotatingFileHandler.shouldRollover(self,
+                                                                   record)
+
+    def doRollover(self):
+        logging.handlers.RotatingFileHandler.doRollover(self)
+        if self.max_age is not None:
+            self._rotate_at = time.time() + self.max_age
+        return None
+
+
+class LogSession(object):
+    """The handlers, queue and listener thread set up by setup()."""
+
+    def __init__(self, handler, listener, file_handler):
+        self.handler = handler
+        self.listener = listener
+        self.file_handler = file_handler
+
+    @property
+    def dropped(self):
+        """Records dropped because the queue was full."""
+
+        return self.handler.dropped
+
+    def close(self):
+        """Writes the queued records, stops the listener thread and closes
+        the log file.
+
+        Returns:
+            None.
+        """
+
+        self.listener.stop()
+        logging.getLogger(ROOT).removeHandler(self.handler)
+        for handler in self.listener.handlers:
+            handler.close()
+        if self.handler.dropped:
+            sys.stderr.write("%i log records dropped (queue full).\n"
+                             % (self.handler.dropped))
+        return None
+
+
+def setup(path, clock, max_bytes=10 * 1024 * 1024, backup_count=30,
+          max_age=86400, queue_size=10000, levels=None,
+          console_level='WARNING'):
+    """Sends the piDose loggers' records to a rotated log file (and, at
+    console_level and above, to stdout) through a queue and listener
+    thread.
+
+    Args:
+        path is a string containing the location of the log file.
+        clock is the clock to stamp records with (a timing.SystemClock() or
+        simulator.SimClock()).
+        max_bytes, backup_count and max_age are as for
+        CompressingRotatingFileHandler().
+        queue_size is the most records waiting to be written. Records made
+        while the queue is full are dropped.
+        levels is a dict of logger names and their levels (e.g.
+        {'piDose': 'INFO', 'piDose.licks': 'WARNING'}).
+        console_level is the lowest level also printed to stdout (which
+        monitor.sh appends to log.txt), or None.
+
+    Returns:
+        A LogSession(), which should be closed when the program ends.
+    """
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    file_handler = CompressingRotatingFileHandler(path, max_bytes,
+                                                  backup_count, max_age)
+    file_handler.setFormatter(JSONFormatter())
+    handlers = [file_handler]
+    if console_level is not None:
+        console = logging.StreamHandler(sys.stdout)
+        console.setLevel(console_level)
+        console.setFormatter(logging.Formatter(
+            '%(clock_time)s %(levelname)s %(name)s: %(message)s'))
+        handlers.append(console)
+
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    handler.addFilter(ContextFilter(clock))
+    listener = logging.handlers.QueueListener(handler.queue, *handlers,
+                                              respect_handler_level=True)
+    root = logging.getLogger(ROOT)
+    root.addHandler(handler)
+    root.propagate = False
+    root.setLevel(logging.INFO)
+    for name, level in (levels or {}).items():
+        logging.getLogger(name).setLevel(level)
+    listener.start()
+    return LogSession(handler, listener, file_handler)
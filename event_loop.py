@@ -0,0 +1,93 @@
+"""Event-driven waiting for the PiDose main loop.
+
+Instead of polling GPIO pins every few milliseconds, the main loop sleeps in
+a selector until either an edge occurs on a watched GPIO pin (e.g. the RFID
+tag-in-range pin), or a timeout expires (used for weighing and the grace
+period). Edges are reported by RPi.GPIO on its own thread and passed to the
+selector through a pipe. While nothing is happening the process is blocked in
+the kernel and uses no CPU. As a precaution against a missed edge, waits
+are capped at max_sleep seconds so pins are still re-checked occasionally.
+
+The RFID serial port is not watched: the reader raises the tag-in-range pin
+whenever a tag is present, and readTag() waits for the tag's data itself.
+Watching the port as well would wake the loop repeatedly for any bytes left
+unread.
+
+"""
+
+import os
+import selectors
+from timing import SystemClock
+
+
+class EdgeLoop(object):
+    """Blocks until a watched pin changes or a timeout expires."""
+
+    def __init__(self, gpio, max_sleep=1, clock=None):
+        """Args:
+            gpio is the RPi.GPIO module (or an object with the same
+            interface).
+            max_sleep is the longest time in seconds wait() will block for.
+            clock is the clock to wait on (defaults to a SystemClock()).
+        """
+
+        self._gpio = gpio
+        self.max_sleep = max_sleep
+        self._clock = SystemClock() if clock is None else clock
+        self._pins = []
+        self._selector = selectors.DefaultSelector()
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+        self._selector.register(self._read_fd, selectors.EVENT_READ)
+
+    def _on_edge(self, channel):
+        """GPIO callback, wakes up wait(). Runs on the RPi.GPIO thread."""
+
+        try:
+            os.write(self._write_fd, b'\x00')
+        except BlockingIOError:
+            # Pipe is full, so wait() is going to wake up anyway
+            pass
+        return None
+
+    def watch_pin(self, pin):
+        """Wakes up wait() on every rising or falling edge of pin."""
+
+        self._gpio.add_event_detect(pin, self._gpio.BOTH,
+                                    callback=self._on_edge)
+        self._pins.append(pin)
+        return None
+
+    def wait(self, timeout=None):
+        """Blocks until an edge or timeout.
+
+        Args:
+            timeout is the maximum time to wait in seconds (None waits up to
+            max_sleep).
+
+        Returns:
+            True if woken by an edge, False on timeout.
+        """
+
+        if timeout is None or timeout > self.max_sleep:
+            timeout = self.max_sleep
+        elif timeout < 0:
+            timeout = 0
+        events = self._clock.select(self._selector, timeout)
+        if events:
+            try:
+                while os.read(self._read_fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        return bool(events)
+
+    def close(self):
+        for pin in self._pins:
+            self._gpio.remove_event_detect(pin)
+        self._pins = []
+        self._selector.close()
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        return None
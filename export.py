@@ -0,0 +1,334 @@
+"""Columnar export of the event and weight logs for analysis.
+
+Parsing str(datetime) timestamps out of <mouse>_data.txt and the weight
+logs line by line is slow. This converts them, for one mouse or the whole
+colony, into numpy arrays with one folder per mouse and day:
+
+    <export>/<mouse>/<YYYY-MM-DD>/event_times.npy   int64 epoch ms
+                                  event_codes.npy   uint8 (0, 1, 2, 3, 99)
+                                  weight_times.npy  int64 epoch ms
+                                  weights.npy       float32 grams
+
+Each is a plain .npy file, so a day can be memory-mapped without reading
+it, e.g. np.load(path, mmap_mode='r'), or a mouse's days loaded together
+with load_mouse(). Timestamps are converted to epoch ms as in weight_log.py
+(the logs are in local time). Days are calendar days, so the samples of a
+visit that goes past midnight are split between two days.
+
+The export is incremental: the byte offset (or record count, for binary
+weight logs) read from each log is kept in export_state.json in the mouse's
+folder, and a later run only reads what has been appended since, adding it
+to the days it belongs to. It can be run every night on the Pi:
+
+    python3 export.py /home/pi/piDose/data /home/pi/piDose/export
+
+"""
+
+import os
+import json
+import shutil
+import argparse
+import datetime as dt
+from time import perf_counter
+import numpy as np
+import weight_log
+from report import tail_crc, read_lines
+
+STATE_FILE = 'export_state.json'
+COLUMNS = {'event_times': np.int64, 'event_codes': np.uint8,
+           'weight_times': np.int64, 'weights': np.float32}
+
+
+def local_to_epoch_ms(times):
+    """Converts local times to epoch ms.
+
+    Args:
+        times is a numpy datetime64 array of local (naive) times.
+
+    Returns:
+        A numpy int64 array of epoch ms.
+    """
+
+    if len(times) == 0:
+        return np.zeros(0, np.int64)
+    times_us = times.astype('datetime64[us]')
+    # The UTC offset can only change on the hour, so work it out once for
+    # each hour in the array
+    hours, index = np.unique(times_us.astype('datetime64[h]'),
+                             return_inverse=True)
+    offsets_us = np.array([int(round(hour.astype(dt.datetime).timestamp()
+                                     * 1e6)) -
+                           hour.astype('datetime64[us]').astype(np.int64)
+                           for hour in hours], np.int64)
+    epoch_us = times_us.astype(np.int64) + offsets_us[index.ravel()]
+    # Rounded from float seconds, as weight_log.epoch_ms() does
+    return np.rint(epoch_us / 1e6 * 1000).astype(np.int64)
+
+
+def parse_log(data):
+    """Splits complete 'timestamp<tab>value' lines into columns.
+
+    The timestamp is str(datetime), 'YYYY-MM-DD HH:MM:SS' with '.ffffff'
+    unless the microseconds are 0, so its fields are at fixed offsets from
+    the start of the line and are read straight out of the bytes for all
+    lines at once (as in report.parse_events()). Lines that do not fit are
+    skipped.
+
+    Args:
+        data is the bytes of the lines.
+
+    Returns:
+        A numpy array of the local times (datetime64[us]) and a list of the
+        values (as bytes).
+    """
+
+    if not data:
+        return np.zeros(0, 'datetime64[us]'), []
+    chars = np.frombuffer(data, np.uint8)
+    ends = np.flatnonzero(chars == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    last = len(chars) - 1
+
+    def char(offsets, value):
+        return chars[np.minimum(offsets, last)] == ord(value)
+
+    fraction = char(starts + 19, '.') & char(starts + 26, '\t')
+    valid = ((ends - starts > 20) & char(starts + 4, '-') &
+             char(starts + 10, ' ') & char(starts + 16, ':') &
+             (fraction | char(starts + 19, '\t')))
+    starts = starts[valid]
+    ends = ends[valid]
+    fraction = fraction[valid]
+
+    def digits(offsets):
+        value = np.zeros(len(starts), np.int64)
+        for offset in offsets:
+            value = (value * 10 + chars[np.minimum(starts + offset, last)] -
+                     ord('0'))
+        return value
+
+    dates, index = np.unique(digits((0, 1, 2, 3, 5, 6, 8, 9)),
+                             return_inverse=True)
+    days = np.array(['%04i-%02i-%02i' % (date // 10000, date // 100 % 100,
+                                         date % 100)
+                     for date in dates.tolist()], 'datetime64[D]')
+    seconds = (digits((11, 12)) * 3600 + digits((14, 15)) * 60 +
+               digits((17, 18)))
+    times_us = (days.astype(np.int64)[index.ravel()] * 86400000000 +
+                seconds * 1000000 +
+                np.where(fraction, digits(range(20, 26)), 0))
+    value_starts = starts + np.where(fraction, 27, 20)
+    values = [data[start:end] for start, end in zip(value_starts.tolist(),
+                                                    ends.tolist())]
+    return times_us.astype('datetime64[us]'), values
+
+
+def day_folders(export_dir, mouse):
+    """The days exported for a mouse, as a sorted list of date strings."""
+
+    folder = os.path.join(export_dir, mouse)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name for name in os.listdir(folder)
+                  if os.path.isdir(os.path.join(folder, name)))
+
+
+def load_day(export_dir, mouse, date, mmap_mode='r'):
+    """Loads one exported day.
+
+    Args:
+        export_dir is a string containing the export folder.
+        mouse is a string containing the name of the mouse.
+        date is a 'YYYY-MM-DD' string.
+        mmap_mode is as for numpy.load() ('r' to memory-map, None to read).
+
+    Returns:
+        A dict of column names (see COLUMNS) and numpy arrays.
+    """
+
+    folder = os.path.join(export_dir, mouse, date)
+    return {name: np.load(os.path.join(folder, name + '.npy'),
+                          mmap_mode=mmap_mode)
+            for name in COLUMNS}
+
+
+def load_mouse(export_dir, mouse):
+    """Loads every exported day of a mouse, concatenated in date order.
+
+    Returns:
+        A dict of column names (see COLUMNS) and numpy arrays.
+    """
+
+    days = [load_day(export_dir, mouse, date)
+            for date in day_folders(export_dir, mouse)]
+    return {name: np.concatenate([day[name] for day in days]
+                                 or [np.zeros(0, dtype)])
+            for name, dtype in COLUMNS.items()}
+
+
+def _append_days(folder, new):
+    """Adds new rows to the day folders they fall in.
+
+    Args:
+        folder is a string containing the mouse's export folder.
+        new is a dict with 'event_times', 'event_codes', 'weight_times' and
+        'weights' arrays.
+
+    Returns:
+        The number of days written.
+    """
+
+    dates = {}
+    for kind in ('event', 'weight'):
+        times = new[kind + '_times']
+        if len(times) == 0:
+            continue
+        # Local dates only change on a 15 minute boundary (of any UTC
+        # offset), so work out the date once for each 15 minutes
+        quarters, index = np.unique(times // 900000, return_inverse=True)
+        local_days = np.array([str(dt.date.fromtimestamp(quarter * 900))
+                               for quarter in quarters.tolist()])
+        sample_days = local_days[index.ravel()]
+        for date in np.unique(sample_days):
+            dates.setdefault(str(date), {})[kind] = sample_days == date
+
+    for date, masks in sorted(dates.items()):
+        path = os.path.join(folder, date)
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, 'weights.npy')):
+            day = load_day(os.path.dirname(folder), os.path.basename(folder),
+                           date, None)
+        else:
+            day = {name: np.zeros(0, dtype)
+                   for name, dtype in COLUMNS.items()}
+        for kind, value_name in (('event', 'event_codes'),
+                                 ('weight', 'weights')):
+            if kind not in masks:
+                continue
+            times = np.concatenate((day[kind + '_times'],
+                                    new[kind + '_times'][masks[kind]]))
+            values = np.concatenate((day[value_name],
+                                     new[value_name][masks[kind]]))
+            # Weight logs from two days in the cage can both have samples
+            # from the same calendar day
+            order = np.argsort(times, kind='stable')
+            day[kind + '_times'] = times[order]
+            day[value_name] = values[order].astype(COLUMNS[value_name])
+        for name in COLUMNS:
+            tmp_path = os.path.join(path, name + '.tmp.npy')
+            np.save(tmp_path, day[name])
+            os.replace(tmp_path, os.path.join(path, name + '.npy'))
+    return len(dates)
+
+
+def export_mouse(data_dir, export_dir, mouse):
+    """Exports whatever has been added to a mouse's logs since the last
+    export.
+
+    Args:
+        data_dir is a string containing the data folder.
+        export_dir is a string containing the export folder.
+        mouse is a string containing the name of the mouse.
+
+    Returns:
+        The number of events and weight samples exported, and the number of
+        days written.
+    """
+
+    folder = os.path.join(export_dir, mouse)
+    os.makedirs(folder, exist_ok=True)
+    state_path = os.path.join(folder, STATE_FILE)
+    try:
+        with open(state_path, 'r') as file:
+            state = json.load(file)
+    except (IOError, ValueError):
+        state = {}
+    if state:
+        # Logs changed other than by appending: start again
+        for name, entry in state.items():
+            path = os.path.join(data_dir, mouse, name)
+            if (not os.path.exists(path) or
+                    os.path.getsize(path) < entry['size'] or
+                    ('tail' in entry and
+                     tail_crc(path, entry['size']) != entry['tail'])):
+                # rmtree, as a crash while exporting can leave a day
+                # without some columns or with a .tmp.npy file in it
+                for date in day_folders(export_dir, mouse):
+                    shutil.rmtree(os.path.join(folder, date))
+                state = {}
+                break
+
+    new = {'event_times': [], 'event_codes': [], 'weight_times': [],
+           'weights': []}
+    events_name = '%s_data.txt' % (mouse)
+    logs = [events_name]
+    weights_dir = os.path.join(data_dir, mouse, 'Weights')
+    if os.path.isdir(weights_dir):
+        logs += sorted(os.path.join('Weights', name)
+                       for name in os.listdir(weights_dir)
+                       if name.startswith(mouse + '_weights_day'))
+    for name in logs:
+        path = os.path.join(data_dir, mouse, name)
+        if not os.path.exists(path):
+            continue
+        start = state.get(name, {}).get('size', 0)
+        if path.endswith('.bin'):
+            header, records = weight_log.open_weight_log(path)
+            first = state.get(name, {}).get('records', 0)
+            times = weight_log.read_times(path)[first:]
+            values = weight_log.read_weights(path)[first:]
+            new['weight_times'].append(times)
+            new['weights'].append(values.astype(np.float32))
+            state[name] = {'size': weight_log.HEADER_SIZE +
+                           len(records) * records.dtype.itemsize,
+                           'records': len(records)}
+            continue
+        data, end = read_lines(path, start)
+        times, values = parse_log(data)
+        times = local_to_epoch_ms(times)
+        if name == events_name:
+            new['event_times'].append(times)
+            new['event_codes'].append(np.fromiter(map(int, values),
+                                                  np.uint8, len(values)))
+        else:
+            new['weight_times'].append(times)
+            new['weights'].append(np.fromiter(map(float, values),
+                                              np.float64, len(values))
+                                  .astype(np.float32))
+        state[name] = {'size': end, 'tail': tail_crc(path, end)}
+
+    new = {name: np.concatenate(arrays or [np.zeros(0, COLUMNS[name])])
+           for name, arrays in new.items()}
+    n_days = _append_days(folder, new)
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file)
+    os.replace(tmp_path, state_path)
+    return len(new['event_times']), len(new['weight_times']), n_days
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export PiDose event and "
+                                     "weight logs to per-day numpy arrays, "
+                                     "adding only what is new.")
+    parser.add_argument('data_dir', nargs='?',
+                        default='/home/pi/piDose/data')
+    parser.add_argument('export_dir', nargs='?',
+                        default='/home/pi/piDose/export')
+    parser.add_argument('--mouse', action='append', default=None,
+                        help="mouse to export (can be given more than "
+                        "once, defaults to every mouse)")
+    args = parser.parse_args()
+
+    mice = args.mouse or sorted(
+        name for name in os.listdir(args.data_dir)
+        if os.path.exists(os.path.join(args.data_dir, name,
+                                       '%s_data.txt' % (name))))
+    start = perf_counter()
+    for mouse in mice:
+        n_events, n_weights, n_days = export_mouse(args.data_dir,
+                                                   args.export_dir, mouse)
+        print("%s: %i events and %i weight samples added to %i days."
+              % (mouse, n_events, n_weights, n_days))
+    print("Exported %i mice to %s in %.2f s." % (len(mice), args.export_dir,
+                                                 perf_counter() - start))
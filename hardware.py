@@ -0,0 +1,258 @@
+"""Hardware backends for PiDose.
+
+PiDose talks to its devices only through the interfaces below, so the same
+control logic can run on the cage or, with the simulated backend in
+simulator.py, on any computer:
+
+    GPIOBackend - GPIO pins (RFID tag-in-range, cap sensor IRQ, solenoid,
+        syringe pump). The RPi.GPIO module itself is the Pi implementation.
+    CapSensorBackend - The MPR121 capacitive sensor (adafruit_mpr121.MPR121).
+    ScaleBackend - The HX711 load cell (Scale.Scale from GPIO_Thread).
+    TagReaderBackend - The RFID reader (RFIDTagReader.TagReader).
+    CameraBackend - The Pi camera (picamera.PiCamera).
+
+Pulse trains for the syringe pump come from Hardware.pulses() (see
+stepper.py), and the in-memory video buffer from Hardware.video_buffer() (see
+video_clips.py).
+
+A backend set is bundled with a clock (see timing.py) in a Hardware object.
+The Pi libraries are only imported when PiHardware is created, so importing
+piDose.py does not need them.
+
+"""
+
+import os
+import logging
+from timing import SystemClock
+from stepper import SoftwarePulses, DMAPulses
+
+log = logging.getLogger('piDose.hardware')
+
+
+class GPIOBackend(object):
+    """Interface of the RPi.GPIO module used by PiDose."""
+
+    BCM = 11
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def setmode(self, mode):
+        raise NotImplementedError
+
+    def setup(self, pin, direction, pull_up_down=None):
+        raise NotImplementedError
+
+    def output(self, pin, value):
+        raise NotImplementedError
+
+    def input(self, pin):
+        raise NotImplementedError
+
+    def add_event_detect(self, pin, edge, callback=None):
+        raise NotImplementedError
+
+    def remove_event_detect(self, pin):
+        raise NotImplementedError
+
+    def cleanup(self):
+        raise NotImplementedError
+
+
+class CapSensorBackend(object):
+    """Interface of adafruit_mpr121.MPR121 used by PiDose.
+
+    Indexing the sensor with an electrode number gives an object with
+    threshold and release_threshold attributes.
+    """
+
+    def touched(self):
+        """Reads (and so clears the interrupt for) the touch state of all
+        electrodes, as a bit mask."""
+
+        raise NotImplementedError
+
+    def __getitem__(self, electrode):
+        raise NotImplementedError
+
+
+class ScaleBackend(object):
+    """Interface of Scale.Scale used by PiDose."""
+
+    def weighOnce(self):
+        """Takes one reading and returns it in grams."""
+
+        raise NotImplementedError
+
+    def tare(self, n_readings, print_result):
+        """Sets the current reading (averaged over n_readings) as zero."""
+
+        raise NotImplementedError
+
+    # A scale may also have the threaded array read of Scale.Scale, which
+    # scale_stream.ScaleStream uses when it is there: weighThreadStart(n)
+    # starts reading up to n readings (in grams) into dataArray on a C
+    # thread, weighThreadCheck() returns the number read so far, and
+    # weighThreadStop() stops reading.
+
+
+class TagReaderBackend(object):
+    """Interface of RFIDTagReader.TagReader used by PiDose."""
+
+    def readTag(self):
+        """Returns the RFID of the tag in range (as an int), or 0 if no tag
+        is read before the timeout."""
+
+        raise NotImplementedError
+
+
+class CameraBackend(object):
+    """Interface of picamera.PiCamera used by PiDose."""
+
+    vflip = False
+    hflip = False
+    rotation = 0
+    framerate = 30
+    clock_mode = 'reset'
+
+    @property
+    def timestamp(self):
+        """The camera's clock in microseconds, which the timestamps of
+        recorded frames are on when clock_mode is 'raw'."""
+
+        raise NotImplementedError
+
+    def capture(self, output, **kwargs):
+        raise NotImplementedError
+
+    def start_recording(self, output, format=None, **options):
+        """Starts recording video into output (e.g. a buffer from
+        Hardware.video_buffer())."""
+
+        raise NotImplementedError
+
+    def wait_recording(self, timeout=0):
+        """Waits timeout seconds, raising any error the encoder has had."""
+
+        raise NotImplementedError
+
+    def stop_recording(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class Hardware(object):
+    """A set of device backends and the clock they run on."""
+
+    def __init__(self, gpio, clock, threaded=True):
+        """Args:
+            gpio is a GPIOBackend (or the RPi.GPIO module).
+            clock is a timing.SystemClock() or a clock with the same methods.
+            threaded is False if work that waits on the clock (delivering
+            drops) must be run as events on the clock rather than on
+            background threads, as on the simulated cage.
+        """
+
+        self.gpio = gpio
+        self.clock = clock
+        self.threaded = threaded
+
+    def cap_sensor(self):
+        """Returns a CapSensorBackend for the MPR121."""
+
+        raise NotImplementedError
+
+    def scale(self, pin_data, pin_clock, grams_per_unit, array_size):
+        """Returns a ScaleBackend for the HX711."""
+
+        raise NotImplementedError
+
+    def tag_reader(self, port, timeout, kind):
+        """Returns a TagReaderBackend for the RFID reader."""
+
+        raise NotImplementedError
+
+    def camera(self, resolution):
+        """Returns a CameraBackend."""
+
+        raise NotImplementedError
+
+    def video_buffer(self, camera, seconds, bitrate):
+        """Returns an in-memory circular buffer for the camera to record
+        into, holding seconds of video at bitrate bits per second (see
+        video_clips.py). It has the frames, lock, tell(), seek() and read()
+        of picamera.PiCameraCircularIO."""
+
+        raise NotImplementedError
+
+    def pulses(self):
+        """Returns a pulse generator for stepper.StepperDriver() (by default,
+        a stepper.SoftwarePulses() on the GPIO and clock)."""
+
+        return SoftwarePulses(self.gpio, self.clock)
+
+    def reboot(self):
+        """Reboots the system."""
+
+        raise NotImplementedError
+
+
+class PiHardware(Hardware):
+    """The real devices of a PiDose cage."""
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        Hardware.__init__(self, GPIO, SystemClock())
+        self._pulses = None
+
+    def cap_sensor(self):
+        import board
+        import busio
+        import adafruit_mpr121
+        i2c = busio.I2C(board.SCL, board.SDA)
+        return adafruit_mpr121.MPR121(i2c)
+
+    def scale(self, pin_data, pin_clock, grams_per_unit, array_size):
+        from Scale import Scale
+        return Scale(pin_data, pin_clock, grams_per_unit, array_size)
+
+    def tag_reader(self, port, timeout, kind):
+        from RFIDTagReader import TagReader
+        return TagReader(port, doChecksum=False, timeOutSecs=timeout,
+                         kind=kind)
+
+    def camera(self, resolution):
+        import picamera
+        return picamera.PiCamera(resolution=resolution)
+
+    def video_buffer(self, camera, seconds, bitrate):
+        import picamera
+        return picamera.PiCameraCircularIO(camera, seconds=seconds,
+                                           bitrate=bitrate)
+
+    def pulses(self):
+        """DMA-timed pulses if the pigpio daemon is running, otherwise
+        software-timed. One generator is shared by all of the chambers."""
+
+        if self._pulses is None:
+            try:
+                import pigpio
+                pi = pigpio.pi()
+            except ImportError:
+                pi = None
+            if pi is not None and pi.connected:
+                self._pulses = DMAPulses(pi)
+            else:
+                log.warning("pigpio daemon not running, stepping the syringe "
+                            "pump in software.")
+                self._pulses = SoftwarePulses(self.gpio, self.clock)
+        return self._pulses
+
+    def reboot(self):
+        os.system('sudo reboot')
+        return None
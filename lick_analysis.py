@@ -0,0 +1,239 @@
+"""Lick bouts and drinking microstructure from the event logs.
+
+Every lick is recorded as event 01, followed straight away by 02 or 03 if it
+got a drop (a lick within WATER_TIMEOUT ms of the last drop does not), and
+each visit starts with 00 and ends with 99. From these, with numpy over a
+mouse's whole event log at once:
+
+    Bouts - Runs of licks with no inter-lick interval over the bout gap
+        (BOUT_GAP_MS) and within one visit.
+    Bout sizes and lengths - Licks in each bout, and the time from its first
+        to its last lick.
+    Lick rate - Licks per second within bouts (bout sizes less one over bout
+        lengths, for bouts of more than one lick).
+    Time to first lick - From the entry to the first lick of each visit with
+        a lick.
+    Rejected licks - Licks that got no drop because of WATER_TIMEOUT.
+
+Bouts are counted on the day of their first lick and visits on the day of
+their entry. The events are read from export.py's arrays, so run that
+first:
+
+    python3 export.py /home/pi/piDose/data /home/pi/piDose/export
+    python3 lick_analysis.py /home/pi/piDose/export
+
+which writes a table with a row per mouse and day (lick_report.txt in the
+export folder).
+
+"""
+
+import os
+import argparse
+from time import perf_counter
+import numpy as np
+import export
+
+BOUT_GAP_MS = 1000
+ENTRY = 0
+LICK = 1
+WATER = 2
+DRUG = 3
+
+
+def analyze(times, codes, gap_ms=BOUT_GAP_MS):
+    """Finds the visits, licks and bouts in a mouse's events.
+
+    Args:
+        times is a numpy int64 array of the event times in epoch ms.
+        codes is a numpy array of the event codes (as ints).
+        gap_ms is the inter-lick interval in ms above which a new bout
+        starts.
+
+    Returns:
+        A dict of numpy arrays:
+            licks - Event index of each lick.
+            accepted - Whether each lick got a drop.
+            lick_visit - Visit of each lick (-1 before the first entry).
+            intervals - Inter-lick interval in ms before each lick within a
+                bout (NaN for the first lick of a bout).
+            bout_starts - Index (into licks) of the first lick of each bout.
+            bout_sizes - Licks in each bout.
+            bout_lengths - ms from the first to the last lick of each bout.
+            entries - Event index of each entry.
+            latencies - ms from each entry to the first lick of the visit
+                (NaN if there was no lick).
+    """
+
+    times = np.asarray(times, np.int64)
+    codes = np.asarray(codes)
+    is_entry = codes == ENTRY
+    entries = np.flatnonzero(is_entry)
+    visit = np.cumsum(is_entry) - 1
+
+    licks = np.flatnonzero(codes == LICK)
+    lick_times = times[licks]
+    lick_visit = visit[licks]
+    following = codes[np.minimum(licks + 1, len(codes) - 1)]
+    accepted = ((licks + 1 < len(codes)) &
+                ((following == WATER) | (following == DRUG)))
+
+    new_visit = np.ones(len(licks), bool)
+    new_visit[1:] = lick_visit[1:] != lick_visit[:-1]
+    new_bout = new_visit.copy()
+    gaps = np.diff(lick_times)
+    new_bout[1:] |= gaps > gap_ms
+    intervals = np.full(len(licks), np.nan)
+    intervals[1:] = gaps
+    intervals[new_bout] = np.nan
+
+    bout_starts = np.flatnonzero(new_bout)
+    bout_sizes = np.diff(np.append(bout_starts, len(licks)))
+    bout_lengths = (lick_times[bout_starts + bout_sizes - 1] -
+                    lick_times[bout_starts])
+
+    latencies = np.full(len(entries), np.nan)
+    first = new_visit & (lick_visit >= 0)
+    latencies[lick_visit[first]] = (lick_times[first] -
+                                    times[entries[lick_visit[first]]])
+    return {'licks': licks, 'accepted': accepted, 'lick_visit': lick_visit,
+            'intervals': intervals, 'bout_starts': bout_starts,
+            'bout_sizes': bout_sizes, 'bout_lengths': bout_lengths,
+            'entries': entries, 'latencies': latencies}
+
+
+def daily_summary(times, codes, days, n_days, gap_ms=BOUT_GAP_MS):
+    """Summarizes a mouse's licking for each day.
+
+    Args:
+        times and codes are as for analyze().
+        days is a numpy array of the day (from 0) of each event.
+        n_days is the number of days.
+        gap_ms is as for analyze().
+
+    Returns:
+        A dict of numpy arrays with a value for each day: visits, licks,
+        rejected (licks), bouts, bout_licks (mean bout size), bout_seconds
+        (mean bout length), lick_rate (Hz within bouts), interval (mean
+        inter-lick interval within bouts, in ms) and first_lick (mean time
+        to first lick in seconds). Means are NaN for days without any.
+    """
+
+    result = analyze(times, codes, gap_ms)
+    days = np.asarray(days)
+
+    def count(labels, weights=None):
+        return np.bincount(labels, weights, minlength=n_days)
+
+    def mean(labels, values):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return count(labels, values) / count(labels)
+
+    lick_days = days[result['licks']]
+    bout_days = lick_days[result['bout_starts']]
+    visit_days = days[result['entries']]
+    multiple = result['bout_sizes'] > 1
+    timed = ~np.isnan(result['intervals'])
+    licked = ~np.isnan(result['latencies'])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lick_rate = (1000 * count(bout_days[multiple],
+                                  result['bout_sizes'][multiple] - 1) /
+                     count(bout_days[multiple],
+                           result['bout_lengths'][multiple]))
+    return {'visits': count(visit_days),
+            'licks': count(lick_days),
+            'rejected': count(lick_days[~result['accepted']]),
+            'bouts': count(bout_days),
+            'bout_licks': mean(bout_days, result['bout_sizes']),
+            'bout_seconds': mean(bout_days, result['bout_lengths']) / 1000,
+            'lick_rate': lick_rate,
+            'interval': mean(lick_days[timed], result['intervals'][timed]),
+            'first_lick': mean(visit_days[licked],
+                               result['latencies'][licked]) / 1000}
+
+
+def load_events(export_dir, mouse):
+    """Loads a mouse's exported events.
+
+    Returns:
+        The list of dates, and numpy arrays of the event times, codes and
+        day (index into the dates) of each event.
+    """
+
+    dates = export.day_folders(export_dir, mouse)
+    times, codes, lengths = [], [], []
+    for date in dates:
+        day = export.load_day(export_dir, mouse, date)
+        times.append(day['event_times'])
+        codes.append(day['event_codes'])
+        lengths.append(len(day['event_times']))
+    if not dates:
+        return dates, np.zeros(0, np.int64), np.zeros(0, np.uint8), \
+            np.zeros(0, np.int64)
+    return (dates, np.concatenate(times), np.concatenate(codes),
+            np.repeat(np.arange(len(dates)), lengths))
+
+
+def lick_report(export_dir, output, gap_ms=BOUT_GAP_MS, mice=None):
+    """Writes a table of each mouse's daily lick microstructure.
+
+    Args:
+        export_dir is a string containing the export folder.
+        output is a string containing the location of the table.
+        gap_ms is as for analyze().
+        mice is a list of the mice to include, or None for every mouse.
+
+    Returns:
+        The number of mice and of days in the table.
+    """
+
+    if mice is None:
+        mice = sorted(name for name in os.listdir(export_dir)
+                      if export.day_folders(export_dir, name))
+    n_days = 0
+    with open(output, 'w') as file:
+        file.write("Mouse\tDate\tVisits\tLicks\tRejected Licks (%)\tBouts\t"
+                   "Licks per Bout\tBout Length (s)\tLick Rate (Hz)\t"
+                   "Inter-lick Interval (ms)\tTime to First Lick (s)\n")
+        for mouse in mice:
+            dates, times, codes, days = load_events(export_dir, mouse)
+            summary = daily_summary(times, codes, days, len(dates), gap_ms)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                rejected = 100 * summary['rejected'] / summary['licks']
+            for j, date in enumerate(dates):
+                values = [rejected[j], summary['bout_licks'][j],
+                          summary['bout_seconds'][j], summary['lick_rate'][j],
+                          summary['interval'][j], summary['first_lick'][j]]
+                file.write('%s\t%s\t%i\t%i\t%s\t%i\t%s\n' % (
+                    mouse, date, summary['visits'][j], summary['licks'][j],
+                    '' if np.isnan(values[0]) else '%.1f' % (values[0]),
+                    summary['bouts'][j],
+                    '\t'.join('' if np.isnan(value) else '%.2f' % (value)
+                              for value in values[1:])))
+            n_days += len(dates)
+    return len(mice), n_days
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a table of daily "
+                                     "lick bouts, lick rates, time to first "
+                                     "lick and rejected licks from "
+                                     "export.py's arrays.")
+    parser.add_argument('export_dir', nargs='?',
+                        default='/home/pi/piDose/export')
+    parser.add_argument('--gap', type=float, default=BOUT_GAP_MS,
+                        help="inter-lick interval in ms that ends a bout "
+                        "(default %(default)s)")
+    parser.add_argument('--mouse', action='append', default=None,
+                        help="mouse to include (can be given more than "
+                        "once, defaults to every mouse)")
+    parser.add_argument('--output', default=None,
+                        help="table to write (defaults to lick_report.txt "
+                        "in the export folder)")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(args.export_dir, 'lick_report.txt')
+    start = perf_counter()
+    n_mice, n_days = lick_report(args.export_dir, output, args.gap,
+                                 args.mouse)
+    print("Analyzed %i days of %i mice in %.2f s. Lick table in %s."
+          % (n_days, n_mice, perf_counter() - start, output))
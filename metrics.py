@@ -0,0 +1,272 @@
+"""Runtime metrics for PiDose, served in the Prometheus text format.
+
+The program counts events (licks, drops, visits, unknown tags) and times
+the things most likely to slow it down (lick to valve opening, weighing,
+writing events, reading RFIDs, re-taring, rollover) into Counter and
+Histogram metrics. Recording a value only takes a lock and adds to a
+couple of numbers (a histogram finds its bucket by bisection), so it costs
+about a microsecond and does not grow with how long the program has run.
+
+If METRICS_ADDRESS is set, a MetricsServer thread answers GET /metrics with
+the current values, e.g. for a Prometheus server scraping every cage:
+
+    # HELP pidose_drops_total Drops queued.
+    # TYPE pidose_drops_total counter
+    pidose_drops_total{chamber="Chamber 1",kind="water"} 336
+    # HELP pidose_lick_to_valve_seconds Time from a lick to the start...
+    # TYPE pidose_lick_to_valve_seconds histogram
+    pidose_lick_to_valve_seconds_bucket{chamber="Chamber 1",le="0.001"} 12
+    ...
+
+The address is a (host, port) tuple for HTTP over TCP (keep the host
+'127.0.0.1' to only serve the Pi itself), or a string path for HTTP over a
+Unix socket.
+
+"""
+
+import os
+import bisect
+import logging
+import threading
+import socketserver
+import http.server
+
+log = logging.getLogger('piDose.metrics')
+
+# Bucket upper bounds in seconds, from 0.1 ms to 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                          .replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % (','.join(pairs)) if pairs else ''
+
+
+class Metric(object):
+    """A named metric with a value (or values) for each set of labels."""
+
+    TYPE = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """The metric for one set of label values (created the first time
+        it is asked for). Look this up once and keep it, rather than on
+        every observation.
+
+        Args:
+            values are the label values, in the order of label_names.
+
+        Returns:
+            A child object with inc() (counters) or observe() (histograms).
+
+        Raises:
+            ValueError: the wrong number of label values was given.
+        """
+
+        if len(values) != len(self.label_names):
+            raise ValueError("%s takes labels %s, got %s." % (
+                self.name, self.label_names, values))
+        values = tuple(str(value) for value in values)
+        with self._lock:
+            if values not in self._children:
+                self._children[values] = self._child()
+            return self._children[values]
+
+    def render(self):
+        """The metric's lines in the Prometheus text format."""
+
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            lines.extend(child.render(self.name, self.label_names, values))
+        return lines
+
+
+class _CounterChild(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+        return None
+
+    def render(self, name, label_names, values):
+        return ['%s%s %s' % (name, _format_labels(label_names, values),
+                             repr(self.value))]
+
+
+class _HistogramChild(object):
+
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Records one value (e.g. a time in seconds)."""
+
+        j = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[j] += 1
+            self.sum += value
+        return None
+
+    def render(self, name, label_names, values):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket%s %i' % (
+                name, _format_labels(label_names, values, 'le="%s"' % (le)),
+                cumulative))
+        labels = _format_labels(label_names, values)
+        lines.append('%s_sum%s %r' % (name, labels, total))
+        lines.append('%s_count%s %i' % (name, labels, cumulative))
+        return lines
+
+
+class Counter(Metric):
+    """A count that only goes up (e.g. drops delivered)."""
+
+    TYPE = 'counter'
+
+    def _child(self):
+        return _CounterChild()
+
+
+class Histogram(Metric):
+    """Counts of values (e.g. latencies) falling into fixed buckets."""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, description, label_names=(),
+                 buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+
+class MetricsRegistry(object):
+    """The program's metrics, rendered together."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, description, label_names=()):
+        """Makes and registers a Counter()."""
+
+        metric = Counter(name, description, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, label_names=(),
+                  buckets=LATENCY_BUCKETS):
+        """Makes and registers a Histogram()."""
+
+        metric = Histogram(name, description, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All of the metrics in the Prometheus text format (a string)."""
+
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return None
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return None
+
+    def log_message(self, format, *args):
+        return None
+
+
+class _TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # Unix sockets have no client address, which the handler expects
+        request, client_address = socketserver.UnixStreamServer.get_request(
+            self)
+        return request, ('local', 0)
+
+
+class MetricsServer(object):
+    """Serves a MetricsRegistry over HTTP on a background thread."""
+
+    def __init__(self, registry, address):
+        """Starts the server.
+
+        Args:
+            registry is the MetricsRegistry() to serve.
+            address is a (host, port) tuple to serve over TCP, or a string
+            path of a Unix socket (replaced if it already exists).
+        """
+
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self._server = _UnixServer(address, _Handler)
+        else:
+            self._server = _TCPServer(tuple(address), _Handler)
+        self._server.registry = registry
+        self.address = address
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='MetricsServer', daemon=True)
+        self._thread.start()
+        log.info("Serving metrics on %s.", address)
+
+    def close(self):
+        """Stops the server.
+
+        Returns:
+            None.
+        """
+
+        self._server.shutdown()
+        self._server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+        return None
@@ -0,0 +1,406 @@
+"""In-memory registry of the mice listed in mice.cfg.
+
+mice.cfg is read once when the registry is created and each mouse is indexed
+by its RFID tag, so identifying a mouse on entry is a dictionary lookup rather
+than a scan of the whole file. Changes are tracked per mouse and only written
+back to disk when something has actually changed. Writes go to a temporary
+file which then replaces mice.cfg, so a crash part way through a save can never
+leave a truncated config behind.
+
+The tab-separated layout of mice.cfg is unchanged:
+
+    RFID_Tag  Name  Treat.  D.ofM.  D.inC.  DrugD.  WaterD.  ReqD.D.  Weight
+
+Changes made between saves (above all the drop counters, which change on
+every drop) can also be kept in a write-ahead journal next to mice.cfg, so a
+crash or a restart by monitor.sh in the middle of a visit loses nothing.
+Each change appends one short, tab-separated line to the journal:
+
+    # base 2868279354
+    2006010044  drug_drops+=1
+    2006010044  mouse_day=5  day_count=4  water_drops=0
+
+Appending a line costs far less than rewriting mice.cfg. save() compacts
+the journal into mice.cfg (through a temporary file, as always) and then
+starts a new journal whose first line is the CRC-32 of the mice.cfg it
+follows. The drop counters are changed from the lick callback, so their
+journal lines can be handed to another thread (the storage writer) to
+append and fsync; a line handed over before a save is dropped if it is
+appended after it, since the saved mice.cfg already holds the change.
+When the registry is loaded, the journal is replayed onto mice.cfg
+only if that CRC matches, so a crash between replacing mice.cfg and starting
+the new journal cannot apply the same changes twice. A partly written last
+line (from a crash while appending) is ignored.
+
+"""
+
+import os
+import zlib
+import logging
+import threading
+from time import perf_counter
+import tracing
+
+log = logging.getLogger('piDose.storage')
+
+
+class MouseRecord(object):
+    """Holds the mice.cfg columns for a single mouse."""
+
+    __slots__ = ('tag', 'name', 'treatment', 'mouse_day', 'day_count',
+                 'drug_drops', 'water_drops', 'required_drug_drops', 'weight')
+    TYPES = {'tag': str, 'name': str, 'treatment': str, 'mouse_day': int,
+             'day_count': int, 'drug_drops': int, 'water_drops': int,
+             'required_drug_drops': int, 'weight': float}
+
+    def __init__(self, fields):
+        """Builds a record from the tab-separated columns of a mice.cfg line.
+
+        Args:
+            fields is a list of strings holding the nine mice.cfg columns.
+
+        Raises:
+            ValueError: fields is not a valid mouse line.
+        """
+
+        if len(fields) < 9:
+            raise ValueError("Expected 9 columns, got %i." % (len(fields)))
+        self.tag = fields[0]
+        self.name = fields[1]
+        self.treatment = fields[2]
+        self.mouse_day = int(fields[3])
+        self.day_count = int(fields[4])
+        self.drug_drops = int(fields[5])
+        self.water_drops = int(fields[6])
+        self.required_drug_drops = int(fields[7])
+        self.weight = float(fields[8])
+
+    def to_line(self):
+        """Formats the record as a mice.cfg line (without a newline)."""
+
+        return '\t'.join(str(getattr(self, name)) for name in self.__slots__)
+
+
+class MouseJournal(object):
+    """Append-only journal of changes to mouse records (see above)."""
+
+    def __init__(self, path, sync=True):
+        """Args:
+            path is a string containing the location of the journal.
+            sync is True to fsync every record, so it survives a power cut
+            as well as a crash of the program.
+        """
+
+        self.path = path
+        self.sync = sync
+        self.records = 0
+        # Number of journals started, so a change made for an earlier one
+        # can be told apart
+        self.generation = 0
+        self._file = None
+
+    def read(self, base):
+        """Reads the changes recorded after the given mice.cfg.
+
+        Args:
+            base is the CRC-32 of the mice.cfg the registry was loaded from.
+
+        Returns:
+            A list of (tag, op, field, value string) tuples, where op is '='
+            or '+=', oldest first. Empty if there is no journal or it
+            follows a different mice.cfg.
+        """
+
+        try:
+            with open(self.path, 'r') as file:
+                lines = file.read().split('\n')
+        except FileNotFoundError:
+            return []
+        if lines[0] != '# base %i' % (base):
+            if len(lines) > 2 or lines[-1]:
+                log.warning("Ignoring %s, mice.cfg was saved or edited after "
+                            "it was written.", self.path)
+            return []
+        # The last element follows the final newline, so it is either empty
+        # or a line cut short by a crash
+        if lines[-1]:
+            log.warning("Ignoring partly written last line of %s.",
+                        self.path)
+        changes = []
+        for line in lines[1:-1]:
+            fields = line.split('\t')
+            for change in fields[1:]:
+                if '+=' in change:
+                    name, value = change.split('+=', 1)
+                    changes.append((fields[0], '+=', name, value))
+                else:
+                    name, value = change.split('=', 1)
+                    changes.append((fields[0], '=', name, value))
+        return changes
+
+    def start(self, base):
+        """Replaces the journal with an empty one following the given
+        mice.cfg.
+
+        Args:
+            base is the CRC-32 of the mice.cfg just saved.
+
+        Returns:
+            None.
+        """
+
+        self.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write('# base %i\n' % (base))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a')
+        self.records = 0
+        self.generation += 1
+        return None
+
+    def append(self, tag, changes):
+        """Appends one record.
+
+        Args:
+            tag is the RFID of the mouse (a string).
+            changes is a list of 'field=value' or 'field+=delta' strings.
+
+        Returns:
+            None.
+        """
+
+        self._file.write('%s\t%s\n' % (tag, '\t'.join(changes)))
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        self.records += 1
+        return None
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return None
+
+
+class MouseRegistry(object):
+    """Mice from mice.cfg, keyed by RFID tag, with dirty tracking.
+
+    Lines that are not mouse records (the header, blank lines) are kept
+    exactly as they were read and written back unchanged.
+    """
+
+    def __init__(self, path, journal_path=None, sync=True):
+        """Loads mice.cfg into memory, along with the changes in the journal
+        if there is one.
+
+        Args:
+            path is a string containing the location of mice.cfg.
+            journal_path is a string containing the location of the journal,
+            or None to save changes only when save() is called.
+            sync is as for MouseJournal().
+        """
+
+        self.path = path
+        self.journal = (None if journal_path is None
+                        else MouseJournal(journal_path, sync))
+        self._lock = threading.Lock()
+        # Held while writing the journal. Appends (and syncs) are made under
+        # this lock only, never under _lock, so they do not hold up changes
+        # to the records themselves
+        self._journal_lock = threading.Lock()
+        self._lines = []
+        self._records = {}
+        self._line_index = {}
+        self._dirty = set()
+        self.recovered = 0
+        self.recovery_ms = 0.0
+        self.load()
+
+    def load(self):
+        """(Re)reads mice.cfg from disk, discarding any unsaved changes that
+        are not in the journal. The journal's changes are replayed and
+        saved to mice.cfg.
+
+        Returns:
+            None.
+        """
+
+        start = perf_counter()
+        with open(self.path, 'r') as file:
+            text = file.read()
+        self._lines = text.split('\n')
+        self._records = {}
+        self._line_index = {}
+        self._dirty = set()
+        for j, line in enumerate(self._lines):
+            try:
+                record = MouseRecord(line.split('\t'))
+            except ValueError:
+                continue
+            self._records[record.tag] = record
+            self._line_index[record.tag] = j
+        if self.journal is None:
+            return None
+
+        # Replay the journal, then compact it into mice.cfg
+        base = zlib.crc32(text.encode())
+        changes = self.journal.read(base)
+        for tag, op, name, value in changes:
+            if tag not in self._records:
+                log.warning("Journal entry for unknown mouse %s ignored.",
+                            tag)
+                continue
+            record = self._records[tag]
+            value = MouseRecord.TYPES[name](value)
+            if op == '+=':
+                value = getattr(record, name) + value
+            setattr(record, name, value)
+            self._dirty.add(tag)
+        self.recovered = len(changes)
+        if self._dirty:
+            self.save()
+        else:
+            self.journal.start(base)
+        self.recovery_ms = (perf_counter() - start) * 1000
+        if changes:
+            log.warning("Recovered %i changes from %s in %.1f ms.",
+                        len(changes), self.journal.path, self.recovery_ms)
+        return None
+
+    def __contains__(self, rfid_tag):
+        return str(rfid_tag) in self._records
+
+    def __getitem__(self, rfid_tag):
+        return self._records[str(rfid_tag)]
+
+    def __iter__(self):
+        return iter(self._records.values())
+
+    def __len__(self):
+        return len(self._records)
+
+    def update(self, rfid_tag, **fields):
+        """Sets fields on a mouse record and marks it as needing to be saved.
+
+        Args:
+            rfid_tag is the RFID of the mouse (string or int).
+            fields are keyword arguments naming MouseRecord attributes.
+
+        Returns:
+            None.
+
+        Raises:
+            KeyError: rfid_tag is not in the registry.
+        """
+
+        record = self._records[str(rfid_tag)]
+        changes = ['%s=%s' % (name, value) for name, value in fields.items()]
+        with self._lock:
+            for name, value in fields.items():
+                setattr(record, name, value)
+            self._dirty.add(record.tag)
+            if self.journal is None:
+                return None
+            generation = self.journal.generation
+        self._append(generation, record.tag, changes)
+        return None
+
+    @tracing.traced
+    def add(self, rfid_tag, name, delta=1, defer=None):
+        """Adds to a counter of a mouse record (e.g. drug_drops), and
+        appends the change to the journal if there is one.
+
+        Args:
+            rfid_tag is the RFID of the mouse (string or int).
+            name is the name of an int MouseRecord attribute.
+            delta is the int to add.
+            defer is a function to hand the journal append to, which is
+            called with a function and its arguments and calls it later on
+            another thread (e.g. storage.AsyncWriter.call()). None appends
+            it before returning.
+
+        Returns:
+            None.
+
+        Raises:
+            KeyError: rfid_tag is not in the registry.
+        """
+
+        record = self._records[str(rfid_tag)]
+        changes = ['%s+=%i' % (name, delta)]
+        with self._lock:
+            setattr(record, name, getattr(record, name) + delta)
+            self._dirty.add(record.tag)
+            if self.journal is None:
+                return None
+            generation = self.journal.generation
+        if defer is None:
+            self._append(generation, record.tag, changes)
+        else:
+            defer(self._append, generation, record.tag, changes)
+        return None
+
+    def _append(self, generation, tag, changes):
+        """Appends a change made by update() or add(), unless mice.cfg has
+        been saved since it was made (and so already holds it). Called
+        without _lock held."""
+
+        with self._journal_lock:
+            if self.journal.generation == generation:
+                self.journal.append(tag, changes)
+        return None
+
+    @property
+    def dirty(self):
+        """True if there are changes that have not been saved."""
+
+        return bool(self._dirty)
+
+    def save(self):
+        """Writes any changed records back to mice.cfg atomically, and starts
+        a new, empty journal.
+
+        Only the lines of mice that have changed are regenerated, everything
+        else is written back exactly as it was read. Nothing is written if no
+        records have changed.
+
+        Returns:
+            None.
+        """
+
+        with self._lock:
+            if not self._dirty:
+                return None
+            for tag in self._dirty:
+                self._lines[self._line_index[tag]] = \
+                    self._records[tag].to_line()
+
+            text = '\n'.join(self._lines)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as file:
+                file.write(text)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+            self._dirty.clear()
+            if self.journal is not None:
+                with self._journal_lock:
+                    self.journal.start(zlib.crc32(text.encode()))
+        return None
+
+    def close(self):
+        """Saves any changes and closes the journal.
+
+        Returns:
+            None.
+        """
+
+        self.save()
+        if self.journal is not None:
+            with self._journal_lock:
+                self.journal.close()
+        return None
@@ -3,9 +3,16 @@
 This program is meant to be run on a Raspberry Pi operating a PiDose home-cage
 setup. It performs all detection, weighing, drug and water dispensing and data 
 recording necessary for the proper operation of PiDose. Note that this version 
-of the script does not incorporate a camera to take pictures/videos. This 
-program should be run from the provided bash script (monitor.sh), which should 
-be set to automatically run at startup.
+of the script does not incorporate a camera to take pictures/videos (see 
+piDose_camera.py). This program should be run from the provided bash script 
+(monitor.sh), which should be set to automatically run at startup.
+
+All devices are accessed through the backends in hardware.py, so the program 
+can also be run off the Pi on the simulated cage in simulator.py.
+
+One Pi can run several chambers (see CHAMBERS), each with its own RFID 
+reader, load cell, solenoid, syringe pump, mice and data, and one electrode of
+a shared MPR121.
 
 Written by Cameron Woodard and Bahram Samiei.
 
@@ -13,16 +20,26 @@ Written by Cameron Woodard and Bahram Samiei.
 
 import os
 import sys
-import board
-import busio
-import adafruit_mpr121
-import RPi.GPIO as GPIO
+import signal
+import logging
+import threading
 import datetime as dt
-import numpy as np
-from time import sleep, time
-from scipy import stats
-from Scale import Scale
-from RFIDTagReader import TagReader
+import diagnostics
+import tracing
+from hardware import PiHardware
+from mouse_registry import MouseRegistry
+from storage import open_storage, AsyncWriter
+from actuator import ActuatorWorker
+from stepper import StepperDriver
+from video_clips import ClipRecorder
+from still_capture import StillCapture
+from weight_histogram import WeightHistogram
+from rolling_stats import RollingWindow
+from plateau import PlateauDetector
+from scale_stream import ScaleStream
+from event_loop import EdgeLoop
+from metrics import MetricsRegistry, MetricsServer
+from timing import SystemClock, RateScheduler
 
 
 # Task Constants
@@ -34,11 +51,60 @@ DRUG_DROP_FREQUENCY = 1
 SOLENOID_OPEN_TIME = 0.1
 REVERSE_SOLENOID = False
 SCALE_GRAMS_PER_UNIT = 0.00048
+SCALE_MODE = 'single'
+SCALE_SAMPLE_RATE = 80
+SCALE_DECIMATION = 16
+SCALE_FILTER = 'median'
+SCALE_BATCH_INTERVAL = 1
+SCALE_BUFFER_SIZE = 1024
 RETARE_WEIGH_ATTEMPTS = 20
 RETARE_VARIABILITY = 0.1
+RETARE_INTERVAL = 600
+DAILY_REBOOT = False
 UPPER_WEIGHT = 60
 LOWER_WEIGHT = 20
+PLATEAU_WINDOW = 5
+PLATEAU_MAX_SD = 0.1
 SYRINGE_STEPS = 57
+MOTOR_STEP_FREQUENCY = 500
+MOTOR_START_FREQUENCY = 500
+MOTOR_RAMP_STEPS = 0
+MOTOR_MICROSTEP = 8
+
+# Data Constants
+MICE_CONFIG = '/home/pi/piDose/mice.cfg'
+MICE_JOURNAL_SYNC = False
+MICE_JOURNAL_COMPACT = 1000
+TARE_LOG = '/home/pi/piDose/tare_weights.txt'
+DATA_DIR = '/home/pi/piDose/data'
+STORAGE_BACKEND = 'text'
+WEIGHT_LOG_FORMAT = 'text'
+WEIGHT_LOG_MODE = 'raw'
+SQLITE_DATABASE = '/home/pi/piDose/data/piDose.db'
+SQLITE_SYNC_INTERVAL = 5
+WRITER_QUEUE_SIZE = 10000
+WRITER_FLUSH_SIZE = 100
+WRITER_FLUSH_INTERVAL = 1
+
+# Logging Constants
+LOG_FILE = '/home/pi/piDose/logs/piDose.log'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_MAX_AGE = 86400
+LOG_BACKUP_COUNT = 30
+LOG_QUEUE_SIZE = 10000
+LOG_CONSOLE_LEVEL = 'WARNING'
+LOG_LEVELS = {'piDose': 'INFO', 'piDose.licks': 'INFO',
+              'piDose.drops': 'INFO', 'piDose.scale': 'INFO',
+              'piDose.camera': 'INFO'}
+
+# Metrics Constants
+METRICS_ADDRESS = None
+
+# Tracing Constants
+TRACE_ENABLED = False
+TRACE_BUFFER_SIZE = 100000
+TRACE_DIR = '/home/pi/piDose/traces'
+PROFILE_INTERVAL = 0.005
 
 # GPIO Pin Constants
 PIN_RFID_TIR = 27
@@ -61,509 +127,1387 @@ RFID_PORT = "/dev/serial0"
 RFID_TIMEOUT = 0.1
 RFID_KIND = 'ID'
 RFID_UNKNOWN_REBOOT = 10
+RFID_CHECK_INTERVAL = 1
+
+# Camera Constants (piDose_camera.py only)
+CAMERA_RESOLUTION = (480, 360)
+CAMERA_VFLIP = True
+CAMERA_HFLIP = True
+CAMERA_ROTATION = 90
+CAMERA_STILLS = True
+STILL_QUEUE_SIZE = 4
+STILL_BUFFERS = 4
+STILL_COALESCE_MS = 500
+CAMERA_CLIPS = True
+VIDEO_RESOLUTION = (320, 240)
+VIDEO_FRAMERATE = 30
+VIDEO_BITRATE = 1000000
+CLIP_PRE_SECONDS = 5
+CLIP_POST_SECONDS = 5
+CLIP_MAX_SECONDS = 20
+CLIP_QUEUE_SIZE = 4
+
 
+# Chamber Constants
+# One dict per chamber run by this Pi. Each dict can set any of the
+# constants in CHAMBER_CONSTANTS for that chamber; the rest take the values
+# above. The MPR121 (and PIN_CAP_IRQ) is shared, so each chamber needs its
+# own CAP_SPOUT_PIN electrode.
+CHAMBERS = [{}]
+CHAMBER_CONSTANTS = ('MICE_CONFIG', 'TARE_LOG', 'DATA_DIR', 'SQLITE_DATABASE',
+                     'PIN_RFID_TIR', 'PIN_SCALE_CLK', 'PIN_SCALE_DAT',
+                     'PIN_SOLENOID', 'PIN_MOTOR_STEP', 'PIN_MOTOR_DIR',
+                     'PIN_MOTOR_MS1', 'PIN_MOTOR_MS2', 'CAP_SPOUT_PIN',
+                     'RFID_PORT')
 
-# Global Mouse Variables
-mouse_name = ''
-mouse_day = 0
-day_count = 0
-drug_drops = 0
-water_drops = 0
-current_weight = 0
-required_drug_drops = 0
-water_timer = 0
-current_day = dt.datetime.now().day
-b_mouse_treatment = False
+
+# Hardware
+GPIO = None
+clock = SystemClock()
+cap = None
+cap_touched = 0
+
+# Loggers (see diagnostics.py)
+log = logging.getLogger('piDose')
+lick_log = logging.getLogger('piDose.licks')
+drop_log = logging.getLogger('piDose.drops')
+scale_log = logging.getLogger('piDose.scale')
+camera_log = logging.getLogger('piDose.camera')
+
+# Metrics (see metrics.py), labelled by chamber
+metrics_registry = MetricsRegistry()
+licks_total = metrics_registry.counter(
+    'pidose_licks_total', "Licks detected.", ('chamber',))
+drops_total = metrics_registry.counter(
+    'pidose_drops_total', "Drops queued.", ('chamber', 'kind'))
+visits_total = metrics_registry.counter(
+    'pidose_visits_total', "Entries of known mice.", ('chamber',))
+unknown_tags_total = metrics_registry.counter(
+    'pidose_unknown_tags_total', "Entries of RFIDs not in mice.cfg.",
+    ('chamber',))
+drop_failures_total = metrics_registry.counter(
+    'pidose_drop_failures_total', "Drops that could not be delivered "
+    "because the valve or syringe pump raised an error.",
+    ('chamber', 'kind'))
+lick_to_valve_seconds = metrics_registry.histogram(
+    'pidose_lick_to_valve_seconds', "Time from a lick to the start of its "
+    "drop (the valve opening or the first syringe pump step).",
+    ('chamber', 'kind'))
+weigh_period_seconds = metrics_registry.histogram(
+    'pidose_weigh_period_seconds', "Time between weight samples (batches "
+    "in 'stream' mode) during visits and re-tares.", ('chamber', 'loop'))
+weigh_jitter_seconds = metrics_registry.histogram(
+    'pidose_weigh_jitter_seconds', "Lateness of weight samples.",
+    ('chamber', 'loop'))
+record_event_seconds = metrics_registry.histogram(
+    'pidose_record_event_seconds', "Time taken by the storage backend to "
+    "write an event, on the writer thread (not counting flushes).",
+    ('chamber',))
+rfid_read_seconds = metrics_registry.histogram(
+    'pidose_rfid_read_seconds', "Time taken to read an RFID tag.",
+    ('chamber',))
+zero_scale_seconds = metrics_registry.histogram(
+    'pidose_zero_scale_seconds', "Time the main loop spends re-taring the "
+    "load cell (stopping weighing, zeroing and logging the tare).",
+    ('chamber',))
+rollover_seconds = metrics_registry.histogram(
+    'pidose_rollover_seconds', "Time taken to roll every mouse over to "
+    "the next day.", ('chamber',))
+
+# Global Variables
+profiler = None
+chambers = []
+current_day = 0
 b_reboot_pi = False
 
 
-def update_mouse_variables(rfid_tag):
-    """Takes an RFID tag and sets the global mouse variables of the program to
-    those corresponding with the detected mouse. 
-    
+def seconds_until_midnight():
+    """Time in seconds until just after the next midnight on the clock."""
+
+    now = clock.now()
+    midnight = dt.datetime.combine(now.date() + dt.timedelta(days=1),
+                                   dt.time())
+    return (midnight - now).total_seconds() + 0.001
+
+
+def time_ms():
+    """Gets the current time on the monotonic clock in milliseconds. Unlike the
+    time since the epoch, this is not changed when the system time is
+    corrected, so it is used for all of the program's timers.
+
     Args:
-        rfid_tag is string containing the RFID.
-        
-    Returns:
         None.
-    
-    Raises:
-        ValueError: rfid_tag not found in mice.cfg.
+
+    Returns:
+        Milliseconds on the monotonic clock as an int.
     """
-    
-    global mouse_name, mouse_day, day_count, drug_drops, water_drops
-    global current_weight, required_drug_drops, b_mouse_treatment
-
-    with open('/home/pi/piDose/mice.cfg', 'r') as file:
-        mice_lines = file.readlines()
-
-    for mouse_line in mice_lines:
-        mouse_line = mouse_line.replace('\n', '')
-        mouse_line = mouse_line.split('\t')
-
-        if mouse_line[0] == str(rfid_tag):
-            print("%s detected (ID = %s)! (%s)" %(mouse_line[1], str(rfid_tag),
-                  str(dt.datetime.now())))
-            mouse_name = mouse_line[1]
-            if mouse_line[2] == 'DRUG':
-                b_mouse_treatment = True
-            mouse_day = int(mouse_line[3])
-            day_count = int(mouse_line[4])
-            drug_drops = int(mouse_line[5])
-            water_drops = int(mouse_line[6])
-            required_drug_drops = int(mouse_line[7])
-            current_weight = float(mouse_line[8])
-            
-            # Check if it is a new day and reset daily variables if so
-            if dt.datetime.now().day != mouse_day:
-                # All non-mouse RFIDs used for testing/troubleshooting should 
-                # have the string 'TEST' in their name 
-                if not 'TEST' in mouse_name:
-                    print("Rollover time reached. Calculating average weight "
-                          "and resetting daily variables...")
-                    n_weights, current_weight = get_average_weight()
-                    print("Average weight on Day %i for %s was %s grams (mode "
-                          "calculated from %i weight measurements)." %(
-                          day_count, mouse_name, str(current_weight), 
-                          n_weights))
-                    record_summary()
-                    water_drops = 0
-                    if b_mouse_treatment:
-                        drug_drops = 0
-                        required_drug_drops = int(round(current_weight
-                                                        *DRUG_DROPS_PER_GRAM))
-                    day_count += 1
-                mouse_day = dt.datetime.now().day
-            return None
-    
-    raise ValueError("Mouse name not found in mice.cfg (ID = %s)." 
-                     %(str(rfid_tag)))
+
+    return clock.monotonic_ns() // 1000000
 
 
-def save_mouse_variables():
-    """Writes mouse variables to mice.cfg.
-    
+def cap_callback(channel):
+    """Callback routine that is triggered every time a falling edge is
+    detected on the capacitive sensor interrupt pin.
+
+    The MPR121 is shared by all of the chambers and interrupts whenever any
+    electrode is touched or released. Reading the touch state clears the
+    interrupt, and each electrode that has been newly touched is passed on as
+    a lick to its chamber (if there is a mouse in it).
+
     Args:
-        None.
-        
+        channel is the GPIO pin that triggered the callback.
+
     Returns:
         None.
     """
-    
-    with open('/home/pi/piDose/mice.cfg', 'r') as file:
-        data = file.readlines()
-
-    for j in range(len(data)):
-        data[j] = data[j].replace('\n', '')
-        data[j] = data[j].split('\t')
-
-        if data[j][1] == mouse_name:
-            data[j][3] = mouse_day
-            data[j][4] = day_count
-            data[j][5] = drug_drops
-            data[j][6] = water_drops
-            data[j][7] = required_drug_drops
-            data[j][8] = current_weight
-
-    with open('/home/pi/piDose/mice.cfg', 'w') as file:
-        for j in range(len(data)):
-            new_line = ''
-            for i in range(len(data[j])):
-                new_line += str(data[j][i]) + (
-                    '\n' if i == (len(data[j])-1) else '\t')
-            file.write(new_line)
-    
+
+    global cap_touched
+
+    with tracing.span('cap.touched'):
+        touched = cap.touched()
+    new_touches = touched & ~cap_touched
+    cap_touched = touched
+    for chamber in chambers:
+        if chamber.b_licks_enabled and new_touches & (1 <<
+                                                      chamber.cap_spout_pin):
+            chamber.dispense_water_callback()
     return None
 
 
-def record_event(timestamp, event):
-    """Records event information to data file for current mouse.
-    
-    Event Codes:
-        00: Mouse entered
-        99: Mouse exited
-        01: Mouse licked spout
-        02: Mouse received water drop
-        03: Mouse received drug solution drop
-        
+def trace_signal(signum, frame):
+    """SIGUSR1 handler. Turns tracing on (see tracing.py) or, if it is on,
+    writes the spans recorded so far to a Chrome trace file in TRACE_DIR.
+
     Args:
-        timestamp is a datetime.datetime() object
-        event is a string containing the event code
-        
+        signum and frame are passed by the signal module.
+
     Returns:
         None.
     """
-    
-    with open('/home/pi/piDose/data/%s/%s_data.txt' % (mouse_name, 
-              mouse_name), 'a') as file:
-        data = str(timestamp) + '\t' + event + '\n'
-        file.write(data)
+
+    if not tracing.is_enabled():
+        tracing.enable(TRACE_BUFFER_SIZE)
+        log.warning("Tracing started, send SIGUSR1 again to save the spans.")
+        return None
+    path = os.path.join(TRACE_DIR, 'trace_%s.json'
+                        % (clock.now().strftime('%m-%d-%Y-%H%M%S')))
+
+    # Written on another thread so the main loop is not held up
+    def write():
+        log.warning("Saved %i spans to %s.", tracing.dump(path), path)
+    threading.Thread(target=write, name='TraceDump', daemon=True).start()
     return None
 
 
-def record_summary():
-    """Records a summary of the previous day for each mouse.
-    
+def profile_signal(signum, frame):
+    """SIGUSR2 handler. Starts the sampling profiler, or stops it and writes
+    the sampled stacks to a folded stacks file in TRACE_DIR.
+
     Args:
-        None.
-    
+        signum and frame are passed by the signal module.
+
     Returns:
         None.
     """
 
-    with open('/home/pi/piDose/data/%s/%s_summary.txt' % (mouse_name, 
-              mouse_name), 'a') as summary_file:
-        if day_count == 0:
-            summary_file.write("Summary file for %s\n\n" %(mouse_name))
-            summary_file.write("Day\tTotal Drops\tWater Drops\tDrug Drops\t"
-                               "Required Drug Drops\tAverage Weight\n")
-        data = (str(day_count) + '\t' + str(water_drops + drug_drops) + '\t\t' 
-                + str(water_drops) + '\t\t' + str(drug_drops) + '\t\t' + 
-                str(required_drug_drops) + '\t\t\t' + str(current_weight) + 
-                '\n')  
-        summary_file.write(data)
+    global profiler
+
+    if profiler is None:
+        profiler = tracing.SamplingProfiler(PROFILE_INTERVAL)
+        profiler.start()
+        log.warning("Profiler started, send SIGUSR2 again to stop it.")
+        return None
+    path = os.path.join(TRACE_DIR, 'profile_%s.folded'
+                        % (clock.now().strftime('%m-%d-%Y-%H%M%S')))
+    stopped = profiler
+    profiler = None
+
+    # Stopped and written on another thread so the main loop is not held up
+    def write():
+        top = stopped.stop(path)
+        log.warning("Saved %i profiler samples to %s.", stopped.samples, path)
+        for stack, count in top[:3]:
+            log.warning("%i samples in %s.", count, stack.rsplit(';', 1)[-1])
+    threading.Thread(target=write, name='ProfileDump', daemon=True).start()
     return None
-        
-        
-def get_average_weight():
-    """Calculates average weight for the previous day by taking all weight 
-    measurements, rounding to 0.1g and taking the mode of these values.
-    
-    Args:
-        None.
-        
-    Returns:
-        The number of weight recordings used to calculate the average weight
-        (as an int), and the average weight (as a float).
-    """
-    
-    with open('/home/pi/piDose/data/%s/Weights/%s_weights_day%d.txt' % (
-              mouse_name, mouse_name, day_count), 'r') as weight_file:
-        weight_list = []
-        for line in weight_file:
-            line = line.replace('\n', '')
-            line = line.split('\t')
-            try:
-                if (float(line[1]) <= UPPER_WEIGHT and float(line[1]) >= 
-                    LOWER_WEIGHT):
-                    weight_list.append(round(float(line[1]), 1))
-            except IndexError:
-                continue
-    arr = np.array(weight_list)
-    weight = stats.mode(arr)
-    return len(weight_list), weight[0][0]
-
-
-def dispense_water(drug):
-    """Dispenses either a water drop (from solenoid) or a drug solution drop
-    (from syringe pump).
-    
+
+
+def check_chambers(configs):
+    """Checks that no two chambers in CHAMBERS share a file, serial port,
+    spout electrode or GPIO pin (with each other or with PIN_CAP_IRQ), which
+    would mix up their mice, data or devices. Only the microstep pins
+    (PIN_MOTOR_MS1 and PIN_MOTOR_MS2) can be shared, as every chamber sets
+    them to the same levels.
+
     Args:
-        drug is a boolean variable which is True if the mouse should receive
-        a drug drop, or False otherwise.
-        
+        configs is a list of dicts, as in CHAMBERS.
+
     Returns:
         None.
+
+    Raises:
+        ValueError: a chamber sets a constant not in CHAMBER_CONSTANTS, or
+        two chambers (or two pins) have the same value.
     """
-    
-    if drug:
-        for x in range(SYRINGE_STEPS):
-            GPIO.output(PIN_MOTOR_STEP, True)
-            sleep(0.001)
-            GPIO.output(PIN_MOTOR_STEP, False)
-            sleep(0.001)
-    else:
-        if not REVERSE_SOLENOID:
-            GPIO.output(PIN_SOLENOID, True)
-            sleep(SOLENOID_OPEN_TIME)
-            GPIO.output(PIN_SOLENOID, False)
-        else:
-            GPIO.output(PIN_SOLENOID, False)
-            sleep(SOLENOID_OPEN_TIME)
-            GPIO.output(PIN_SOLENOID, True) 
+
+    names = ['MICE_CONFIG', 'TARE_LOG', 'DATA_DIR', 'CAP_SPOUT_PIN',
+             'RFID_PORT']
+    if STORAGE_BACKEND == 'sqlite':
+        names.append('SQLITE_DATABASE')
+    pins = [name for name in CHAMBER_CONSTANTS if name.startswith('PIN_')
+            and name not in ('PIN_MOTOR_MS1', 'PIN_MOTOR_MS2')]
+    used = {('GPIO pin', PIN_CAP_IRQ): 'PIN_CAP_IRQ'}
+    for j, config in enumerate(configs):
+        for name in config:
+            if name not in CHAMBER_CONSTANTS:
+                raise ValueError("%s cannot be set per chamber." % (name))
+        for name in names + pins:
+            value = config.get(name, globals()[name])
+            if name in pins:
+                key = ('GPIO pin', value)
+            elif name in ('MICE_CONFIG', 'TARE_LOG', 'DATA_DIR',
+                          'SQLITE_DATABASE'):
+                key = (name, os.path.abspath(value))
+            else:
+                key = (name, value)
+            where = '%s of chamber %i' % (name, j + 1)
+            if key in used:
+                raise ValueError("%s and %s are both %s%s."
+                                 % (used[key], where,
+                                    'GPIO pin ' if name in pins else '',
+                                    str(value)))
+            used[key] = where
     return None
 
 
-def time_ms():
-    """Converts the current time since the epoch to milliseconds as an integer.
-    
-    Args:
-        None.
-        
-    Returns:
-        Milliseconds since the epoch as an int.   
-    """
-    
-    ms = int(round(time() * 1000))
-    return ms
-    
-
-def zero_scale(scale):
-    """Checks if load cell is stable over a certain time period and then 
-    re-tares it if so, otherwise does nothing.
-    
-    Will also trigger a reboot if it is a new day and load cell reading is 
-    stable.
-    
-    Args:
-        scale is a Scale.Scale() object representing the load cell.
-        
-    Returns:
-        None. 
+class Chamber(object):
+    """One PiDose chamber: an RFID reader, load cell, spout (an electrode of
+    the shared MPR121), solenoid valve and syringe pump, with its own mice,
+    data files and timers.
+
+    The chamber is a state machine, so one main loop can run several chambers
+    at once. step() does whatever is due (reading a tag, taking a weight
+    sample, ending the grace period...) without waiting, and says how long
+    until it next needs to run. Licks come in from cap_callback().
     """
-    
-    global b_reboot_pi
-    
-    weight_list = []
-    weigh_timer = time_ms()
-    with open('/home/pi/piDose/tare_weights.txt', 'a') as file:
-        file.write(str(dt.datetime.now()) + '\n')
-        while len(weight_list) < RETARE_WEIGH_ATTEMPTS:
-            if time_ms() - weigh_timer >= 1000/WEIGH_FREQUENCY:
-                weigh_timer = time_ms()
-                weight = scale.weighOnce()
-                file.write(str(weight) + '\n')
-                weight_list.append(weight)
-        mean_weight = sum(weight_list)/len(weight_list)
-        
-        # Check the variability of the weight measurements over the period
-        for weight in weight_list:
-            if abs(weight - mean_weight) > RETARE_VARIABILITY:
-                print("Scale not zeroed, sample variability too high.")
-                file.write("Not zeroed, sample variability too high. Mean "
-                           "weight = " + str(round(mean_weight, 2)) + '\n')
+
+    # States
+    IDLE = 'idle'
+    UNKNOWN = 'unknown'
+    PRESENT = 'present'
+    GRACE = 'grace'
+
+    def __init__(self, config, number=0):
+        """Args:
+            config is a dict giving values for this chamber of any of the
+            constants named in CHAMBER_CONSTANTS (e.g. {'PIN_RFID_TIR': 5}).
+            Those not given take the value of the module constant.
+            number is the index of the chamber in CHAMBERS.
+
+        Raises:
+            ValueError: config sets a constant not in CHAMBER_CONSTANTS.
+        """
+
+        for name in config:
+            if name not in CHAMBER_CONSTANTS:
+                raise ValueError("%s cannot be set per chamber." % (name))
+        for name in CHAMBER_CONSTANTS:
+            setattr(self, name.lower(), config.get(name, globals()[name]))
+        self.number = number
+        self.name = 'Chamber %i' % (number + 1)
+
+        # Devices and data, set up by open()
+        self.mice = None
+        self.storage = None
+        self.scale = None
+        self.scale_stream = None
+        self.tag_reader = None
+        self.stills = None
+        self.clips = None
+        self.stepper = None
+        self.actuator = None
+
+        # Mouse Variables
+        self.mouse_tag = ''
+        self.mouse_name = ''
+        self.mouse_day = 0
+        self.day_count = 0
+        self.drug_drops = 0
+        self.water_drops = 0
+        self.current_weight = 0
+        self.required_drug_drops = 0
+        self.weight_histogram = None
+        self.weight_histograms = {}
+        self.water_timer = -WATER_TIMEOUT
+        self.b_mouse_treatment = False
+
+        # Task Variables
+        self.state = Chamber.IDLE
+        self.tag_id = 0
+        self.unknown_count = 0
+        self.b_mouse_entered = False
+        self.b_licks_enabled = False
+        self.grace_start = 0
+        self.time_last_detected = None
+        # In 'stream' mode the schedulers time batches of samples
+        if SCALE_MODE not in ('single', 'stream'):
+            raise ValueError("Unknown SCALE_MODE %s." % (SCALE_MODE))
+        weigh_rate = (WEIGH_FREQUENCY if SCALE_MODE == 'single'
+                      else 1.0 / SCALE_BATCH_INTERVAL)
+        self.weigh_scheduler = RateScheduler(weigh_rate, clock.monotonic_ns)
+        self.tare_scheduler = RateScheduler(weigh_rate, clock.monotonic_ns)
+        self.tare_window = RollingWindow(RETARE_WEIGH_ATTEMPTS)
+        if WEIGHT_LOG_MODE not in ('plateaus', 'raw'):
+            raise ValueError("Unknown WEIGHT_LOG_MODE %s." % (WEIGHT_LOG_MODE))
+        self.plateaus = PlateauDetector(PLATEAU_WINDOW, PLATEAU_MAX_SD,
+                                        LOWER_WEIGHT, UPPER_WEIGHT)
+        # Samples taken, samples stored and plateaus found this visit
+        self.weight_counts = [0, 0, 0]
+        self.b_retare_pending = False
+        self.last_tare_ns = 0
+        self.rollover_day = None
+        # Metrics for this chamber, looked up once so recording is cheap
+        self.metrics = {
+            'licks': licks_total.labels(self.name),
+            'visits': visits_total.labels(self.name),
+            'unknown_tags': unknown_tags_total.labels(self.name),
+            'record_event': record_event_seconds.labels(self.name),
+            'rfid_read': rfid_read_seconds.labels(self.name),
+            'zero_scale': zero_scale_seconds.labels(self.name),
+            'rollover': rollover_seconds.labels(self.name)}
+        for kind in (ActuatorWorker.WATER, ActuatorWorker.DRUG):
+            self.metrics['drops', kind] = drops_total.labels(self.name, kind)
+            self.metrics['drop_failures', kind] = \
+                drop_failures_total.labels(self.name, kind)
+            self.metrics['lick_to_valve', kind] = \
+                lick_to_valve_seconds.labels(self.name, kind)
+        for loop in ('visit', 'tare'):
+            self.metrics['weigh_period', loop] = \
+                weigh_period_seconds.labels(self.name, loop)
+            self.metrics['weigh_jitter', loop] = \
+                weigh_jitter_seconds.labels(self.name, loop)
+        self._handlers = {Chamber.IDLE: self._idle,
+                          Chamber.UNKNOWN: self._unknown,
+                          Chamber.PRESENT: self._present,
+                          Chamber.GRACE: self._grace}
+
+    def open(self, hw, stills=None, clips=None):
+        """Sets up the chamber's GPIO pins, devices and data files.
+
+        Args:
+            hw is the hardware.Hardware() object holding the device backends.
+            stills is a still_capture.StillCapture() to take a picture on
+            every drop, or None.
+            clips is a video_clips.ClipRecorder() to save a clip of every
+            drop, or None.
+
+        Returns:
+            None.
+        """
+
+        # Load mice.cfg once, mice are looked up by RFID from here on. Drop
+        # counts are journaled as they change, and any left in the journal
+        # by a crash are recovered here.
+        self.mice = MouseRegistry(self.mice_config,
+                                  self.mice_config + '.journal',
+                                  MICE_JOURNAL_SYNC)
+        self.storage = AsyncWriter(open_storage(STORAGE_BACKEND,
+                                                self.data_dir,
+                                                self.sqlite_database,
+                                                SQLITE_SYNC_INTERVAL,
+                                                WEIGHT_LOG_FORMAT, clock),
+                                   WRITER_QUEUE_SIZE, WRITER_FLUSH_SIZE,
+                                   WRITER_FLUSH_INTERVAL,
+                                   {'record_event':
+                                    self.metrics['record_event'].observe})
+
+        # GPIO Setup
+        GPIO.setup(self.pin_rfid_tir, GPIO.IN)
+        GPIO.setup(self.pin_scale_dat, GPIO.IN)
+        GPIO.setup(self.pin_solenoid, GPIO.OUT)
+        if not REVERSE_SOLENOID:
+            GPIO.output(self.pin_solenoid, False)
+        else:
+            GPIO.output(self.pin_solenoid, True)
+        self.stepper = StepperDriver(GPIO, hw.pulses(), self.pin_motor_step,
+                                     self.pin_motor_dir, self.pin_motor_ms1,
+                                     self.pin_motor_ms2, MOTOR_STEP_FREQUENCY,
+                                     MOTOR_START_FREQUENCY, MOTOR_RAMP_STEPS,
+                                     MOTOR_MICROSTEP)
+
+        # Drops are delivered by the actuator worker, so licks are not held
+        # up while the solenoid is open or the syringe pump is stepping
+        self.actuator = ActuatorWorker(GPIO, clock, self.pin_solenoid,
+                                       self.stepper,
+                                       SOLENOID_OPEN_TIME, SYRINGE_STEPS,
+                                       REVERSE_SOLENOID, self.drop_delivered,
+                                       hw.threaded, 'Actuator %i'
+                                       % (self.number + 1))
+
+        # Spout Setup
+        cap[self.cap_spout_pin].threshold = CAP_TOUCH_THRESHOLD
+        cap[self.cap_spout_pin].release_threshold = CAP_RELEASE_THRESHOLD
+        self.stills = stills
+        self.clips = clips
+
+        # RFID Reader Setup
+        try:
+            self.tag_reader = hw.tag_reader(self.rfid_port, RFID_TIMEOUT,
+                                            RFID_KIND)
+        except Exception as e:
+            raise e("Error making RFIDTagReader")
+
+        # Scale Setup (in 'stream' mode the scale's array holds the readings
+        # of its threaded read, see scale_stream.py)
+        self.scale = hw.scale(self.pin_scale_dat, self.pin_scale_clk,
+                              SCALE_GRAMS_PER_UNIT,
+                              SCALE_BUFFER_SIZE if SCALE_MODE == 'stream'
+                              else 1)
+        self.scale.weighOnce()
+        self.scale.tare(1, False)
+        self.last_tare_ns = clock.monotonic_ns()
+        if SCALE_MODE == 'stream':
+            self.scale_stream = ScaleStream(self.scale, clock,
+                                            SCALE_SAMPLE_RATE,
+                                            SCALE_BUFFER_SIZE,
+                                            SCALE_DECIMATION, SCALE_FILTER,
+                                            hw.threaded)
+        return None
+
+    def close(self):
+        """Saves the mouse in the chamber (if there is one) and closes the
+        chamber's data files.
+
+        Returns:
+            None.
+        """
+
+        self.b_licks_enabled = False
+        if self.scale_stream is not None:
+            self.scale_stream.stop()
+        if self.actuator is not None:
+            self.actuator.close()
+            self.actuator = None
+        if self.b_mouse_entered:
+            self.record_plateau(self.plateaus.reset())
+            self.save_mouse_variables()
+            self.record_event(clock.now(), '99')
+            self.b_mouse_entered = False
+        if self.storage is not None:
+            self.storage.close()
+            self.storage = None
+        if self.mice is not None:
+            self.mice.close()
+        return None
+
+    def log_extra(self, event=None):
+        """The structured fields for a log record about this chamber (see
+        diagnostics.py).
+
+        Args:
+            event is the event code the record is about (see
+            record_event()), or None.
+
+        Returns:
+            A dict to pass as the extra argument of a log call.
+        """
+
+        return {'chamber': self.name,
+                'mouse': self.mouse_name if self.b_mouse_entered else None,
+                'event': event}
+
+    def is_idle(self):
+        """True if there is no mouse in the chamber."""
+
+        return self.state == Chamber.IDLE and not self.b_mouse_entered
+
+    def step(self):
+        """Does whatever the chamber has due, without waiting.
+
+        Args:
+            None.
+
+        Returns:
+            The time in seconds until the chamber next has something due, or
+            None if it is only waiting for the RFID tag-in-range pin to
+            change.
+        """
+
+        while True:
+            state = self.state
+            timeout = self._handlers[state]()
+            if self.state == state:
+                return timeout
+
+    def _idle(self):
+        """Waiting for an RFID to come into range, then loads the stats for
+        that mouse. Re-tares the load cell while the chamber is empty."""
+
+        if not GPIO.input(self.pin_rfid_tir):
+            if (clock.now().day != self.rollover_day and
+                not self.b_mouse_entered):
+                self.rollover()
+            timeout = self._retare()
+            until_midnight = seconds_until_midnight()
+            if timeout is None or until_midnight < timeout:
+                return until_midnight
+            return timeout
+        if self.b_retare_pending:
+            self.abort_tare()
+        if not self.b_mouse_entered:
+            self.tag_id = self.read_tag()
+        try:
+            self.update_mouse_variables(self.tag_id)
+        except ValueError as e:
+            log.warning("%s Waiting for mouse to leave.", e,
+                        extra=self.log_extra())
+            self.metrics['unknown_tags'].inc()
+            self.state = Chamber.UNKNOWN
+            return None
+
+        # Record entrance and activate spout
+        self.record_event(clock.now(), '00')
+        self.metrics['visits'].inc()
+        self.b_mouse_entered = True
+        self.b_licks_enabled = True
+        self.start_weighing()
+        self.state = Chamber.PRESENT
+        return None
+
+    def _unknown(self):
+        """Waiting for an unknown RFID to go out of range."""
+
+        global b_reboot_pi
+
+        if GPIO.input(self.pin_rfid_tir):
+            return None
+        log.info("Mouse no longer in range.", extra=self.log_extra())
+
+        # Sometimes, for whatever reason, the RFID reader stops working and
+        # will not successfully detect any of the mice. Following ensures
+        # that if an unknown mouse is detected too many times, the cage will
+        # automatically restart.
+        self.unknown_count += 1
+        if self.unknown_count == RFID_UNKNOWN_REBOOT:
+            log.error("Too many unkown tags detected, triggering reboot of "
+                      "the system.", extra=self.log_extra())
+            b_reboot_pi = True
+        self.state = Chamber.IDLE
+        return None
+
+    def _present(self):
+        """Weighs the mouse until its RFID goes out of range."""
+
+        if GPIO.input(self.pin_rfid_tir):
+            for timestamp, weight in self.read_weights(self.weigh_scheduler):
+                self.record_weight(timestamp, weight)
+            # Compact a long visit's journal into mice.cfg
+            if self.mice.journal.records >= MICE_JOURNAL_COMPACT:
+                self.mice.save()
+        if GPIO.input(self.pin_rfid_tir):
+            return self.weigh_scheduler.time_until_next()
+
+        # If RFID goes out of range, start grace period and turn off spout
+        self.stop_weighing()
+        self.record_plateau(self.plateaus.reset())
+        self.grace_start = time_ms()
+        self.time_last_detected = clock.now()
+        self.b_licks_enabled = False
+        log.info("%s no longer detected. Beginning grace period...",
+                 self.mouse_name, extra=self.log_extra())
+        self.state = Chamber.GRACE
+        return None
+
+    def _grace(self):
+        """Waits for the grace period to finish or for the RFID to come back
+        in range."""
+
+        remaining = (self.grace_start + RFID_GRACE_PERIOD - time_ms())/1000
+        if not GPIO.input(self.pin_rfid_tir) and remaining > 0:
+            return remaining
+        new_id = self.read_tag()
+
+        # Following is True if new mouse detected, or no RFID in range. Save
+        # data for previous mouse.
+        if self.tag_id != new_id:
+            self.save_mouse_variables()
+            self.record_event(self.time_last_detected, '99')
+            stats = self.weigh_scheduler.stats()
+            scale_log.info("Weighed %i times (mean jitter %.1f ms, max jitter "
+                           "%.1f ms, %i overruns).", stats['ticks'],
+                           stats['mean_jitter_ms'], stats['max_jitter_ms'],
+                           stats['overruns'], extra=self.log_extra())
+            self.weigh_scheduler.reset_stats()
+            scale_log.info("Stored %i of %i weight samples (%i plateaus).",
+                           self.weight_counts[1], self.weight_counts[0],
+                           self.weight_counts[2], extra=self.log_extra())
+            self.weight_counts = [0, 0, 0]
+            if self.scale_stream is not None and self.scale_stream.lost:
+                scale_log.warning("%i load cell readings lost (not pulled in "
+                                  "time, or failed).", self.scale_stream.lost,
+                                  extra=self.log_extra())
+                self.scale_stream.lost = 0
+            stats = self.actuator.stats()
+            if stats['commands']:
+                drop_log.info("Delivered %i drops (mean wait %.1f ms, max "
+                              "wait %.1f ms, mean duration %.1f ms).",
+                              stats['commands'] - stats['failed'],
+                              stats['mean_wait_ms'], stats['max_wait_ms'],
+                              stats['mean_run_ms'], extra=self.log_extra())
+            if stats['failed']:
+                drop_log.error("%i drops failed and were not delivered.",
+                               stats['failed'], extra=self.log_extra())
+            self.actuator.reset_stats()
+            if self.clips is not None:
+                stats = self.clips.stats()
+                camera_log.info("Clips so far: %i saved, %i drops added to an "
+                                "earlier clip, %i drops not filmed (slowest "
+                                "save %.0f ms).", stats['written'],
+                                stats['extended'], stats['dropped'],
+                                stats['write_ms_max'], extra=self.log_extra())
+            if self.stills is not None:
+                stats = self.stills.stats()
+                camera_log.info("Saved %i pictures (%i requests shared a "
+                                "picture, %i dropped, max queue depth %i, "
+                                "mean latency %.1f ms, max latency %.1f ms).",
+                                stats['saved'], stats['coalesced'],
+                                stats['dropped'], stats['max_depth'],
+                                stats['mean_latency_ms'],
+                                stats['max_latency_ms'],
+                                extra=self.log_extra())
+                self.stills.reset_stats()
+            self.b_mouse_treatment = False
+            if new_id != 0:
+                log.info("New mouse entered during grace period. "
+                         "Identifying...", extra=self.log_extra())
+                self.tag_id = new_id
+                self.state = Chamber.IDLE
+            else:
+                log.info("%s has exited the chamber.", self.mouse_name,
+                         extra=self.log_extra('99'))
+                self.b_mouse_entered = False
+                self.start_tare()
+                self.state = Chamber.IDLE
+
+        # Otherwise the same mouse is back in range. Reactivate spout.
+        else:
+            self.b_licks_enabled = True
+            log.info("%s has returned within grace period.",
+                     self.mouse_name, extra=self.log_extra())
+            self.start_weighing()
+            self.state = Chamber.PRESENT
+        return None
+
+    def _retare(self):
+        """Samples the empty load cell into the re-tare window, and zeroes it
+        as soon as the window is stable (see zero_scale()). Returns the time
+        in seconds until the next sample or re-tare is due."""
+
+        if not self.b_retare_pending:
+            if not RETARE_INTERVAL:
                 return None
-                
-        # If readings from load cell not further than RETARE_VARIABILITY away 
-        # from mean weight, and day has not changed, re-zero the load cell
-        if dt.datetime.now().day == current_day:
-            print("Zeroing scale.")
-            scale.tare(1, False)
-            file.write('Scale zeroed. Mean weight = ' 
-                       + str(round(mean_weight, 2)) + '\n')
-            return None 
-        
-        # If it is past midnight on a new day and there is no mouse in the 
-        # chamber, trigger an automatic reboot of the system.
+            remaining = (self.last_tare_ns + int(RETARE_INTERVAL * 1e9) -
+                         clock.monotonic_ns())
+            if remaining > 0:
+                return remaining / 1e9
+            self.start_tare()
+        for timestamp, weight in self.read_weights(self.tare_scheduler):
+            self.tare_window.add(weight)
+            if (self.tare_window.full() and
+                self.tare_window.max_deviation() <= RETARE_VARIABILITY):
+                self.zero_scale()
+                return self._retare()
+        return self.tare_scheduler.time_until_next()
+
+    def record_weight(self, timestamp, weight):
+        """Stores a weight sample and counts it in the weight histogram,
+        or, in 'plateaus' WEIGHT_LOG_MODE, stores and counts only the
+        samples in stable plateaus (see plateau.py).
+
+        Args:
+            timestamp is a datetime.datetime() object.
+            weight is a float containing the weight in grams.
+
+        Returns:
+            None.
+        """
+
+        samples, plateau = self.plateaus.add(timestamp, weight)
+        self.record_plateau(plateau)
+        if WEIGHT_LOG_MODE == 'raw':
+            samples = [(timestamp, weight)]
+        for timestamp, weight in samples:
+            self.storage.record_weight(self.mouse_name, self.day_count,
+                                       timestamp, weight)
+            self.weight_histogram.add(weight)
+        self.weight_counts[0] += 1
+        self.weight_counts[1] += len(samples)
+        return None
+
+    def record_plateau(self, plateau):
+        """Stores the summary of a weight plateau that has ended.
+
+        Args:
+            plateau is a plateau.Plateau() object, or None (nothing is
+            stored).
+
+        Returns:
+            None.
+        """
+
+        if plateau is None:
+            return None
+        self.storage.record_plateau(self.mouse_name, self.day_count,
+                                    plateau.start, plateau.end, plateau.n,
+                                    plateau.mean(), plateau.std())
+        self.weight_counts[2] += 1
+        return None
+
+    def start_weighing(self):
+        """Starts the weight schedule (and the scale stream, in 'stream'
+        mode)."""
+
+        self.weigh_scheduler.start()
+        if self.scale_stream is not None:
+            self.scale_stream.start()
+        return None
+
+    def stop_weighing(self):
+        """Stops the scale stream, if there is one."""
+
+        if self.scale_stream is not None:
+            self.scale_stream.stop()
+        return None
+
+    def read_weights(self, scheduler):
+        """Takes the weight samples that scheduler says are due: one reading
+        in 'single' mode, or the decimated batch of readings since the last
+        call in 'stream' mode.
+
+        Args:
+            scheduler is the timing.RateScheduler() for the samples.
+
+        Returns:
+            A list of (datetime.datetime(), weight in grams) tuples.
+        """
+
+        if not scheduler.due():
+            return []
+        jitter = scheduler.tick()
+        loop = 'visit' if scheduler is self.weigh_scheduler else 'tare'
+        self.metrics['weigh_jitter', loop].observe(jitter)
+        if scheduler.period is not None:
+            self.metrics['weigh_period', loop].observe(scheduler.period)
+        if self.scale_stream is None:
+            weight = self.scale.weighOnce()
+            return [(clock.now(), weight)]
+        times, weights = self.scale_stream.samples()
+        now = clock.now()
+        now_ns = clock.monotonic_ns()
+        return [(now - dt.timedelta(microseconds=(now_ns - time) // 1000),
+                 weight)
+                for time, weight in zip(times.tolist(), weights.tolist())]
+
+    @tracing.traced
+    def update_mouse_variables(self, rfid_tag):
+        """Takes an RFID tag and sets the chamber's mouse variables to those
+        corresponding with the detected mouse.
+
+        Args:
+            rfid_tag is string containing the RFID.
+
+        Returns:
+            None.
+
+        Raises:
+            ValueError: rfid_tag not found in mice.cfg.
+        """
+
+        try:
+            mouse = self.mice[rfid_tag]
+        except KeyError:
+            raise ValueError("Mouse name not found in mice.cfg (ID = %s)."
+                             %(str(rfid_tag)))
+
+        log.info("%s detected (ID = %s)!", mouse.name, str(rfid_tag),
+                 extra={'chamber': self.name, 'mouse': mouse.name,
+                        'event': '00'})
+
+        # Mice are normally rolled over by rollover() once the chamber is
+        # empty after midnight, this only catches a mouse that enters first
+        if clock.now().day != mouse.mouse_day:
+            self.roll_over_mouse(mouse)
+
+        self.mouse_tag = mouse.tag
+        self.mouse_name = mouse.name
+        if mouse.treatment == 'DRUG':
+            self.b_mouse_treatment = True
+        self.mouse_day = mouse.mouse_day
+        self.day_count = mouse.day_count
+        self.drug_drops = mouse.drug_drops
+        self.water_drops = mouse.water_drops
+        self.required_drug_drops = mouse.required_drug_drops
+        self.current_weight = mouse.weight
+        self.weight_histogram = self.get_weight_histogram()
+        return None
+
+    def roll_over_mouse(self, mouse):
+        """Ends the day for one mouse: records a summary of the day (with
+        its average weight), resets the daily drop counts and works out the
+        next day's required drug drops, in the registry.
+
+        Args:
+            mouse is the mouse_registry.MouseRecord() of the mouse, which
+            must not be in the chamber.
+
+        Returns:
+            None.
+        """
+
+        # All non-mouse RFIDs used for testing/troubleshooting should have
+        # the string 'TEST' in their name
+        if 'TEST' in mouse.name:
+            self.mice.update(mouse.tag, mouse_day=clock.now().day)
+            return None
+
+        n_weights, average_weight = self.get_average_weight(mouse)
+        weight = mouse.weight if average_weight is None else average_weight
+        log.info("Rollover: average weight on Day %i for %s was %s grams "
+                 "(mode calculated from %i weight measurements).",
+                 mouse.day_count, mouse.name, str(weight), n_weights,
+                 extra={'chamber': self.name, 'mouse': mouse.name,
+                        'event': None})
+        self.record_summary(mouse, weight)
+        fields = {'mouse_day': clock.now().day,
+                  'day_count': mouse.day_count + 1, 'water_drops': 0,
+                  'weight': weight}
+        if mouse.treatment == 'DRUG':
+            fields['drug_drops'] = 0
+            fields['required_drug_drops'] = int(round(
+                weight*DRUG_DROPS_PER_GRAM))
+        self.mice.update(mouse.tag, **fields)
+        self.storage.save_mouse(mouse)
+        return None
+
+    def rollover(self):
+        """Rolls over every mouse that has not been rolled over today (see
+        roll_over_mouse()) and saves mice.cfg once. Run from the IDLE state,
+        so the first entry of the day costs no more than any other.
+
+        Args:
+            None.
+
+        Returns:
+            None.
+        """
+
+        start = clock.monotonic_ns()
+        today = clock.now().day
+        n_mice = 0
+        for mouse in self.mice:
+            if mouse.mouse_day != today:
+                self.roll_over_mouse(mouse)
+                n_mice += 1
+        self.mice.save()
+        if n_mice:
+            self.storage.flush()
+        self.rollover_day = today
+        duration = (clock.monotonic_ns() - start) / 1e9
+        self.metrics['rollover'].observe(duration)
+        if n_mice:
+            log.info("Rolled over %i mice in %.1f ms.", n_mice,
+                     duration * 1000, extra=self.log_extra())
+        return None
+
+    @tracing.traced
+    def save_mouse_variables(self):
+        """Writes mouse variables to the registry and saves any changes to
+        mice.cfg.
+
+        Args:
+            None.
+
+        Returns:
+            None.
+        """
+
+        self.mice.update(self.mouse_tag, mouse_day=self.mouse_day,
+                         day_count=self.day_count, drug_drops=self.drug_drops,
+                         water_drops=self.water_drops,
+                         required_drug_drops=self.required_drug_drops,
+                         weight=self.current_weight)
+        self.mice.save()
+        self.storage.save_mouse(self.mice[self.mouse_tag])
+        self.storage.save_histogram(self.mouse_name, self.day_count,
+                                    self.weight_histogram)
+        return None
+
+    @tracing.traced
+    def record_event(self, timestamp, event):
+        """Records event information to data file for current mouse.
+
+        Event Codes:
+            00: Mouse entered
+            99: Mouse exited
+            01: Mouse licked spout
+            02: Mouse received water drop
+            03: Mouse received drug solution drop
+
+        Args:
+            timestamp is a datetime.datetime() object
+            event is a string containing the event code
+
+        Returns:
+            None.
+        """
+
+        self.storage.record_event(self.mouse_name, timestamp, event)
+        return None
+
+    def read_tag(self):
+        """Reads the RFID tag in range (timing the read).
+
+        Returns:
+            The tag as read by the tag reader (0 if none was read).
+        """
+
+        start = clock.monotonic_ns()
+        tag = self.tag_reader.readTag()
+        self.metrics['rfid_read'].observe((clock.monotonic_ns() - start)
+                                          / 1e9)
+        return tag
+
+    def record_summary(self, mouse, weight):
+        """Records a summary of the previous day for a mouse.
+
+        Args:
+            mouse is the mouse_registry.MouseRecord() of the mouse.
+            weight is a float containing its average weight for the day.
+
+        Returns:
+            None.
+        """
+
+        self.storage.record_summary(mouse.name, mouse.day_count,
+                                    mouse.water_drops, mouse.drug_drops,
+                                    mouse.required_drug_drops, weight)
+        return None
+
+    def get_weight_histogram(self):
+        """Gets the weight histogram for the current mouse and day, which is
+        kept in memory after the first visit of the day.
+
+        A saved histogram is used if there is one and the day's weight log
+        has not changed since it was saved, otherwise the histogram is built
+        from the weights in the log (e.g. if the program crashed during a
+        visit, after the histogram was last saved).
+
+        Args:
+            None.
+
+        Returns:
+            A WeightHistogram() object.
+        """
+
+        return self.load_weight_histogram(self.mouse_tag, self.mouse_name,
+                                          self.day_count)
+
+    def load_weight_histogram(self, tag, name, day_count):
+        """Gets the weight histogram for any mouse and day (see
+        get_weight_histogram()).
+
+        Args:
+            tag is a string containing the RFID of the mouse.
+            name is a string containing the name of the mouse.
+            day_count is an int giving the mouse's day in the cage.
+
+        Returns:
+            A WeightHistogram() object.
+        """
+
+        day, histogram = self.weight_histograms.get(tag, (None, None))
+        if day != day_count:
+            histogram = self.storage.load_histogram(name, day_count,
+                                                    LOWER_WEIGHT, UPPER_WEIGHT)
+            if histogram is None:
+                histogram = WeightHistogram(LOWER_WEIGHT, UPPER_WEIGHT)
+                try:
+                    histogram.add_many(self.storage.read_weights(name,
+                                                                 day_count))
+                except IOError:
+                    pass
+            self.weight_histograms[tag] = (day_count, histogram)
+        return histogram
+
+    @tracing.traced
+    def get_average_weight(self, mouse):
+        """Calculates average weight for the previous day by taking all
+        weight measurements, rounding to 0.1g and taking the mode of these
+        values.
+
+        The rounded measurements are counted in the weight histogram as they
+        are taken, so this only has to find the most common one.
+
+        Args:
+            mouse is the mouse_registry.MouseRecord() of the mouse.
+
+        Returns:
+            The number of weight recordings used to calculate the average
+            weight (as an int), and the average weight (as a float, or None
+            if there were no weight recordings).
+        """
+
+        return self.load_weight_histogram(mouse.tag, mouse.name,
+                                          mouse.day_count).mode()
+
+    def dispense_water(self, drug, lick_ns=None):
+        """Queues either a water drop (from solenoid) or a drug solution drop
+        (from syringe pump) with the actuator worker, without waiting for it
+        to be delivered.
+
+        Args:
+            drug is a boolean variable which is True if the mouse should
+            receive a drug drop, or False otherwise.
+            lick_ns is the monotonic time (ns) of the lick the drop is for,
+            to measure the time from lick to drop.
+
+        Returns:
+            None.
+        """
+
+        kind = ActuatorWorker.DRUG if drug else ActuatorWorker.WATER
+        self.actuator.submit(kind, lick_ns, self.mouse_tag,
+                             self.log_extra('03' if drug else '02'))
+        self.metrics['drops', kind].inc()
+        return None
+
+    def drop_delivered(self, command):
+        """Called by the actuator worker when a drop has been delivered, or
+        has failed (the worker has already logged why).
+
+        Args:
+            command is the ActuatorCommand() object for the drop.
+
+        Returns:
+            None.
+        """
+
+        if command.error is not None:
+            self.metrics['drop_failures', command.kind].inc()
+            return None
+        drop_log.info("%s drop delivered (queued %s, started %s, finished "
+                      "%s).", command.kind.capitalize(), str(command.queued),
+                      str(command.started), str(command.finished),
+                      extra=self.log_extra())
+        self.metrics['lick_to_valve', command.kind].observe(
+            command.latency_ms() / 1000)
+        if command.timing is not None:
+            drop_log.info("%i steps in %.1f ms (requested %.1f ms, mean error "
+                          "%.1f us, max error %.1f us).",
+                          command.timing['steps'], command.timing['actual_ms'],
+                          command.timing['requested_ms'],
+                          command.timing['mean_error_us'],
+                          command.timing['max_error_us'],
+                          extra=self.log_extra())
+        return None
+
+    def start_tare(self):
+        """Starts sampling the empty load cell to re-tare it (see
+        zero_scale()). Sampling goes on in the background of the IDLE state
+        until the readings are stable or an RFID comes into range.
+
+        Returns:
+            None.
+        """
+
+        self.tare_window.clear()
+        self.tare_scheduler.start()
+        if self.scale_stream is not None:
+            self.scale_stream.start()
+        self.b_retare_pending = True
+        return None
+
+    def abort_tare(self):
+        """Stops a re-tare because an RFID has come into range.
+
+        Returns:
+            None.
+        """
+
+        self.b_retare_pending = False
+        self.stop_weighing()
+        if len(self.tare_window) > 0:
+            scale_log.info("Scale not zeroed, tare aborted (mouse in "
+                           "range).", extra=self.log_extra())
+            self.log_tare("Scale not zeroed, tare aborted (mouse in range) "
+                          "after %i samples. Mean weight = %s, SD = %s"
+                          % (len(self.tare_window),
+                             round(self.tare_window.mean(), 2),
+                             round(self.tare_window.std(), 3)))
+        self.tare_window.clear()
+        self.last_tare_ns = clock.monotonic_ns()
+        return None
+
+    def log_tare(self, message):
+        """Appends a timestamped line to the chamber's tare log.
+
+        Args:
+            message is a string describing the re-tare.
+
+        Returns:
+            None.
+        """
+
+        with open(self.tare_log, 'a') as file:
+            file.write("%s %s\n" % (str(clock.now()), message))
+        return None
+
+    @tracing.traced
+    def zero_scale(self):
+        """Re-tares the load cell, once the last RETARE_WEIGH_ATTEMPTS
+        readings are all within RETARE_VARIABILITY of their mean.
+
+        Will instead trigger a reboot if it is a new day and DAILY_REBOOT
+        is on.
+
+        Args:
+            None.
+
+        Returns:
+            None.
+        """
+
+        global b_reboot_pi
+
+        start = clock.monotonic_ns()
+        mean_weight = round(self.tare_window.mean(), 2)
+        sd_weight = round(self.tare_window.std(), 3)
+        self.b_retare_pending = False
+        self.stop_weighing()
+        self.tare_window.clear()
+        self.last_tare_ns = clock.monotonic_ns()
+
+        # If the day has not changed (or DAILY_REBOOT is off), re-zero the
+        # load cell
+        if clock.now().day == current_day or not DAILY_REBOOT:
+            scale_log.info("Zeroing scale.", extra=self.log_extra())
+            self.scale.tare(1, False)
+            self.log_tare("Scale zeroed. Mean weight = %s, SD = %s"
+                          % (mean_weight, sd_weight))
+            self.metrics['zero_scale'].observe(
+                (clock.monotonic_ns() - start) / 1e9)
+
+        # If it is past midnight on a new day and there is no mouse in the
+        # chamber, trigger an automatic reboot of the system (once every
+        # chamber is empty).
         else:
-            print("New day in the cage. Triggering automatic reboot of the "
-                  "system (%s)." %(str(dt.datetime.now())))
-            file.write("New day in the cage and low scale variability. "
-                       "Automatic reboot triggered.\n")
+            log.info("New day in the cage. Triggering automatic reboot of "
+                     "the system.", extra=self.log_extra())
+            self.log_tare("New day in the cage and low scale variability. "
+                          "Automatic reboot triggered.")
             b_reboot_pi = True
+        return None
 
- 
-def dispense_water_callback(cap):
-    """Callback routine that is triggered every time a rising edge is detected
-    on the capacative sensor input.
-    
-    Triggers delivery of a drugged or regular water drop based on the 
-    specified drug timing and daily dose.
-    
-    Args:
-        cap is a adafruit_mpr121.MPR121() object representing the capacitive
-        sensor.
-        
-    Returns:
-        None.
-    """
+    @tracing.traced
+    def dispense_water_callback(self):
+        """Called by cap_callback() every time the mouse in the chamber
+        touches the spout.
 
-    global water_timer, drug_drops, water_drops
-
-    # Read off touch and record data
-    cap.touched()
-    record_event(dt.datetime.now(), '01')
-    print("Lick detected (%s)." % (str(dt.datetime.now())))
-    
-    # If enough time has passed since last water drop delivery, deliver drop
-    if time_ms() - water_timer >= WATER_TIMEOUT:
-        water_timer = time_ms()
-        timestamp = dt.datetime.now()
-       
-        # Dispense water or drug drops
-        if (b_mouse_treatment and drug_drops < required_drug_drops and 
-            (drug_drops + water_drops) % DRUG_DROP_FREQUENCY == 0):
-            print("Dispensing drugged water drop.")
-            record_event(timestamp, '03')
-            drug_drops += 1
-            dispense_water(drug=True)
-            
+        Triggers delivery of a drugged or regular water drop based on the
+        specified drug timing and daily dose, and asks for a clip and/or a
+        picture if there is a camera.
+
+        Args:
+            None.
+
+        Returns:
+            None.
+        """
+
+        # Record data
+        lick_ns = clock.monotonic_ns()
+        self.record_event(clock.now(), '01')
+        self.metrics['licks'].inc()
+        lick_log.info("Lick detected.", extra=self.log_extra('01'))
+
+        # If enough time has passed since last water drop delivery, deliver
+        # drop
+        if time_ms() - self.water_timer >= WATER_TIMEOUT:
+            self.water_timer = time_ms()
+            timestamp = clock.now()
+
+            # Dispense water or drug drops
+            if (self.b_mouse_treatment and
+                self.drug_drops < self.required_drug_drops and
+                (self.drug_drops + self.water_drops)
+                % DRUG_DROP_FREQUENCY == 0):
+                lick_log.info("Dispensing drugged water drop.",
+                              extra=self.log_extra('03'))
+                self.record_event(timestamp, '03')
+                self.drug_drops += 1
+                self.dispense_water(drug=True, lick_ns=lick_ns)
+                self.mice.add(self.mouse_tag, 'drug_drops',
+                              defer=self.storage.call)
+
+            else:
+                lick_log.info("Dispensing regular water drop.",
+                              extra=self.log_extra('02'))
+                self.record_event(timestamp, '02')
+                self.water_drops += 1
+                self.dispense_water(drug=False, lick_ns=lick_ns)
+                self.mice.add(self.mouse_tag, 'water_drops',
+                              defer=self.storage.call)
+
+            # Save a clip and take a picture of the drop. Both are only
+            # requested here, and saved later on other threads.
+            date = timestamp.strftime('%m-%d-%Y-%H%M%S-%f')[:-3]
+            if self.clips is not None:
+                self.clips.request('%s/%s/Videos/%s_%s.h264'
+                                   % (self.data_dir, self.mouse_name,
+                                      self.mouse_name, date))
+            if self.stills is not None:
+                self.stills.request('%s/%s/Pictures/%s_%s.jpg'
+                                    % (self.data_dir, self.mouse_name,
+                                       self.mouse_name, date))
         else:
-            print("Dispensing regular water drop.")
-            record_event(timestamp, '02')
-            water_drops += 1
-            dispense_water(drug=False)
-    else:
-        print("Insufficient time has passed since last drop.")
-        
-    return None
+            lick_log.info("Insufficient time has passed since last drop.",
+                          extra=self.log_extra('01'))
+
+        return None
+
+
+def main(hw=None, use_camera=False):
+    """Initializes and runs the PiDose system, with one Chamber() for each
+    entry in CHAMBERS.
 
-            
-def main():
-    """Initializes and runs the PiDose system.
-    
     Args:
-        None.
-        
+        hw is a hardware.Hardware() object holding the device backends to use
+        (defaults to the real devices, hardware.PiHardware()).
+        use_camera is a boolean which is True if a clip should be saved
+        (see CAMERA_CLIPS) and/or a picture taken (see CAMERA_STILLS) on
+        every drop. There is one camera, which is used by the first chamber.
+
     Returns:
         None.
     """
-    
-    global b_mouse_treatment, b_reboot_pi
+
+    global GPIO, clock, cap, cap_touched, chambers, current_day
+
+    if hw is None:
+        hw = PiHardware()
+    GPIO = hw.gpio
+    clock = hw.clock
+    current_day = clock.now().day
+    check_chambers(CHAMBERS)
+    chambers = [Chamber(config, j) for j, config in enumerate(CHAMBERS)]
+
+    # Logging Setup. Log calls only queue the record, a listener thread
+    # writes them to LOG_FILE.
+    log_session = diagnostics.setup(LOG_FILE, clock, LOG_MAX_BYTES,
+                                    LOG_BACKUP_COUNT, LOG_MAX_AGE,
+                                    LOG_QUEUE_SIZE, LOG_LEVELS,
+                                    LOG_CONSOLE_LEVEL)
+
+    # Metrics Setup. Served to whatever scrapes METRICS_ADDRESS, if set.
+    metrics_server = None
+    if METRICS_ADDRESS is not None:
+        metrics_server = MetricsServer(metrics_registry, METRICS_ADDRESS)
+
+    # Make SIGTERM exit through the cleanup below so queued records are saved
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+
+    # Tracing Setup. SIGUSR1 turns tracing on and saves the spans, SIGUSR2
+    # starts and stops the profiler.
+    if TRACE_ENABLED:
+        tracing.enable(TRACE_BUFFER_SIZE)
+    signal.signal(signal.SIGUSR1, trace_signal)
+    signal.signal(signal.SIGUSR2, profile_signal)
 
     # GPIO Setup
     GPIO.setmode(GPIO.BCM)
-    GPIO.setup(PIN_RFID_TIR, GPIO.IN)
     GPIO.setup(PIN_CAP_IRQ, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-    GPIO.setup(PIN_SCALE_DAT, GPIO.IN)
-    GPIO.setup(PIN_SOLENOID, GPIO.OUT)
-    if not REVERSE_SOLENOID:
-        GPIO.output(PIN_SOLENOID, False)
-    else:
-        GPIO.output(PIN_SOLENOID, True)
-    GPIO.setup(PIN_MOTOR_STEP, GPIO.OUT)
-    GPIO.output(PIN_MOTOR_STEP, False)
-    GPIO.setup(PIN_MOTOR_DIR, GPIO.OUT)
-    GPIO.output(PIN_MOTOR_DIR, False)
-    GPIO.setup(PIN_MOTOR_MS1, GPIO.OUT)
-    GPIO.output(PIN_MOTOR_MS1, True)
-    GPIO.setup(PIN_MOTOR_MS2, GPIO.OUT)
-    GPIO.output(PIN_MOTOR_MS2, True)
-    
+
     # Capacitive Sensor Setup
     try:
-        i2c = busio.I2C(board.SCL, board.SDA)
-        cap = adafruit_mpr121.MPR121(i2c)
-        cap[CAP_SPOUT_PIN].threshold = CAP_TOUCH_THRESHOLD
-        cap[CAP_SPOUT_PIN].release_threshold = CAP_RELEASE_THRESHOLD
+        cap = hw.cap_sensor()
+        cap_touched = cap.touched()
     except Exception as e:
         raise e("Failed to initialize MPR121, check your wiring!")
-    callback_func = lambda channel, c=cap: dispense_water_callback(c)
-    
-    # RFID Reader Setup
-    try:
-        tag_reader = TagReader(RFID_PORT, doChecksum=False, 
-                              timeOutSecs=RFID_TIMEOUT, kind=RFID_KIND)
-    except Exception as e:
-        raise e("Error making RFIDTagReader")
-    unknown_count = 0
-    
-    # Scale Setup
-    scale = Scale(PIN_SCALE_DAT, PIN_SCALE_CLK, SCALE_GRAMS_PER_UNIT, 1)
-    scale.weighOnce()
-    scale.tare(1, False)
-    
-    # Task Variables
-    b_mouse_entered = False
-    weigh_timer = time_ms()
-    
-    print("Done initializing.")
-    print("Waiting for mouse...")
-    
+
+    # Camera Setup
+    camera = None
+    stills = None
+    clips = None
+    if use_camera:
+        camera = hw.camera(CAMERA_RESOLUTION)
+        camera.vflip = CAMERA_VFLIP
+        camera.hflip = CAMERA_HFLIP
+        camera.rotation = CAMERA_ROTATION
+        camera.framerate = VIDEO_FRAMERATE
+        if CAMERA_CLIPS:
+            # Record continuously into memory, with a couple of seconds to
+            # spare so clips can start on a key frame
+            clips = ClipRecorder(camera,
+                                 hw.video_buffer(camera, CLIP_MAX_SECONDS + 2,
+                                                 VIDEO_BITRATE),
+                                 clock, CLIP_PRE_SECONDS, CLIP_POST_SECONDS,
+                                 CLIP_MAX_SECONDS, CLIP_QUEUE_SIZE,
+                                 hw.threaded, VIDEO_RESOLUTION, VIDEO_BITRATE)
+        if CAMERA_STILLS:
+            stills = StillCapture(camera, clock, STILL_QUEUE_SIZE,
+                                  STILL_BUFFERS, STILL_COALESCE_MS,
+                                  threaded=hw.threaded)
+
+    # Chamber Setup. Sleep until an RFID tag-in-range pin changes rather than
+    # polling them.
+    edge_loop = EdgeLoop(GPIO, RFID_CHECK_INTERVAL, clock)
     try:
+        for chamber in chambers:
+            if chamber is chambers[0]:
+                chamber.open(hw, stills, clips)
+            else:
+                chamber.open(hw)
+            edge_loop.watch_pin(chamber.pin_rfid_tir)
+        GPIO.add_event_detect(PIN_CAP_IRQ, GPIO.FALLING,
+                              callback=cap_callback)
+
+        log.info("Done initializing.")
+        log.info("Waiting for mouse...")
+
         while True:
-            
-            # Reboot the system in certain circumstances
-            if b_reboot_pi:
+
+            # Reboot the system in certain circumstances, once there are no
+            # mice in any of the chambers
+            if b_reboot_pi and all(chamber.is_idle() for chamber in chambers):
                 sys.exit()
-            
-            # Wait for an RFID to come into range and then attempt to load the 
-            # stats for that mouse
-            if GPIO.input(PIN_RFID_TIR):
-                if not b_mouse_entered:
-                    tag_id = tag_reader.readTag()
-                try:
-                    update_mouse_variables(tag_id)
-                except ValueError as e:
-                    print(e)
-                    print("Waiting for mouse to leave.")
-                    while GPIO.input(PIN_RFID_TIR):
-                        sleep(0.01)
-                    print("Mouse no longer in range.")
-                    
-                    # Sometimes, for whatever reason, the RFID reader stops 
-                    # working and will not successfully detect any of the mice. 
-                    # Following ensures that if an unknown mouse is detected
-                    # too many times, the cage will automatically restart.
-                    unknown_count += 1
-                    if unknown_count == RFID_UNKNOWN_REBOOT:
-                        print("Too many unkown tags detected, triggering "
-                              "reboot of the system (%s)." 
-                              %(str(dt.datetime.now())))
-                        b_reboot_pi = True
-                    continue
-                
-                # Record entrance and activate cap sensor
-                record_event(dt.datetime.now(), '00')
-                b_mouse_entered = True
-                cap.touched()
-                GPIO.add_event_detect(PIN_CAP_IRQ, GPIO.FALLING, 
-                                      callback=callback_func) 
-    
-                # Weigh animal until RFID goes out of range
-                with open('/home/pi/piDose/data/%s/Weights/'
-                          '%s_weights_day%d.txt' 
-                          % (mouse_name, mouse_name, day_count), 'a') as file:
-                    while True:
-                        if (time_ms() - weigh_timer >= 1000/WEIGH_FREQUENCY 
-                            and GPIO.input(PIN_RFID_TIR)):
-                            weigh_timer = time_ms()
-                            weight = scale.weighOnce()
-                            weight_line = (str(dt.datetime.now()) + '\t' + 
-                                           str(weight) + '\n')
-                            file.write(weight_line)
-                        
-                        # If RFID goes out of range, start grace period and
-                        # turn off cap sensor
-                        if not GPIO.input(PIN_RFID_TIR):
-                            grace_start = time_ms()
-                            time_last_detected = dt.datetime.now()
-                            GPIO.remove_event_detect(PIN_CAP_IRQ)
-                            print("%s no longer detected. Beginning grace "
-                                  "period... " % (mouse_name))
-                            
-                            # Wait for grace period to finish or for RFID to 
-                            # come back in range
-                            while (not GPIO.input(PIN_RFID_TIR) and time_ms() 
-                                       - grace_start < RFID_GRACE_PERIOD):
-                                sleep(0.01)
-                            new_id = tag_reader.readTag()
-                            
-                            # Following is True if new mouse detected, or no
-                            # RFID in range. Save data for previous mouse.
-                            if tag_id != new_id:
-                                save_mouse_variables()
-                                record_event(time_last_detected, '99')
-                                b_mouse_treatment = False
-                                if new_id != 0:
-                                    print("New mouse entered during grace "
-                                          "period. Identifying...")
-                                    tag_id = new_id
-                                else:
-                                    print("%s has exited the chamber (%s)." % 
-                                          (mouse_name, str(dt.datetime.now())))
-                                    b_mouse_entered = False
-                                    zero_scale(scale)
-                                break
-                            
-                            # Otherwise the same mouse is back in range.
-                            # Reactivate cap sensor.
-                            else:
-                                cap.touched()
-                                GPIO.add_event_detect(PIN_CAP_IRQ, 
-                                    GPIO.FALLING, callback=callback_func)
-                                print("%s has returned within grace period." 
-                                      % (mouse_name))
-            sleep(0.01)
+
+            # Run each chamber, then sleep until one of them has something
+            # due or an RFID tag-in-range pin changes
+            timeout = None
+            for chamber in chambers:
+                chamber_timeout = chamber.step()
+                if chamber_timeout is not None and (timeout is None or
+                                                    chamber_timeout < timeout):
+                    timeout = chamber_timeout
+            edge_loop.wait(timeout)
     except KeyboardInterrupt:
-        print("Keyboard interrupt detected...")
+        log.info("Keyboard interrupt detected...")
     finally:
-        if b_mouse_entered:
-            save_mouse_variables()
-            record_event(dt.datetime.now(), '99')
+        for chamber in chambers:
+            chamber.close()
+        edge_loop.close()
+        if stills is not None:
+            stills.close()
+        if clips is not None:
+            clips.close()
+        if camera is not None:
+            camera.close()
         GPIO.cleanup()
+        if metrics_server is not None:
+            metrics_server.close()
+        log_session.close()
         if b_reboot_pi:
-            os.system('sudo reboot')
+            hw.reboot()
 
 
 if __name__ == '__main__':
@@ -21,6 +21,11 @@ sudo make
 sudo make install
 cd ..
 
+echo "Installing pigpio (DMA-timed pulses for the syringe pump)"
+sudo apt-get install pigpio python3-pigpio
+sudo systemctl enable pigpiod
+sudo systemctl start pigpiod
+
 echo "Cloning GPIO_Thread and setting up HX711"
 git clone https://github.com/jamieboyd/GPIO_Thread.git
 cd GPIO_Thread
@@ -0,0 +1,140 @@
+"""Online detection of stable weight plateaus during a visit.
+
+While its RFID is in range a mouse is weighed several times a second, but
+many of those samples are taken while it steps on or off the platform,
+rears, or has only some paws on it. A plateau is a run of samples where
+the standard deviation of the last window samples stays at or below
+max_sd and their mean is within the weight limits (LOWER_WEIGHT and
+UPPER_WEIGHT). PlateauDetector finds them as the samples arrive, keeping
+the rolling mean and variance in a rolling_stats.RollingWindow, so each
+sample costs the same however long the visit.
+
+When a plateau starts, the samples in the window are returned as its first
+samples (leaving out any already returned in the plateau before it); after
+that each sample is returned as it arrives, until one makes
+the window unstable, which ends the plateau. A plateau's mean, standard
+deviation and number of samples are returned once it has ended.
+
+"""
+
+import math
+import collections
+from rolling_stats import RollingWindow
+
+
+class Plateau(object):
+    """A run of stable weight samples, with the times (datetime.datetime()
+    objects) of its first and last samples."""
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.n = 0
+        self._sum = 0.0
+        self._sum_squares = 0.0
+
+    def add(self, timestamp, weight):
+        self.end = timestamp
+        self.n += 1
+        self._sum += weight
+        self._sum_squares += weight * weight
+        return None
+
+    def mean(self):
+        return self._sum / self.n
+
+    def std(self):
+        """Population standard deviation of the samples."""
+
+        mean = self.mean()
+        return math.sqrt(max(self._sum_squares / self.n - mean * mean, 0.0))
+
+
+class PlateauDetector(object):
+    """Splits a stream of weight samples into stable plateaus."""
+
+    def __init__(self, window, max_sd, lower, upper):
+        """Args:
+            window is the number of samples the standard deviation is taken
+            over (an int, at least 2).
+            max_sd is the largest standard deviation in grams of a stable
+            window.
+            lower and upper are the lowest and highest window means in grams
+            of a plateau.
+
+        Raises:
+            ValueError: window is less than 2.
+        """
+
+        if window < 2:
+            raise ValueError("Plateau window must be at least 2 samples, got "
+                             "%s." % (window))
+        self.max_sd = max_sd
+        self.lower = lower
+        self.upper = upper
+        self._window = RollingWindow(window)
+        self._recent = collections.deque(maxlen=window)
+        # Number of the last sample returned, so a plateau starting right
+        # after another does not return its samples again (sample times can
+        # go back if the clock is set back)
+        self._n_added = 0
+        self._last_returned = 0
+        self.plateau = None
+
+    def _stable(self):
+        window = self._window
+        return (window.full() and window.std() <= self.max_sd and
+                self.lower <= window.mean() <= self.upper)
+
+    def add(self, timestamp, weight):
+        """Adds a weight sample.
+
+        Args:
+            timestamp is a datetime.datetime() object.
+            weight is a float containing the weight in grams.
+
+        Returns:
+            A list of the (timestamp, weight) samples now known to be in a
+            plateau (empty unless one is going on), and the Plateau() that
+            this sample ended, or None.
+        """
+
+        self._n_added += 1
+        self._window.add(weight)
+        self._recent.append((self._n_added, timestamp, weight))
+        if not self._stable():
+            return [], self.end()
+        samples = [(sample_time, grams) for n, sample_time, grams
+                   in self._recent if n > self._last_returned]
+        if not samples:
+            return [], None
+        if self.plateau is None:
+            self.plateau = Plateau(samples[0][0])
+        for sample in samples:
+            self.plateau.add(*sample)
+        self._last_returned = self._n_added
+        return samples, None
+
+    def end(self):
+        """Ends the current plateau, if there is one (e.g. when the mouse
+        leaves).
+
+        Returns:
+            The Plateau() that was ended, or None.
+        """
+
+        plateau = self.plateau
+        self.plateau = None
+        return plateau
+
+    def reset(self):
+        """Forgets the recent samples and ends the current plateau.
+
+        Returns:
+            The Plateau() that was ended, or None.
+        """
+
+        self._window.clear()
+        self._recent.clear()
+        self._last_returned = self._n_added
+        return self.end()
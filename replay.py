@@ -0,0 +1,346 @@
+"""Replays recorded cage logs through the PiDose control logic.
+
+The visits in a cage's data folder are rebuilt from each mouse's
+<mouse>_data.txt (entries '00', exits '99' and licks '01') and weight logs
+(<mouse>_weights_day<N>.txt or .bin), and played on a simulated cage (see
+simulator.py): the RFID pin goes high and low at the recorded entry and exit
+times, the cap sensor fires at each recorded lick and the scale returns the
+recorded weight samples. The unmodified main loop of piDose.py then makes
+its own drop decisions (through update_mouse_variables(),
+dispense_water_callback() and the rollover and reboot logic) on a virtual
+clock, as fast as the CPU allows.
+
+The decision made for each lick is compared with the recorded one, so a
+change to piDose.py can be checked (and profiled) against real workloads
+before it is deployed:
+
+    python3 replay.py /home/pi/piDose/data /home/pi/piDose/mice.cfg
+
+mice.cfg should hold the state of the mice at the start of the logs (e.g. a
+backup taken when the cohort was set up), or use --reset to start every
+mouse from zero. A mouse leaving and returning within the grace period is
+not in the logs, so in the replay it stays in the chamber throughout.
+
+"""
+
+import os
+import sys
+import glob
+import bisect
+import shutil
+import argparse
+import tempfile
+import datetime as dt
+from time import perf_counter
+import weight_log
+import simulator
+from mouse_registry import MouseRegistry
+
+
+def parse_timestamp(text):
+    """Parses a timestamp written by str(datetime.datetime())."""
+
+    return dt.datetime.fromisoformat(text)
+
+
+def read_events(path):
+    """Reads a <mouse>_data.txt event log.
+
+    Args:
+        path is a string containing the location of the log.
+
+    Returns:
+        A list of (datetime.datetime(), event code) tuples in file order.
+        Lines that cannot be parsed are skipped.
+    """
+
+    events = []
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.rstrip('\n').split('\t')
+            if len(line) < 2:
+                continue
+            try:
+                events.append((parse_timestamp(line[0]), line[1]))
+            except ValueError:
+                continue
+    return events
+
+
+def read_weight_samples(weights_dir, mouse_name):
+    """Reads every weight sample logged for a mouse, text or binary.
+
+    Args:
+        weights_dir is a string containing the mouse's Weights folder.
+        mouse_name is a string containing the name of the mouse.
+
+    Returns:
+        A list of (datetime.datetime(), grams) tuples sorted by time.
+    """
+
+    samples = []
+    pattern = os.path.join(weights_dir, '%s_weights_day*' % (mouse_name))
+    for path in glob.glob(pattern):
+        if path.endswith('.bin'):
+            times = weight_log.read_times(path)
+            weights = weight_log.read_weights(path)
+            samples.extend((weight_log.from_epoch_ms(int(ms)), float(weight))
+                           for ms, weight in zip(times, weights))
+        elif path.endswith('.txt'):
+            for timestamp, weight in read_events(path):
+                try:
+                    samples.append((timestamp, float(weight)))
+                except ValueError:
+                    continue
+    samples.sort()
+    return samples
+
+
+def lick_decisions(events):
+    """Pairs each lick with the drop it triggered.
+
+    Args:
+        events is a list of (timestamp, event code) tuples from read_events().
+
+    Returns:
+        A list of (timestamp of the lick, code) tuples, where code is '02'
+        (water), '03' (drug) or None (no drop).
+    """
+
+    decisions = []
+    for timestamp, event in events:
+        if event == '01':
+            decisions.append([timestamp, None])
+        elif event in ('02', '03') and decisions and decisions[-1][1] is None:
+            decisions[-1][1] = event
+    return [tuple(decision) for decision in decisions]
+
+
+def load_visits(data_dir, mice, tag_read_time=0.01):
+    """Rebuilds the visits to the chamber from a cage's data folder.
+
+    A visit runs from an entry to the next exit of the same mouse. If the
+    exit is missing (e.g. a power cut), the visit ends at its last lick.
+    Visits that overlap the next one are cut short.
+
+    Args:
+        data_dir is a string containing the cage's data folder.
+        mice is a MouseRegistry of the mice in the cage.
+        tag_read_time is the time in seconds taken to read a tag. The mouse
+        arrives this long before its recorded entry.
+
+    Returns:
+        The start time (a datetime.datetime()) and a list of
+        simulator.Visit objects timed in seconds from it.
+    """
+
+    raw = []
+    for mouse in mice:
+        path = os.path.join(data_dir, mouse.name, mouse.name + '_data.txt')
+        if not os.path.exists(path):
+            continue
+        samples = read_weight_samples(
+            os.path.join(data_dir, mouse.name, 'Weights'), mouse.name)
+        visit = None
+        for timestamp, event in read_events(path) + [(None, '00')]:
+            if event == '00' and visit is not None:
+                end = visit[2] or max(visit[3] + [visit[1]])
+                raw.append((visit[1], end, mouse, visit[3], samples))
+                visit = None
+            if event == '00' and timestamp is not None:
+                visit = [mouse, timestamp, None, []]
+            elif visit is not None and event == '01':
+                visit[3].append(timestamp)
+            elif visit is not None and event == '99' and visit[2] is None:
+                visit[2] = timestamp
+    if not raw:
+        return None, []
+    raw.sort(key=lambda visit: visit[0])
+    start = raw[0][0] - dt.timedelta(seconds=60)
+
+    def seconds(timestamp):
+        return (timestamp - start).total_seconds()
+
+    visits = []
+    for j, (entry, end, mouse, licks, samples) in enumerate(raw):
+        end = max(end, entry)
+        if j + 1 < len(raw):
+            end = min(end, raw[j + 1][0] - dt.timedelta(seconds=0.1))
+        t0 = seconds(entry) - tag_read_time
+        t1 = max(seconds(end), t0 + tag_read_time)
+        first = bisect.bisect_left(samples, (entry,))
+        last = bisect.bisect_right(samples, (end, float('inf')))
+        trace = [(seconds(timestamp) - t0, weight)
+                 for timestamp, weight in samples[first:last]]
+        if trace:
+            weights = sorted(weight for t, weight in trace)
+            weight = weights[len(weights) // 2]
+        else:
+            weight = mouse.weight
+        visits.append(simulator.Visit(
+            int(mouse.tag), t0, t1 - t0, weight,
+            [seconds(lick) - t0 for lick in licks], trace))
+    return start, visits
+
+
+def compare_decisions(recorded, replayed, tolerance=0.001):
+    """Matches up the licks of a recording and a replay of it.
+
+    Args:
+        recorded and replayed are lists from lick_decisions().
+        tolerance is how far apart (in seconds) the same lick can be.
+
+    Returns:
+        A list of (timestamp, recorded code, replayed code) tuples, one per
+        lick in either list. A lick missing from one list has the code '-'
+        there.
+    """
+
+    rows = []
+    j = k = 0
+    while j < len(recorded) or k < len(replayed):
+        if k == len(replayed):
+            rows.append((recorded[j][0], recorded[j][1], '-'))
+            j += 1
+        elif j == len(recorded):
+            rows.append((replayed[k][0], '-', replayed[k][1]))
+            k += 1
+        else:
+            difference = (replayed[k][0] - recorded[j][0]).total_seconds()
+            if abs(difference) <= tolerance:
+                rows.append((recorded[j][0], recorded[j][1], replayed[k][1]))
+                j += 1
+                k += 1
+            elif difference > 0:
+                rows.append((recorded[j][0], recorded[j][1], '-'))
+                j += 1
+            else:
+                rows.append((replayed[k][0], '-', replayed[k][1]))
+                k += 1
+    return rows
+
+
+def replay(data_dir, mice_config, root, reset=False, program='piDose',
+           **constants):
+    """Replays a cage's logs through PiDose on a simulated cage.
+
+    Args:
+        data_dir is a string containing the recorded data folder.
+        mice_config is a string containing the location of mice.cfg.
+        root is a string containing an empty (or new) directory for the
+        replay's mice.cfg and data.
+        reset is True to start every mouse from day zero with no drops.
+        program is the name of the module to run (piDose or piDose_camera).
+        constants are PiDose constants to override (e.g. WATER_TIMEOUT).
+
+    Returns:
+        A dict with 'visits', 'starts' (program starts), 'simulated_days',
+        'wall_seconds' and 'decisions' (from compare_decisions(), for all
+        mice, sorted by time).
+
+    Raises:
+        ValueError: root already holds a replay's mice.cfg or data, which
+        the new replay would add to.
+    """
+
+    if (os.path.exists(os.path.join(root, 'mice.cfg')) or
+            os.path.exists(os.path.join(root, 'data'))):
+        raise ValueError("%s already holds a replay, use an empty "
+                         "directory." % (root))
+    os.makedirs(os.path.join(root, 'data'))
+    shutil.copyfile(mice_config, os.path.join(root, 'mice.cfg'))
+    mice = MouseRegistry(os.path.join(root, 'mice.cfg'))
+    start, visits = load_visits(data_dir, mice)
+    for mouse in mice:
+        if reset:
+            mice.update(mouse.tag, mouse_day=0, day_count=0, drug_drops=0,
+                        water_drops=0, required_drug_drops=0)
+        os.makedirs(os.path.join(root, 'data', mouse.name, 'Weights'),
+                    exist_ok=True)
+        os.makedirs(os.path.join(root, 'data', mouse.name, 'Pictures'),
+                    exist_ok=True)
+    mice.save()
+
+    constants.setdefault('STORAGE_BACKEND', 'text')
+    hardware = simulator.SimHardware(visits, start)
+    wall_start = perf_counter()
+    starts = simulator.run(hardware, root, program, **constants)
+    wall = perf_counter() - wall_start
+
+    decisions = []
+    for mouse in mice:
+        recorded = os.path.join(data_dir, mouse.name,
+                                mouse.name + '_data.txt')
+        replayed = os.path.join(root, 'data', mouse.name,
+                                mouse.name + '_data.txt')
+        if not os.path.exists(recorded):
+            continue
+        replayed = (read_events(replayed) if os.path.exists(replayed)
+                    else [])
+        for row in compare_decisions(lick_decisions(read_events(recorded)),
+                                     lick_decisions(replayed)):
+            decisions.append((row[0], mouse.name) + row[1:])
+    decisions.sort(key=lambda decision: (decision[0], decision[1]))
+    return {'visits': len(visits), 'starts': starts,
+            'simulated_days': hardware.clock.seconds() / 86400,
+            'wall_seconds': wall, 'decisions': decisions}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded PiDose "
+                                     "logs on a simulated cage.")
+    parser.add_argument('data_dir', help="recorded data folder")
+    parser.add_argument('mice_config', help="mice.cfg at the start of the "
+                        "logs")
+    parser.add_argument('--reset', action='store_true',
+                        help="start every mouse from day zero with no "
+                        "drops (weights are kept)")
+    parser.add_argument('--camera', action='store_true',
+                        help="run piDose_camera.py instead of piDose.py")
+    parser.add_argument('--dir', default=None,
+                        help="empty or new directory for the replay's "
+                        "mice.cfg, data, log and decisions (defaults to a "
+                        "new temporary directory)")
+    args = parser.parse_args()
+
+    root = args.dir or tempfile.mkdtemp(prefix='pidose_replay_')
+    if os.path.isdir(root) and os.listdir(root):
+        sys.exit("%s is not empty, use an empty directory for the replay."
+                 % (root))
+    stdout = sys.stdout
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'log.txt'), 'w') as log:
+        sys.stdout = log
+        try:
+            result = replay(args.data_dir, args.mice_config, root,
+                            args.reset, 'piDose_camera' if args.camera
+                            else 'piDose')
+        finally:
+            sys.stdout = stdout
+
+    # Codes: 02 water, 03 drug, None no drop, - lick missing
+    counts = {'recorded': {}, 'replayed': {}}
+    n_same = 0
+    with open(os.path.join(root, 'decisions.txt'), 'w') as file:
+        file.write('Timestamp\tMouse\tRecorded\tReplayed\n')
+        for timestamp, name, recorded, replayed in result['decisions']:
+            file.write('%s\t%s\t%s\t%s\n' % (timestamp, name, recorded,
+                                             replayed))
+            counts['recorded'][recorded] = (
+                counts['recorded'].get(recorded, 0) + 1)
+            counts['replayed'][replayed] = (
+                counts['replayed'].get(replayed, 0) + 1)
+            n_same += recorded == replayed
+    n_licks = len(result['decisions'])
+    print("Replayed %.2f days (%i visits, %i program starts) in %.1f s, "
+          "%.1f simulated days per second."
+          % (result['simulated_days'], result['visits'], result['starts'],
+             result['wall_seconds'],
+             result['simulated_days'] / result['wall_seconds']))
+    for source in ('recorded', 'replayed'):
+        print("%s: %i water drops, %i drug drops, %i licks without a drop."
+              % (source.capitalize(), counts[source].get('02', 0),
+                 counts[source].get('03', 0), counts[source].get(None, 0)))
+    print("%i of %i licks (%.1f%%) got the same decision. Per-lick decisions "
+          "in %s." % (n_same, n_licks, 100.0 * n_same / max(n_licks, 1),
+                      os.path.join(root, 'decisions.txt')))
@@ -0,0 +1,382 @@
+"""Cohort report over a PiDose data folder.
+
+Every mouse folder in the data folder is scanned (its <mouse>_data.txt
+events, <mouse>_summary.txt and daily weight logs, text or binary), and one
+table is written with a row for each mouse and date:
+
+    Mouse  Date  Day  Entries  Licks  Water Drops  Drug Drops
+    Required Drug Drops  Dose (%)  Weight Samples  Weight
+
+Dose is the drug drops given as a percentage of the required drug drops,
+and Weight is the mode of the day's weight samples (rounded to 0.1g,
+between LOWER_WEIGHT and UPPER_WEIGHT), as worked out at rollover. Required
+drug drops come from the summary file, so they are blank for today.
+
+Files are parsed with numpy (the dates and event codes of a whole event
+file are read straight out of its bytes), one file per task in a pool of
+processes. The result for each file is cached (in report_cache.json in the
+data folder) with the file's size and modification time, so a rerun only
+reads files that have changed. Event files and text weight logs are only
+ever appended to, so for those only the lines added since the last run are
+read (after checking that the bytes before them are the ones read last
+time).
+
+Only the 'text' storage backend is read (the 'sqlite' backend can be
+queried directly).
+
+    python3 report.py /home/pi/piDose/data
+
+"""
+
+import os
+import re
+import json
+import zlib
+import argparse
+import datetime as dt
+import concurrent.futures
+from time import perf_counter
+import numpy as np
+import weight_log
+from weight_histogram import WeightHistogram
+
+CACHE_VERSION = 1
+EVENTS = ('00', '01', '02', '03')
+TAIL_BYTES = 4096
+WEIGHTS_FILE = re.compile(r'_weights_day(\d+)\.(txt|bin)$')
+
+
+def tail_crc(path, offset):
+    """CRC-32 of the TAIL_BYTES bytes of a file before offset."""
+
+    with open(path, 'rb') as file:
+        file.seek(max(offset - TAIL_BYTES, 0))
+        return zlib.crc32(file.read(min(offset, TAIL_BYTES)))
+
+
+def read_lines(path, start):
+    """Reads the complete lines of a file from byte start.
+
+    Returns:
+        The bytes of the lines, and the offset after the last complete line.
+    """
+
+    with open(path, 'rb') as file:
+        file.seek(start)
+        data = file.read()
+    end = data.rfind(b'\n') + 1
+    return data[:end], start + end
+
+
+def parse_events(data):
+    """Counts the events in lines of a <mouse>_data.txt file by date.
+
+    Every line is 'YYYY-MM-DD HH:MM:SS[.ffffff]<tab>event code', so the date
+    and code are at fixed offsets from the start and end of the line and
+    are read straight out of the bytes for all lines at once. Lines that do
+    not fit are skipped.
+
+    Args:
+        data is the bytes of complete lines.
+
+    Returns:
+        A dict of date strings ('YYYY-MM-DD') and lists of the number of
+        entries, licks, water drops and drug drops on that date.
+    """
+
+    counts = {}
+    if not data:
+        return counts
+    chars = np.frombuffer(data, np.uint8)
+    ends = np.flatnonzero(chars == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    valid = ((ends - starts >= 13) &
+             (chars[np.maximum(ends - 3, 0)] == ord('\t')) &
+             (chars[np.minimum(starts + 4, len(chars) - 1)] == ord('-')) &
+             (chars[np.minimum(starts + 7, len(chars) - 1)] == ord('-')))
+    starts = starts[valid]
+    ends = ends[valid]
+
+    def digits(offsets):
+        value = np.zeros(len(offsets[0]), np.int64)
+        for offset in offsets:
+            value = value * 10 + chars[offset] - ord('0')
+        return value
+
+    dates = digits([starts + j for j in (0, 1, 2, 3, 5, 6, 8, 9)])
+    codes = digits([ends - 2, ends - 1])
+    keys, n = np.unique(dates * 100 + codes, return_counts=True)
+    for key, count in zip(keys.tolist(), n.tolist()):
+        code = '%02i' % (key % 100)
+        if code in EVENTS:
+            date = '%04i-%02i-%02i' % (key // 1000000, key // 10000 % 100,
+                                      key // 100 % 100)
+            counts.setdefault(date, [0] * len(EVENTS))[
+                EVENTS.index(code)] += count
+    return counts
+
+
+def parse_weights(data):
+    """Takes the weights and the date of the first sample from lines of a
+    text weight log.
+
+    Args:
+        data is the bytes of complete 'timestamp<tab>weight' lines.
+
+    Returns:
+        A numpy array of the weights in grams, and the date string (None if
+        there are no samples).
+    """
+
+    if not data:
+        return np.zeros(0), None
+    fields = data.replace(b'\n', b'\t').split(b'\t')
+    if len(fields) % 2 == 1:
+        weights = fields[1::2]
+    else:
+        # A line without a tab, fall back to going line by line
+        weights = [line.rpartition(b'\t')[2] for line in data.split(b'\n')
+                   if b'\t' in line]
+    return (np.fromiter(map(float, weights), np.float64, len(weights)),
+            data[:10].decode())
+
+
+def parse_summary(path):
+    """Reads a <mouse>_summary.txt file.
+
+    Returns:
+        A dict of day counts (as strings) and required drug drops.
+    """
+
+    required = {}
+    with open(path, 'r') as file:
+        for line in file:
+            fields = line.split()
+            try:
+                required[str(int(fields[0]))] = int(fields[4])
+            except (IndexError, ValueError):
+                continue
+    return required
+
+
+def scan_file(task):
+    """Scans one data file. Run in the pool's processes.
+
+    Args:
+        task is a (kind, path, lower, upper, cached) tuple, where kind is
+        'events', 'weights' or 'summary', lower and upper are the weight
+        limits and cached is the file's entry in the cache (or None).
+
+    Returns:
+        The path and its new cache entry (a dict holding the 'size' read up
+        to, 'mtime_ns', 'tail' CRC and 'result').
+    """
+
+    kind, path, lower, upper, cached = task
+    stat = os.stat(path)
+    start = 0
+    result = None
+    appended = kind == 'events' or (kind == 'weights' and
+                                    path.endswith('.txt'))
+    if (appended and cached is not None and stat.st_size >= cached['size']
+            and tail_crc(path, cached['size']) == cached['tail']):
+        start = cached['size']
+        result = cached['result']
+
+    end = stat.st_size
+    if kind == 'events':
+        data, end = read_lines(path, start)
+        counts = parse_events(data)
+        result = dict(result or {})
+        for date, new in counts.items():
+            result[date] = [a + b for a, b in
+                            zip(result.get(date, [0] * len(EVENTS)), new)]
+    elif kind == 'summary':
+        result = parse_summary(path)
+    else:
+        histogram = WeightHistogram(lower, upper,
+                                    None if result is None
+                                    else result['counts'])
+        date = None if result is None else result['date']
+        if path.endswith('.bin'):
+            weights = weight_log.read_weights(path)
+            times = weight_log.read_times(path)
+            if len(times):
+                date = str(dt.date.fromtimestamp(times[0] / 1000))
+        else:
+            data, end = read_lines(path, start)
+            weights, first = parse_weights(data)
+            date = date or first
+        histogram.add_array(weights)
+        result = {'day': int(WEIGHTS_FILE.search(path).group(1)),
+                  'date': date, 'counts': histogram.counts.tolist()}
+    return path, {'size': end, 'mtime_ns': stat.st_mtime_ns,
+                  'tail': tail_crc(path, end) if appended else 0,
+                  'result': result}
+
+
+def find_files(data_dir):
+    """Lists the data files of each mouse.
+
+    Returns:
+        A list of (mouse name, kind, path) tuples.
+    """
+
+    files = []
+    for mouse in sorted(os.listdir(data_dir)):
+        folder = os.path.join(data_dir, mouse)
+        if not os.path.isdir(folder):
+            continue
+        for kind, name in (('events', '%s_data.txt'),
+                           ('summary', '%s_summary.txt')):
+            path = os.path.join(folder, name % (mouse))
+            if os.path.exists(path):
+                files.append((mouse, kind, path))
+        weights_dir = os.path.join(folder, 'Weights')
+        if os.path.isdir(weights_dir):
+            for name in sorted(os.listdir(weights_dir)):
+                if (name.startswith(mouse + '_weights_day') and
+                        WEIGHTS_FILE.search(name)):
+                    files.append((mouse, 'weights',
+                                  os.path.join(weights_dir, name)))
+    return files
+
+
+def cohort_rows(files, entries, lower, upper):
+    """Joins the scanned files into the rows of the cohort table.
+
+    Args:
+        files is the list from find_files().
+        entries is a dict of paths and their cache entries.
+        lower and upper are the weight limits.
+
+    Returns:
+        A list of rows (lists of values), sorted by mouse and date.
+    """
+
+    mice = {}
+    for mouse, kind, path in files:
+        result = entries[path]['result']
+        data = mice.setdefault(mouse, {'events': {}, 'required': {},
+                                       'weights': {}})
+        if kind == 'events':
+            data['events'] = result
+        elif kind == 'summary':
+            data['required'] = result
+        elif result['date'] is not None:
+            data['weights'][result['date']] = result
+
+    rows = []
+    for mouse, data in sorted(mice.items()):
+        for date in sorted(set(data['events']) | set(data['weights'])):
+            entered, licks, water, drug = data['events'].get(
+                date, [0] * len(EVENTS))
+            weights = data['weights'].get(date)
+            day = required = dose = weight = ''
+            n_weights = 0
+            if weights is not None:
+                day = weights['day']
+                n_weights, weight = WeightHistogram(
+                    lower, upper, weights['counts']).mode()
+                if weight is None:
+                    weight = ''
+                required = data['required'].get(str(day), '')
+                if required:
+                    dose = '%.1f' % (100.0 * drug / required)
+            rows.append([mouse, date, day, entered, licks, water, drug,
+                         required, dose, n_weights, weight])
+    return rows
+
+
+def report(data_dir, output, cache_path, jobs=None, lower=20, upper=60):
+    """Scans the data folder (in parallel, reusing cached results) and
+    writes the cohort table.
+
+    Args:
+        data_dir is a string containing the data folder.
+        output is a string containing the location of the table.
+        cache_path is a string containing the location of the cache.
+        jobs is the number of processes (None for one per CPU).
+        lower and upper are the weight limits (LOWER_WEIGHT and
+        UPPER_WEIGHT).
+
+    Returns:
+        The number of files scanned and the number of files in the data
+        folder.
+    """
+
+    cache = {}
+    try:
+        with open(cache_path, 'r') as file:
+            saved = json.load(file)
+        if saved.get('version') == CACHE_VERSION and \
+           saved.get('limits') == [lower, upper]:
+            cache = saved['files']
+    except (IOError, ValueError):
+        pass
+
+    files = find_files(data_dir)
+    entries = {}
+    tasks = []
+    for mouse, kind, path in files:
+        cached = cache.get(path)
+        stat = os.stat(path)
+        if (cached is not None and cached['size'] == stat.st_size and
+                cached['mtime_ns'] == stat.st_mtime_ns):
+            entries[path] = cached
+        else:
+            tasks.append((kind, path, lower, upper, cached))
+
+    if jobs == 1 or len(tasks) < 2:
+        results = map(scan_file, tasks)
+        entries.update(results)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            entries.update(pool.map(scan_file, tasks,
+                                    chunksize=max(len(tasks) // 64, 1)))
+
+    rows = cohort_rows(files, entries, lower, upper)
+    with open(output, 'w') as file:
+        file.write("Mouse\tDate\tDay\tEntries\tLicks\tWater Drops\t"
+                   "Drug Drops\tRequired Drug Drops\tDose (%)\t"
+                   "Weight Samples\tWeight\n")
+        for row in rows:
+            file.write('\t'.join(str(value) for value in row) + '\n')
+
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({'version': CACHE_VERSION, 'limits': [lower, upper],
+                   'files': entries}, file)
+    os.replace(tmp_path, cache_path)
+    return len(tasks), len(files)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a cohort table of "
+                                     "daily drops, doses, licks and weights "
+                                     "from a PiDose data folder.")
+    parser.add_argument('data_dir', nargs='?',
+                        default='/home/pi/piDose/data')
+    parser.add_argument('--output', default=None,
+                        help="table to write (defaults to cohort_report.txt "
+                        "in the data folder)")
+    parser.add_argument('--cache', default=None,
+                        help="cache file (defaults to report_cache.json in "
+                        "the data folder)")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="processes to scan files with (defaults to one "
+                        "per CPU)")
+    parser.add_argument('--lower', type=float, default=20,
+                        help="lowest weight counted (LOWER_WEIGHT)")
+    parser.add_argument('--upper', type=float, default=60,
+                        help="highest weight counted (UPPER_WEIGHT)")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(args.data_dir, 'cohort_report.txt')
+    cache_path = args.cache or os.path.join(args.data_dir,
+                                            'report_cache.json')
+    start = perf_counter()
+    scanned, total = report(args.data_dir, output, cache_path, args.jobs,
+                            args.lower, args.upper)
+    print("Scanned %i of %i files (the rest were cached) in %.2f s. Cohort "
+          "table in %s." % (scanned, total, perf_counter() - start, output))
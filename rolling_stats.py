@@ -0,0 +1,96 @@
+"""Statistics of the last n samples of a stream, updated in constant time.
+
+The mean and variance come from a running sum and sum of squares. The
+window's minimum and maximum come from two monotonic deques, so the largest
+deviation of any sample from the mean can be checked after every sample
+without going over the window again.
+
+"""
+
+import math
+import collections
+
+
+class RollingWindow(object):
+    """The last size samples of a stream and their statistics."""
+
+    def __init__(self, size):
+        """Args:
+            size is the number of samples in the window (an int, at least 1).
+        """
+
+        if size < 1:
+            raise ValueError("Window size must be at least 1, got %s."
+                             % (size))
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        """Empties the window."""
+
+        self._samples = collections.deque()
+        self._sum = 0.0
+        self._sum_squares = 0.0
+        # (index, value) of candidates for the window's min and max
+        self._min = collections.deque()
+        self._max = collections.deque()
+        self._count = 0
+        return None
+
+    def add(self, value):
+        """Adds a sample, dropping the oldest one if the window is full."""
+
+        if len(self._samples) == self.size:
+            old = self._samples.popleft()
+            self._sum -= old
+            self._sum_squares -= old * old
+            first = self._count - self.size
+            if self._min[0][0] == first:
+                self._min.popleft()
+            if self._max[0][0] == first:
+                self._max.popleft()
+        self._samples.append(value)
+        self._sum += value
+        self._sum_squares += value * value
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((self._count, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((self._count, value))
+        self._count += 1
+        return None
+
+    def __len__(self):
+        return len(self._samples)
+
+    def full(self):
+        """True if the window holds size samples."""
+
+        return len(self._samples) == self.size
+
+    def mean(self):
+        return self._sum / len(self._samples)
+
+    def variance(self):
+        """Population variance of the samples."""
+
+        n = len(self._samples)
+        mean = self._sum / n
+        # Rounding can make this slightly negative for constant samples
+        return max(self._sum_squares / n - mean * mean, 0.0)
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def min(self):
+        return self._min[0][1]
+
+    def max(self):
+        return self._max[0][1]
+
+    def max_deviation(self):
+        """Largest distance of a sample from the mean."""
+
+        mean = self.mean()
+        return max(self.max() - mean, mean - self.min())
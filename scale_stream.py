@@ -0,0 +1,264 @@
+"""Continuous load cell sampling on a background thread.
+
+Taking one weighOnce() reading per weight sample from the main loop blocks
+it for every conversion and caps the sample rate at WEIGH_FREQUENCY. A
+ScaleStream instead has the HX711 read back to back (at its own conversion
+rate, 80 Hz with RATE tied high) by the threaded array read of GPIO_Thread's
+Scale (weighThreadStart()), which runs in C outside the Python interpreter,
+so it adds no load to the lick callback's process. The main loop pulls
+whatever has arrived since the last pull as a batch of arrays, and reduces
+it to weight samples by taking the median or mean of every n consecutive
+readings (see decimate()). More of each visit is sampled, the main loop
+wakes up once per batch rather than once per sample, and how often weights
+are written no longer depends on how often the load cell is read.
+
+A scale without the threaded read is read by a Python thread into a numpy
+ring buffer instead; readings that raise are counted as lost (the first is
+logged).
+On the simulated cage (threaded=False), readings are taken by events on the
+virtual clock instead of by a thread.
+
+"""
+
+import logging
+import threading
+import numpy as np
+
+log = logging.getLogger('piDose.scale_stream')
+
+FILTERS = ('median', 'mean')
+
+
+def decimate(times, weights, factor, method='median'):
+    """Reduces every factor consecutive readings to one sample.
+
+    Args:
+        times is a numpy int64 array of reading times (monotonic ns).
+        weights is a numpy float64 array of readings in grams.
+        factor is the number of readings per sample (an int).
+        method is 'median' or 'mean'.
+
+    Returns:
+        The sample times (the mean time of each block, as int64) and the
+        sample weights as numpy arrays, and the number of readings left over
+        at the end that did not fill a block.
+
+    Raises:
+        ValueError: method is not a known filter.
+    """
+
+    if method not in FILTERS:
+        raise ValueError("Filter must be one of %s, got %s." % (FILTERS,
+                                                               method))
+    n = len(weights) // factor
+    blocks = weights[:n * factor].reshape(n, factor)
+    if method == 'median':
+        sample_weights = np.median(blocks, axis=1)
+    else:
+        sample_weights = blocks.mean(axis=1)
+    sample_times = (times[:n * factor].reshape(n, factor).mean(axis=1)
+                    .astype(np.int64))
+    return sample_times, sample_weights, len(weights) - n * factor
+
+
+class ScaleStream(object):
+    """Reads a load cell continuously into a ring buffer."""
+
+    def __init__(self, scale, clock, rate=80, capacity=1024, factor=16,
+                 method='median', threaded=True):
+        """Args:
+            scale is the hardware.ScaleBackend() to read.
+            clock is the clock (a timing.SystemClock() or
+            simulator.SimClock()).
+            rate is the reading rate in Hz. When threaded, readings are
+            taken as fast as the load cell converts, and this is only used
+            to time the readings (the threaded read does not time them) and
+            on the simulated cage.
+            capacity is the number of readings the buffer holds (at most the
+            size of the scale's array for the threaded read). If the main
+            loop does not pull them in time, readings are lost.
+            factor and method are as for decimate().
+            threaded is False to take readings from events on the clock
+            (which must then have schedule() and seconds(), as SimClock
+            does).
+
+        Raises:
+            ValueError: method is not a known filter.
+        """
+
+        if method not in FILTERS:
+            raise ValueError("Filter must be one of %s, got %s."
+                             % (FILTERS, method))
+        self._scale = scale
+        self._clock = clock
+        self.rate = rate
+        self.capacity = capacity
+        self.factor = factor
+        self.method = method
+        self.threaded = threaded
+        # Use the scale's own threaded read if it has one
+        self.library_thread = (threaded and
+                               hasattr(scale, 'weighThreadStart'))
+        if self.library_thread:
+            self.capacity = min(capacity, len(scale.dataArray))
+        # Readings of the current threaded read taken so far, and when the
+        # last pull was (monotonic ns)
+        self._read = 0
+        self._last_pull_ns = None
+        self._times = np.zeros(capacity, np.int64)
+        self._weights = np.zeros(capacity, np.float64)
+        # Readings written and pulled so far (the ring index is this modulo
+        # capacity). Only the acquisition side writes _written.
+        self._written = 0
+        self._pulled = 0
+        self._left_times = np.zeros(0, np.int64)
+        self._left_weights = np.zeros(0, np.float64)
+        self.lost = 0
+        self._running = False
+        self._thread = None
+        self._generation = 0
+
+    def start(self):
+        """Empties the buffer and starts taking readings.
+
+        Returns:
+            None.
+        """
+
+        if self._running:
+            self.stop()
+        self._pulled = self._written
+        self._left_times = self._left_times[:0]
+        self._left_weights = self._left_weights[:0]
+        self._running = True
+        if self.library_thread:
+            self._read = 0
+            self._last_pull_ns = self._clock.monotonic_ns()
+            self._scale.weighThreadStart(self.capacity)
+        elif self.threaded:
+            self._thread = threading.Thread(target=self._run,
+                                            name='ScaleStream', daemon=True)
+            self._thread.start()
+        else:
+            self._generation += 1
+            generation = self._generation
+            self._clock.schedule(self._clock.seconds(),
+                                 lambda: self._event(generation))
+        return None
+
+    def stop(self):
+        """Stops taking readings (finishing the one in progress).
+
+        Returns:
+            None.
+        """
+
+        if self.library_thread and self._running:
+            self._scale.weighThreadStop()
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return None
+
+    def _store(self, weight):
+        j = self._written % self.capacity
+        self._times[j] = self._clock.monotonic_ns()
+        self._weights[j] = weight
+        self._written += 1
+        return None
+
+    def _run(self):
+        errors = 0
+        while self._running:
+            try:
+                weight = self._scale.weighOnce()
+            except Exception:
+                # Only the first error is logged, the rest are counted as
+                # lost readings (reported after each visit)
+                if not errors:
+                    log.exception("Error reading the load cell.")
+                errors += 1
+                self.lost += 1
+                self._clock.sleep(1.0 / self.rate)
+                continue
+            self._store(weight)
+        return None
+
+    def _event(self, generation):
+        """Takes one reading and schedules the next. Used when not
+        threaded."""
+
+        if not self._running or generation != self._generation:
+            return None
+        self._store(self._scale.weighOnce())
+        self._clock.schedule(self._clock.seconds() + 1.0 / self.rate,
+                             lambda: self._event(generation))
+        return None
+
+    def pull(self):
+        """Takes the readings that have arrived since the last pull.
+
+        Returns:
+            numpy arrays of the reading times (monotonic ns) and weights in
+            grams, oldest first.
+        """
+
+        if self.library_thread:
+            return self._pull_library()
+        written = self._written
+        if written - self._pulled > self.capacity:
+            self.lost += written - self._pulled - self.capacity
+            self._pulled = written - self.capacity
+        indices = np.arange(self._pulled, written) % self.capacity
+        self._pulled = written
+        return self._times[indices], self._weights[indices]
+
+    def _pull_library(self):
+        """pull() for the scale's threaded read, which fills the scale's
+        array from the start and then stops. Once the array is half full the
+        read is restarted, losing at most the reading in progress. The
+        readings are timed at rate, ending now (or, if the array filled
+        before this pull, starting at the last pull)."""
+
+        if not self._running:
+            return np.zeros(0, np.int64), np.zeros(0, np.float64)
+        now_ns = self._clock.monotonic_ns()
+        n = self._scale.weighThreadCheck()
+        restart = n >= self.capacity // 2
+        if restart:
+            self._scale.weighThreadStop()
+            n = self._scale.weighThreadCheck()
+        weights = np.array(self._scale.dataArray[self._read:n], np.float64)
+        period_ns = 1e9 / self.rate
+        if n >= self.capacity:
+            times = (self._last_pull_ns +
+                     period_ns * np.arange(1, len(weights) + 1))
+            self.lost += max(int((now_ns - self._last_pull_ns) / period_ns) -
+                             len(weights), 0)
+        else:
+            times = now_ns - period_ns * np.arange(len(weights) - 1, -1, -1)
+        self._read = n
+        if restart:
+            self._scale.weighThreadStart(self.capacity)
+            self._read = 0
+        self._last_pull_ns = now_ns
+        return times.astype(np.int64), weights
+
+    def samples(self):
+        """Pulls the new readings and decimates them, keeping readings that
+        do not fill a block for the next call.
+
+        Returns:
+            numpy arrays of the sample times (monotonic ns) and weights in
+            grams.
+        """
+
+        times, weights = self.pull()
+        times = np.concatenate((self._left_times, times))
+        weights = np.concatenate((self._left_weights, weights))
+        sample_times, sample_weights, left = decimate(times, weights,
+                                                      self.factor, self.method)
+        self._left_times = times[len(times) - left:]
+        self._left_weights = weights[len(weights) - left:]
+        return sample_times, sample_weights
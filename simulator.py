@@ -0,0 +1,786 @@
+"""Deterministic simulated PiDose cage.
+
+SimHardware provides every device in hardware.py, driven by a script of
+mouse visits (RFID presence, licks and body weight) on a virtual clock. Time
+only moves forward when the program sleeps or waits, and it jumps straight
+to the next scripted event, so the full main loop of piDose.py runs many
+times faster than real time. Everything runs on the calling thread. GPIO
+callbacks (licks, RFID edges) are called from inside the clock's
+sleep()/select() at their scripted times, so runs are repeatable.
+
+Running this file simulates a colony on a plain computer:
+
+    python3 simulator.py --mice 8 --days 3
+
+"""
+
+import os
+import sys
+import math
+import heapq
+import bisect
+import random
+import argparse
+import tempfile
+import importlib
+import threading
+import collections
+import datetime as dt
+from time import perf_counter
+from hardware import (GPIOBackend, CapSensorBackend, ScaleBackend,
+                      TagReaderBackend, CameraBackend, Hardware)
+from video_clips import FRAME, KEY_FRAME, SPS_HEADER
+
+
+class SimulationEnd(KeyboardInterrupt):
+    """Raised by the virtual clock when the end of the script is reached.
+
+    It is a KeyboardInterrupt so that the main loop shuts down (saving the
+    current mouse) exactly as it does on Ctrl-C.
+    """
+
+
+class SimClock(object):
+    """Virtual clock with a queue of scheduled events."""
+
+    def __init__(self, start, end=None):
+        """Args:
+            start is the wall clock time (datetime.datetime()) at time zero.
+            end is the time in seconds after which SimulationEnd is raised
+            (None runs forever).
+        """
+
+        self.start = start
+        self.end_ns = None if end is None else int(end * 1e9)
+        self._ns = 0
+        self._events = []
+        self._seq = 0
+        self._in_event = 0
+
+    def now(self):
+        return self.start + dt.timedelta(microseconds=self._ns // 1000)
+
+    def monotonic_ns(self):
+        return self._ns
+
+    def seconds(self):
+        """Virtual time since the start in seconds."""
+
+        return self._ns / 1e9
+
+    def schedule(self, seconds, callback):
+        """Calls callback() when the clock reaches seconds after the start."""
+
+        heapq.heappush(self._events, (int(seconds * 1e9), self._seq,
+                                      callback))
+        self._seq += 1
+        return None
+
+    def _advance_to(self, target_ns):
+        """Moves time forward to target_ns, running events on the way."""
+
+        if self.end_ns is not None and target_ns > self.end_ns:
+            self._advance_to(self.end_ns)
+            raise SimulationEnd()
+        while self._events and self._events[0][0] <= target_ns:
+            event_ns, seq, callback = heapq.heappop(self._events)
+            self._ns = max(self._ns, event_ns)
+            self._in_event += 1
+            try:
+                callback()
+            finally:
+                self._in_event -= 1
+        # An event may already have slept past target_ns
+        self._ns = max(self._ns, target_ns)
+        return None
+
+    def in_event(self):
+        """True while a scheduled event is running. Events stand in for work
+        done on background threads on the Pi, so they take no time on the
+        main thread."""
+
+        return self._in_event > 0
+
+    def sleep(self, seconds):
+        self._advance_to(self._ns + max(0, int(seconds * 1e9)))
+        return None
+
+    def select(self, selector, timeout):
+        """Runs events until one makes the selector ready, or until timeout
+        seconds have passed."""
+
+        deadline = self._ns + max(0, int(timeout * 1e9))
+        while True:
+            ready = selector.select(0)
+            if ready:
+                return ready
+            if not self._events or self._events[0][0] > deadline:
+                self._advance_to(deadline)
+                return selector.select(0)
+            self._advance_to(self._events[0][0])
+
+
+class SimGPIO(GPIOBackend):
+    """GPIO pins whose inputs are set by the simulation.
+
+    Edge callbacks are called synchronously. A callback that causes another
+    edge (or sleeps through one) does not re-enter: the new callback runs
+    once the current one returns, as with RPi.GPIO's callback thread.
+    """
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._levels = {}
+        self._callbacks = {}
+        self._pending = []
+        self._dispatching = False
+        self.outputs = []
+
+    def setmode(self, mode):
+        return None
+
+    def setup(self, pin, direction, pull_up_down=None):
+        if pin not in self._levels:
+            self._levels[pin] = 1 if pull_up_down == self.PUD_UP else 0
+        return None
+
+    def output(self, pin, value):
+        value = int(bool(value))
+        self._levels[pin] = value
+        self.outputs.append((self._clock.monotonic_ns(), pin, value))
+        return None
+
+    def input(self, pin):
+        return self._levels.get(pin, 0)
+
+    def add_event_detect(self, pin, edge, callback=None):
+        if pin in self._callbacks:
+            raise RuntimeError("Conflicting edge detection already enabled "
+                               "for this GPIO channel")
+        self._callbacks[pin] = (edge, callback)
+        return None
+
+    def remove_event_detect(self, pin):
+        self._callbacks.pop(pin, None)
+        return None
+
+    def cleanup(self):
+        self._callbacks = {}
+        return None
+
+    def set_input(self, pin, value):
+        """Drives an input pin, calling its edge callback if there is one."""
+
+        value = int(bool(value))
+        old = self._levels.get(pin, 0)
+        self._levels[pin] = value
+        if value == old or pin not in self._callbacks:
+            return None
+        edge, callback = self._callbacks[pin]
+        if (edge == self.BOTH or (edge == self.RISING and value) or
+            (edge == self.FALLING and not value)):
+            self._pending.append((callback, pin))
+            if not self._dispatching:
+                self._dispatching = True
+                try:
+                    while self._pending:
+                        callback, channel = self._pending.pop(0)
+                        callback(channel)
+                finally:
+                    self._dispatching = False
+        return None
+
+
+class SimElectrode(object):
+    def __init__(self):
+        self.threshold = 0
+        self.release_threshold = 0
+
+
+class SimCapSensor(CapSensorBackend):
+    """MPR121 whose IRQ pin goes low on each scripted touch or release and
+    goes high again when touched() is read."""
+
+    def __init__(self, gpio, pin_irq):
+        self._gpio = gpio
+        self._pin_irq = pin_irq
+        self._touched = 0
+        self._electrodes = {}
+
+    def __getitem__(self, electrode):
+        return self._electrodes.setdefault(electrode, SimElectrode())
+
+    def touched(self):
+        touched = self._touched
+        self._gpio.set_input(self._pin_irq, 1)
+        return touched
+
+    def touch(self, electrode):
+        self._touched |= 1 << electrode
+        self._gpio.set_input(self._pin_irq, 0)
+        return None
+
+    def release(self, electrode):
+        self._touched &= ~(1 << electrode)
+        self._gpio.set_input(self._pin_irq, 0)
+        return None
+
+
+class SimScale(ScaleBackend):
+    """Load cell reading the weight of whichever mouse is in the chamber,
+    plus noise, or the samples of a recorded weight trace."""
+
+    def __init__(self, clock, seed=0, noise=0.02, read_time=0.0125):
+        """Args:
+            clock is the SimClock.
+            seed seeds the noise.
+            noise is the standard deviation of the noise in grams.
+            read_time is the time taken by each reading in seconds.
+        """
+
+        self._clock = clock
+        self._random = random.Random(seed)
+        self.noise = noise
+        self.read_time = read_time
+        self.load = 0.0
+        self.offset = 0.0
+        self.trace = None
+
+    def _read(self):
+        # Readings taken by a background stream (see scale_stream.py) do not
+        # hold up the main thread
+        if not self._clock.in_event():
+            self._clock.sleep(self.read_time)
+        if self.trace is not None:
+            # Latest recorded sample (times are in clock seconds)
+            times, weights = self.trace
+            j = bisect.bisect_right(times, self._clock.seconds()) - 1
+            return weights[max(j, 0)]
+        return self.load + self._random.gauss(0, self.noise)
+
+    def weighOnce(self):
+        return self._read() - self.offset
+
+    def tare(self, n_readings, print_result):
+        self.offset = sum(self._read() for i in range(n_readings)) / n_readings
+        return None
+
+
+class SimTagReader(TagReaderBackend):
+    """RFID reader returning whichever tag the script has in range."""
+
+    def __init__(self, clock, timeout, read_time=0.01):
+        self._clock = clock
+        self.timeout = timeout
+        self.read_time = read_time
+        self.tag = 0
+
+    def readTag(self):
+        if self.tag:
+            self._clock.sleep(self.read_time)
+        else:
+            self._clock.sleep(self.timeout)
+        return self.tag
+
+
+class SimCamera(CameraBackend):
+    """Camera producing synthetic greyscale frames (as binary PGM images)."""
+
+    def __init__(self, clock, resolution):
+        self._clock = clock
+        self.resolution = resolution
+        self.frames = 0
+        self.closed = False
+        self.recording = None
+        self.recording_start = None
+
+    def frame(self):
+        """Returns the next frame as PGM bytes. The pixel values encode the
+        frame number so frames can be told apart."""
+
+        width, height = self.resolution
+        self.frames += 1
+        header = ('P5 %i %i 255\n' % (width, height)).encode()
+        return header + bytes([self.frames % 256]) * (width * height)
+
+    def capture(self, output, **kwargs):
+        data = self.frame()
+        if hasattr(output, 'write'):
+            output.write(data)
+        else:
+            with open(output, 'wb') as file:
+                file.write(data)
+        return None
+
+    @property
+    def timestamp(self):
+        return int(round(self._clock.seconds() * 1e6))
+
+    def start_recording(self, output, format=None, **options):
+        self.recording = output
+        self.recording_start = self._clock.seconds()
+        return None
+
+    def wait_recording(self, timeout=0):
+        if self.recording is None:
+            raise RuntimeError("The camera is not recording.")
+        if timeout > 0:
+            self._clock.sleep(timeout)
+        return None
+
+    def stop_recording(self):
+        self.recording = None
+        return None
+
+    def close(self):
+        self.closed = True
+        return None
+
+
+SimFrame = collections.namedtuple('SimFrame', ('frame_type', 'timestamp',
+                                               'frame_size', 'position',
+                                               'complete'),
+                                   defaults=(0, True))
+
+
+class SimVideoBuffer(object):
+    """Circular video buffer of a SimCamera, with the frames, lock, tell(),
+    seek() and read() of picamera.PiCameraCircularIO. Rather than H.264, the
+    stream is a line of text for each frame (and for the SPS header before
+    each key frame, once a second), so a clip copied out of it lists the
+    frames it would hold.
+
+    Frames are recorded at the camera's frame rate from the start of the
+    recording, and the buffer holds the frames of the last seconds.
+    """
+
+    LINE = 32
+
+    def __init__(self, camera, clock, seconds):
+        self._camera = camera
+        self._clock = clock
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self._pos = 0
+
+    def _lines(self):
+        """The index of the first line in the buffer and of the line after
+        the last frame recorded so far."""
+
+        rate = self._camera.framerate
+        period = int(round(rate))
+        elapsed = self._clock.seconds() - self._camera.recording_start
+        last = int(math.floor(elapsed * rate + 1e-9))
+        first = max(0, int(math.ceil((elapsed - self.seconds) * rate)))
+        # Frame n is line n + n // period + 1, after the SPS header of its
+        # second
+        start = first + first // period + (0 if first % period == 0 else 1)
+        return start, last + last // period + 2
+
+    def _line(self, j):
+        period = int(round(self._camera.framerate))
+        n = j - j // (period + 1) - 1
+        if j % (period + 1) == 0:
+            return SimFrame(SPS_HEADER, None, self.LINE), 'SPS header'
+        seconds = (self._camera.recording_start +
+                   n / self._camera.framerate)
+        return (SimFrame(KEY_FRAME if n % period == 0 else FRAME,
+                         int(round(seconds * 1e6)), self.LINE),
+                'Frame %i at %.3f s' % (n, seconds))
+
+    @property
+    def frames(self):
+        """The frames in the buffer (as picamera.PiVideoFrame does, with
+        frame_type, frame_size, position, timestamp and complete)."""
+
+        start, end = self._lines()
+        frames = []
+        for j in range(start, end):
+            frame = self._line(j)[0]
+            frames.append(frame._replace(position=(j - start) * self.LINE))
+        return frames
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos):
+        self._pos = pos
+        return pos
+
+    def read(self, size=-1):
+        start, end = self._lines()
+        lines = [self._line(j)[1].ljust(self.LINE - 1)[:self.LINE - 1] + '\n'
+                 for j in range(start, end)]
+        data = ''.join(lines).encode()
+        end = len(data) if size < 0 else self._pos + size
+        result = data[self._pos:end]
+        self._pos += len(result)
+        return result
+
+
+class Visit(object):
+    """One scripted visit of a mouse to the chamber."""
+
+    def __init__(self, tag, start, duration, weight, licks=(), trace=None,
+                 chamber=0):
+        """Args:
+            tag is the RFID of the mouse (int).
+            start is the time of entry in seconds after the simulation start.
+            duration is the time in seconds until the mouse leaves.
+            weight is the mouse's weight in grams.
+            licks is a list of lick times in seconds after entry.
+            trace is an optional list of (seconds after entry, grams) scale
+            readings to play back instead of weight plus noise.
+            chamber is the index of the chamber visited.
+        """
+
+        self.tag = tag
+        self.start = start
+        self.duration = duration
+        self.weight = weight
+        self.licks = list(licks)
+        self.trace = trace
+        self.chamber = chamber
+
+
+def movement_trace(weight, duration, rng, rate=20, noise=0.02):
+    """Makes a scale trace of a mouse that steps on, moves about and steps
+    off.
+
+    The mouse takes 0.5-1.5 s to step on and off. In between it stands
+    still (its weight plus noise) for 1-10 s at a time, and moves about for
+    0.5-4 s at a time, when the scale reads 40-110% of its weight (as when it
+    rears or has some paws off the platform).
+
+    Args:
+        weight is the mouse's weight in grams.
+        duration is the time in seconds the mouse is in the chamber.
+        rng is a random.Random().
+        rate is the number of scale readings per second.
+        noise is the standard deviation of the noise in grams.
+
+    Returns:
+        A list of (seconds after entry, grams) scale readings.
+    """
+
+    step_on = rng.uniform(0.5, 1.5)
+    step_off = duration - rng.uniform(0.5, 1.5)
+    moving = False
+    phase_end = step_on + rng.uniform(1, 10)
+    level = weight
+    trace = []
+    t = 0.0
+    while t < duration:
+        if t >= phase_end:
+            moving = not moving
+            phase_end = t + (rng.uniform(0.5, 4) if moving
+                             else rng.uniform(1, 10))
+            level = weight
+        if t < step_on:
+            grams = weight * t / step_on + rng.gauss(0, 0.3)
+        elif t >= step_off:
+            grams = (weight * (duration - t) / (duration - step_off) +
+                     rng.gauss(0, 0.3))
+        elif moving:
+            level = min(max(level + rng.gauss(0, 0.1 * weight),
+                            0.4 * weight), 1.1 * weight)
+            grams = level + rng.gauss(0, 0.3)
+        else:
+            grams = weight + rng.gauss(0, noise)
+        trace.append((t, grams))
+        t += 1.0 / rate
+    return trace
+
+
+def random_script(tags, days, visits_per_day=40, seed=0, movement=False):
+    """Makes a script of random visits by a set of mice.
+
+    Each mouse visits visits_per_day times a day (at random times, never
+    overlapping another mouse), stays 10-120 s, and licks in bouts of around
+    7 Hz.
+
+    Args:
+        tags is a list of RFIDs (ints).
+        days is the number of days to simulate.
+        visits_per_day is the number of visits per mouse per day.
+        seed seeds the random number generator.
+        movement is True to have the mice step on and off and move about on
+        the scale (see movement_trace()), False to have the scale read their
+        weight plus noise throughout.
+
+    Returns:
+        A list of Visit objects sorted by start time.
+    """
+
+    rng = random.Random(seed)
+    weights = {tag: rng.uniform(22, 32) for tag in tags}
+    n_visits = int(round(len(tags) * visits_per_day * days))
+    # Space visits out so there is always time for the grace period and tare
+    slot = days * 86400.0 / n_visits
+    visits = []
+    for j in range(n_visits):
+        tag = rng.choice(tags)
+        duration = rng.uniform(10, min(120, slot / 2))
+        start = j * slot + rng.uniform(0, slot - duration - 40)
+        licks = []
+        t = rng.uniform(1, 5)
+        while t < duration - 1:
+            for k in range(rng.randint(3, 30)):
+                licks.append(t)
+                t += rng.uniform(0.12, 0.18)
+            t += rng.uniform(1, 10)
+        licks = [lick for lick in licks if lick < duration - 0.5]
+        trace = (movement_trace(weights[tag], duration, rng) if movement
+                 else None)
+        visits.append(Visit(tag, start, duration, weights[tag], licks,
+                            trace))
+    return visits
+
+
+class SimChamber(object):
+    """The RFID reader, load cell and spout electrode of one chamber of a
+    simulated cage."""
+
+    def __init__(self, pin_rfid_tir=27, pin_scale_dat=17,
+                 rfid_port='/dev/serial0', cap_electrode=0):
+        """Args:
+            pin_rfid_tir, pin_scale_dat, rfid_port and cap_electrode should
+            match the chamber's PiDose constants (PIN_RFID_TIR,
+            PIN_SCALE_DAT, RFID_PORT and CAP_SPOUT_PIN).
+        """
+
+        self.pin_rfid_tir = pin_rfid_tir
+        self.pin_scale_dat = pin_scale_dat
+        self.rfid_port = rfid_port
+        self.cap_electrode = cap_electrode
+        self.scale = None
+        self.tag_reader = None
+
+
+class SimHardware(Hardware):
+    """A simulated cage running a script of mouse visits."""
+
+    def __init__(self, visits, start=None, end=None, seed=0, pin_cap_irq=26,
+                 chambers=None):
+        """Schedules the visits on a new virtual clock.
+
+        Args:
+            visits is a list of Visit objects.
+            start is the wall clock time at the start (defaults to 8am on
+            1 Jan 2020).
+            end is the time in seconds at which to stop (defaults to 60 s
+            after the last visit).
+            seed seeds the scale noise.
+            pin_cap_irq should match PIN_CAP_IRQ.
+            chambers is a list of SimChamber objects, one for each entry in
+            CHAMBERS (defaults to a single chamber on the default pins).
+        """
+
+        if start is None:
+            start = dt.datetime(2020, 1, 1, 8)
+        if end is None:
+            end = max([v.start + v.duration for v in visits] + [0]) + 60
+        Hardware.__init__(self, SimGPIO(None), SimClock(start, end), False)
+        self.gpio._clock = self.clock
+        self.pin_cap_irq = pin_cap_irq
+        self.chambers = [SimChamber()] if chambers is None else chambers
+        self.seed = seed
+        self.reboots = 0
+        self._cap = None
+        self._camera = None
+        self.gpio.setup(pin_cap_irq, GPIOBackend.IN, GPIOBackend.PUD_UP)
+        for visit in visits:
+            self._schedule_visit(visit)
+
+    def _schedule_visit(self, visit):
+        clock = self.clock
+        chamber = self.chambers[visit.chamber]
+        trace = None
+        if visit.trace:
+            trace = ([visit.start + t for t, weight in visit.trace],
+                     [weight for t, weight in visit.trace])
+
+        def enter():
+            if chamber.scale is not None:
+                chamber.scale.load = visit.weight
+                chamber.scale.trace = trace
+            if chamber.tag_reader is not None:
+                chamber.tag_reader.tag = visit.tag
+            self.gpio.set_input(chamber.pin_rfid_tir, 1)
+
+        def leave():
+            if chamber.scale is not None:
+                chamber.scale.load = 0.0
+                chamber.scale.trace = None
+            if chamber.tag_reader is not None:
+                chamber.tag_reader.tag = 0
+            self.gpio.set_input(chamber.pin_rfid_tir, 0)
+
+        def lick():
+            if self._cap is not None:
+                self._cap.touch(chamber.cap_electrode)
+
+        def release():
+            if self._cap is not None:
+                self._cap.release(chamber.cap_electrode)
+
+        clock.schedule(visit.start, enter)
+        licks = sorted(visit.licks)
+        for j, t in enumerate(licks):
+            clock.schedule(visit.start + t, lick)
+            # Release after 50 ms, or half way to a quicker next lick
+            hold = 0.05
+            if j + 1 < len(licks):
+                hold = min(hold, (licks[j + 1] - t) / 2)
+            clock.schedule(visit.start + t + hold, release)
+        clock.schedule(visit.start + visit.duration, leave)
+        return None
+
+    def _chamber(self, name, value):
+        for chamber in self.chambers:
+            if getattr(chamber, name) == value:
+                return chamber
+        raise ValueError("No simulated chamber has %s = %s." % (name, value))
+
+    def cap_sensor(self):
+        if self._cap is None:
+            self._cap = SimCapSensor(self.gpio, self.pin_cap_irq)
+        return self._cap
+
+    def scale(self, pin_data, pin_clock, grams_per_unit, array_size):
+        chamber = self._chamber('pin_scale_dat', pin_data)
+        if chamber.scale is None:
+            chamber.scale = SimScale(self.clock,
+                                     self.seed + self.chambers.index(chamber))
+        return chamber.scale
+
+    def tag_reader(self, port, timeout, kind):
+        chamber = self._chamber('rfid_port', port)
+        if chamber.tag_reader is None:
+            chamber.tag_reader = SimTagReader(self.clock, timeout)
+        return chamber.tag_reader
+
+    def camera(self, resolution):
+        self._camera = SimCamera(self.clock, resolution)
+        return self._camera
+
+    def video_buffer(self, camera, seconds, bitrate):
+        return SimVideoBuffer(camera, self.clock, seconds)
+
+    def reboot(self):
+        self.reboots += 1
+        return None
+
+
+def make_colony(root, n_mice, seed=0):
+    """Creates mice.cfg and data folders for a simulated colony.
+
+    Args:
+        root is a string containing the directory to create them in.
+        n_mice is the number of mice (half are given the drug).
+        seed seeds the RFIDs.
+
+    Returns:
+        The list of RFIDs (ints).
+    """
+
+    rng = random.Random(seed)
+    tags = [rng.randint(10**9, 10**10 - 1) for i in range(n_mice)]
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'mice.cfg'), 'w') as file:
+        file.write('RFID_Tag\tName\tTreat.\tD.ofM.\tD.inC.\tDrugD.\t'
+                   'WaterD.\tReqD.D.\tWeight')
+        for j, tag in enumerate(tags):
+            name = 'SIM%i' % (j + 1)
+            file.write('\n%i\t%s\t%s\t0\t0\t0\t0\t0\t30.0'
+                       % (tag, name, 'DRUG' if j % 2 else 'CTRL'))
+            os.makedirs(os.path.join(root, 'data', name, 'Weights'))
+            os.makedirs(os.path.join(root, 'data', name, 'Pictures'))
+    return tags
+
+
+def run(hardware, root, program='piDose', **constants):
+    """Runs the PiDose main loop on simulated hardware until the script ends.
+
+    Like monitor.sh, the program is restarted (the module reloaded) whenever
+    it exits, e.g. for the automatic reboot after midnight.
+
+    Args:
+        hardware is a SimHardware object.
+        root is a string containing a directory made by make_colony().
+        program is the name of the module to run (piDose or piDose_camera).
+        constants are PiDose constants to override (e.g. WATER_TIMEOUT).
+
+    Returns:
+        The number of times the program was (re)started.
+    """
+
+    starts = 0
+    while True:
+        module = importlib.reload(importlib.import_module(program))
+        base = getattr(module, 'piDose', module)
+        base.MICE_CONFIG = os.path.join(root, 'mice.cfg')
+        base.DATA_DIR = os.path.join(root, 'data')
+        base.SQLITE_DATABASE = os.path.join(root, 'data', 'piDose.db')
+        base.TARE_LOG = os.path.join(root, 'tare_weights.txt')
+        base.LOG_FILE = os.path.join(root, 'piDose.log')
+        base.TRACE_DIR = os.path.join(root, 'traces')
+        for name, value in constants.items():
+            setattr(base, name, value)
+        starts += 1
+        try:
+            module.main(hardware)
+        except SystemExit:
+            continue
+        return starts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run PiDose on a simulated "
+                                     "cage.")
+    parser.add_argument('--mice', type=int, default=8)
+    parser.add_argument('--days', type=float, default=1)
+    parser.add_argument('--visits', type=int, default=40,
+                        help="visits per mouse per day")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--camera', action='store_true',
+                        help="run piDose_camera.py instead of piDose.py")
+    parser.add_argument('--movement', action='store_true',
+                        help="have mice step on and off and move about on "
+                        "the scale, rather than stand still")
+    parser.add_argument('--dir', default=None,
+                        help="directory for mice.cfg and data (defaults to "
+                        "a new temporary directory)")
+    args = parser.parse_args()
+
+    root = args.dir or tempfile.mkdtemp(prefix='pidose_sim_')
+    tags = make_colony(root, args.mice, args.seed)
+    visits = random_script(tags, args.days, args.visits, args.seed,
+                           args.movement)
+    hardware = SimHardware(visits, seed=args.seed)
+
+    stdout = sys.stdout
+    wall_start = perf_counter()
+    with open(os.path.join(root, 'log.txt'), 'w') as log:
+        sys.stdout = log
+        try:
+            starts = run(hardware, root, 'piDose_camera' if args.camera
+                         else 'piDose')
+        finally:
+            sys.stdout = stdout
+    wall = perf_counter() - wall_start
+
+    simulated = hardware.clock.seconds()
+    n_water = n_drug = 0
+    for mouse_dir in os.listdir(os.path.join(root, 'data')):
+        path = os.path.join(root, 'data', mouse_dir, mouse_dir + '_data.txt')
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    n_water += line.endswith('\t02\n')
+                    n_drug += line.endswith('\t03\n')
+    print("Simulated %.2f days (%i visits, %i program starts) in %.1f s, "
+          "%.0fx real time." % (simulated / 86400, len(visits), starts, wall,
+                                simulated / wall))
+    print("%i water drops and %i drug drops. Data and log in %s."
+          % (n_water, n_drug, root))
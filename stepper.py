@@ -0,0 +1,304 @@
+"""Stepper motor driver for the syringe pump.
+
+Stepping the motor by toggling PIN_MOTOR_STEP from Python and sleeping
+between edges leaves the step rate (and so the drop volume) at the mercy of
+the scheduler, and tops out at about 1 kHz. Instead, StepperDriver works out
+the whole pulse train for a move up front: a constant step frequency with
+optional linear acceleration and deceleration ramps. It then hands the train
+to a pulse generator:
+
+    DMAPulses - Sends the train as a pigpio waveform, timed by DMA
+        (requires the pigpio daemon, see piDose_setup.sh).
+    SoftwarePulses - Toggles the pin and sleeps on a clock. Used when pigpio
+        is not available, and on the simulated cage.
+
+Both generators time the rising edges they produce, and every move returns a
+report of actual against requested step timing.
+
+The microstep resolution is set with the MS1/MS2 pins of the driver board
+(EasyDriver: both low is full steps, both high is 1/8 steps).
+
+"""
+
+import math
+import threading
+from time import sleep
+import tracing
+
+# MS1, MS2 levels for each microstep resolution
+MICROSTEPS = {1: (False, False), 2: (True, False), 4: (False, True),
+              8: (True, True)}
+
+
+def step_periods(steps, frequency, start_frequency=None, ramp_steps=0):
+    """Works out the period of every step of a move.
+
+    The step rate rises from start_frequency to frequency over ramp_steps
+    steps with constant acceleration, and falls again over the last
+    ramp_steps steps. Moves too short for both ramps accelerate for the
+    first half and decelerate for the second.
+
+    Args:
+        steps is the number of steps (an int).
+        frequency is the cruising step rate in Hz.
+        start_frequency is the step rate in Hz at the start and end of the
+        ramps (defaults to frequency, i.e. no ramps).
+        ramp_steps is the number of steps in each ramp.
+
+    Returns:
+        A list of step periods in seconds.
+
+    Raises:
+        ValueError: steps is negative, or the frequencies are not
+        0 < start_frequency <= frequency.
+    """
+
+    if steps < 0:
+        raise ValueError("Steps must not be negative, got %s." % (steps))
+    if start_frequency is None:
+        start_frequency = frequency
+    if not 0 < start_frequency <= frequency:
+        raise ValueError("Step frequencies must be 0 < start frequency <= "
+                         "frequency, got %s and %s Hz."
+                         % (start_frequency, frequency))
+    if ramp_steps <= 0:
+        return [1.0 / frequency] * steps
+    acceleration = (frequency**2 - start_frequency**2) / (2.0 * ramp_steps)
+    periods = []
+    for j in range(steps):
+        # Steps from the nearest end of the move
+        k = min(j, steps - 1 - j, ramp_steps)
+        periods.append(1.0 / math.sqrt(start_frequency**2 +
+                                       2 * acceleration * k))
+    return periods
+
+
+def timing_report(periods, edges):
+    """Compares the rising edge times of a move with the requested periods.
+
+    Args:
+        periods is the list of requested step periods in seconds.
+        edges is a list of the times of the rising edges in microseconds.
+
+    Returns:
+        A dict with 'steps' (rising edges seen), 'requested_ms' and
+        'actual_ms' (time from the first to the last rising edge), and
+        'mean_error_us' and 'max_error_us' (absolute error of the time
+        between edges).
+    """
+
+    intervals = [b - a for a, b in zip(edges, edges[1:])]
+    errors = [abs(interval - period * 1e6)
+              for interval, period in zip(intervals, periods)]
+    return {'steps': len(edges),
+            'requested_ms': sum(periods[:len(edges) - 1]) * 1e3,
+            'actual_ms': (edges[-1] - edges[0]) / 1e3 if edges else 0.0,
+            'mean_error_us': sum(errors) / len(errors) if errors else 0.0,
+            'max_error_us': max(errors) if errors else 0.0}
+
+
+class SoftwarePulses(object):
+    """Pulse generator that sets the pins itself and sleeps between edges."""
+
+    def __init__(self, gpio, clock):
+        """Args:
+            gpio is the RPi.GPIO module (or an object with the same
+            interface).
+            clock is a timing.SystemClock() or simulator.SimClock().
+        """
+
+        self._gpio = gpio
+        self._clock = clock
+
+    def play(self, outputs, pin):
+        """Plays a pulse train and waits for it to finish.
+
+        Args:
+            outputs is a list of (pin, value, seconds to wait afterwards).
+            pin is the pin whose rising edges should be timed.
+
+        Returns:
+            A list of the times of the rising edges of pin in microseconds.
+        """
+
+        edges = []
+        for output_pin, value, wait in outputs:
+            self._gpio.output(output_pin, value)
+            if value and output_pin == pin:
+                edges.append(self._clock.monotonic_ns() / 1e3)
+            if wait > 0:
+                self._clock.sleep(wait)
+        return edges
+
+
+class DMAPulses(object):
+    """Pulse generator that sends the train as a DMA-timed pigpio waveform.
+    Edges are timed by the pigpio daemon (to within its 5 us sample rate).
+
+    pigpio sends one waveform at a time, so trains played from several
+    threads (e.g. by the syringe pumps of different chambers) take turns. A
+    waveform holds a few thousand steps at most, so longer moves are split
+    into several waveforms, each sent to start as soon as the one before it
+    ends. Only two are held by the daemon at once (the one playing and the
+    next), so each may use up to half of its pulses and control blocks.
+    """
+
+    def __init__(self, pi):
+        """Args:
+            pi is a connected pigpio.pi() object.
+        """
+
+        import pigpio
+        self._pigpio = pigpio
+        self._pi = pi
+        self._lock = threading.Lock()
+        # Remove any waveforms left by a previous run
+        pi.wave_clear()
+
+    def play(self, outputs, pin):
+        """Same as SoftwarePulses.play()."""
+
+        pigpio = self._pigpio
+        pulses = []
+        pins = set()
+        for output_pin, value, wait in outputs:
+            pins.add(output_pin)
+            mask = 1 << output_pin
+            pulses.append(pigpio.pulse(mask if value else 0,
+                                       0 if value else mask,
+                                       int(round(wait * 1e6))))
+        for output_pin in pins:
+            self._pi.set_mode(output_pin, pigpio.OUTPUT)
+        n_rising = sum(1 for output_pin, value, wait in outputs
+                       if value and output_pin == pin)
+
+        edges = []
+        with self._lock:
+            self._send(pulses, pin, n_rising, edges)
+        if not edges:
+            return []
+        # Ticks are unsigned 32 bit microseconds, so they can wrap around
+        return [edges[0] + ((tick - edges[0]) & 0xFFFFFFFF) for tick in edges]
+
+    def _chunk_size(self):
+        """The most pulses to put in one waveform."""
+
+        # A pulse takes up to 3 control blocks, and two waveforms are held
+        # at once
+        return max(1, min(self._pi.wave_get_max_pulses(),
+                          self._pi.wave_get_max_cbs() // 3) // 2)
+
+    def _send(self, pulses, pin, n_rising, edges):
+        pigpio = self._pigpio
+        callback = self._pi.callback(pin, pigpio.RISING_EDGE,
+                                     lambda gpio, level, tick:
+                                     edges.append(tick))
+        size = self._chunk_size()
+        waves = []
+        try:
+            for start in range(0, len(pulses), size):
+                self._pi.wave_add_generic(pulses[start:start + size])
+                waves.append(self._pi.wave_create())
+                # Starts when the waveform before it ends
+                self._pi.wave_send_using_mode(waves[-1],
+                                              pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+                if len(waves) > 1:
+                    while self._pi.wave_tx_at() == waves[0]:
+                        sleep(0.001)
+                    self._pi.wave_delete(waves.pop(0))
+            while self._pi.wave_tx_busy():
+                sleep(0.001)
+            for wave in waves:
+                self._pi.wave_delete(wave)
+            # Give the daemon time to report the last edges
+            for j in range(100):
+                if len(edges) >= n_rising:
+                    break
+                sleep(0.001)
+        finally:
+            callback.cancel()
+        return None
+
+
+class StepperDriver(object):
+    """Step/direction stepper motor driver with microstep select pins."""
+
+    FORWARD = False
+    BACKWARD = True
+
+    def __init__(self, gpio, pulses, pin_step, pin_dir, pin_ms1, pin_ms2,
+                 frequency=500, start_frequency=None, ramp_steps=0,
+                 microstep=8):
+        """Sets up the pins.
+
+        Args:
+            gpio is the RPi.GPIO module (or an object with the same
+            interface), already in BCM mode.
+            pulses is a DMAPulses() or SoftwarePulses() object.
+            pin_step, pin_dir, pin_ms1 and pin_ms2 are the driver's GPIO
+            pins.
+            frequency, start_frequency and ramp_steps are as for
+            step_periods().
+            microstep is the microstep resolution (1, 2, 4 or 8).
+
+        Raises:
+            ValueError: microstep is not a supported resolution, or the
+            frequencies are not as step_periods() needs.
+        """
+
+        step_periods(0, frequency, start_frequency, ramp_steps)
+        self._gpio = gpio
+        self.pulses = pulses
+        self.pin_step = pin_step
+        self.pin_dir = pin_dir
+        self.pin_ms1 = pin_ms1
+        self.pin_ms2 = pin_ms2
+        self.frequency = frequency
+        self.start_frequency = start_frequency
+        self.ramp_steps = ramp_steps
+        for pin in (pin_step, pin_dir, pin_ms1, pin_ms2):
+            gpio.setup(pin, gpio.OUT)
+        gpio.output(pin_step, False)
+        gpio.output(pin_dir, StepperDriver.FORWARD)
+        self.set_microstep(microstep)
+
+    def set_microstep(self, microstep):
+        """Sets the microstep resolution (1, 2, 4 or 8)."""
+
+        if microstep not in MICROSTEPS:
+            raise ValueError("Microstep must be one of %s, got %s."
+                             % (sorted(MICROSTEPS), microstep))
+        ms1, ms2 = MICROSTEPS[microstep]
+        self._gpio.output(self.pin_ms1, ms1)
+        self._gpio.output(self.pin_ms2, ms2)
+        self.microstep = microstep
+        return None
+
+    def outputs(self, steps):
+        """The pulse train for a move, as (pin, value, seconds to wait
+        afterwards) tuples with a 50% duty cycle."""
+
+        outputs = []
+        for period in step_periods(steps, self.frequency,
+                                   self.start_frequency, self.ramp_steps):
+            outputs.append((self.pin_step, True, period / 2))
+            outputs.append((self.pin_step, False, period / 2))
+        return outputs
+
+    @tracing.traced
+    def move(self, steps, direction=FORWARD):
+        """Moves the motor and waits for the move to finish.
+
+        Args:
+            steps is the number of (micro)steps to move.
+            direction is StepperDriver.FORWARD or StepperDriver.BACKWARD.
+
+        Returns:
+            A timing report (see timing_report()).
+        """
+
+        self._gpio.output(self.pin_dir, direction)
+        periods = step_periods(steps, self.frequency, self.start_frequency,
+                               self.ramp_steps)
+        edges = self.pulses.play(self.outputs(steps), self.pin_step)
+        return timing_report(periods, edges)
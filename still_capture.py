@@ -0,0 +1,240 @@
+"""Pictures of drops, taken and saved away from the lick callback.
+
+camera.capture() takes hundreds of milliseconds (longer if the SD card is
+busy), which used to hold up the lick callback. Instead, the callback only
+posts a request to a StillCapture:
+
+    Capture thread - Takes each requested picture from the camera's video
+        port (use_video_port=True, which is fast and does not interrupt
+        video recording) as a JPEG into one of a fixed pool of preallocated
+        buffers.
+    Writer thread - Writes full buffers to their files and hands them back
+        to the pool.
+
+When licks come faster than pictures can be saved, the backlog is bounded:
+
+    - A request within coalesce_ms of the request still waiting to be
+      taken shares its picture (it is saved under the earlier name).
+    - Otherwise, if max_queue requests are already waiting, the new request
+      is dropped.
+    - If every buffer is waiting to be written, the capture thread waits
+      for one, so a slow SD card fills the request queue rather than memory.
+
+Queue depth and the latency from request to picture are measured for every
+picture. On the simulated cage (threaded=False), pictures are taken and
+saved by an event on the virtual clock instead of by threads.
+
+"""
+
+import io
+import os
+import queue
+import logging
+import threading
+import tracing
+
+log = logging.getLogger('piDose.camera')
+
+
+class StillRequest(object):
+    """A requested picture, with the monotonic times (ns) it was requested
+    and taken."""
+
+    def __init__(self, path, requested_ns):
+        self.path = path
+        self.requested_ns = requested_ns
+        self.captured_ns = None
+        self.requests = 1
+
+
+class StillCapture(object):
+    """Takes and saves pictures on background threads."""
+
+    def __init__(self, camera, clock, max_queue=4, n_buffers=4,
+                 coalesce_ms=500, buffer_size=256 * 1024, threaded=True):
+        """Starts the capture and writer threads.
+
+        Args:
+            camera is the picamera.PiCamera() (or CameraBackend) to take
+            pictures with.
+            clock is the clock (a timing.SystemClock() or
+            simulator.SimClock()).
+            max_queue is the most requests that can wait to be taken.
+            n_buffers is the number of picture buffers.
+            coalesce_ms is the time in milliseconds within which requests
+            share a picture.
+            buffer_size is the number of bytes to preallocate for each
+            picture (a buffer grows if a picture is larger).
+            threaded is False to take pictures from events on the clock
+            (which must then have schedule() and seconds(), as SimClock
+            does).
+        """
+
+        self._camera = camera
+        self._clock = clock
+        self.max_queue = max_queue
+        self.coalesce_ms = coalesce_ms
+        self.threaded = threaded
+        self._lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._waiting = []
+        self._buffers = queue.Queue()
+        for j in range(n_buffers):
+            buffer = io.BytesIO(bytes(buffer_size))
+            self._buffers.put(buffer)
+        self._full = queue.Queue()
+        self.reset_stats()
+        if threaded:
+            self._capture_thread = threading.Thread(target=self._capture_run,
+                                                    name='StillCapture',
+                                                    daemon=True)
+            self._writer_thread = threading.Thread(target=self._writer_run,
+                                                   name='StillWriter',
+                                                   daemon=True)
+            self._capture_thread.start()
+            self._writer_thread.start()
+
+    def request(self, path):
+        """Asks for a picture now. Returns straight away.
+
+        Args:
+            path is a string containing the location to save the picture to.
+
+        Returns:
+            True if the picture will be saved (possibly under the name of an
+            earlier request), False if it was dropped because the queue was
+            full.
+        """
+
+        now_ns = self._clock.monotonic_ns()
+        with self._lock:
+            if (self._waiting and now_ns - self._waiting[-1].requested_ns
+                    <= self.coalesce_ms * 1e6):
+                self._waiting[-1].requests += 1
+                self._coalesced += 1
+                return True
+            if len(self._waiting) >= self.max_queue:
+                self._dropped += 1
+                return False
+            request = StillRequest(path, now_ns)
+            self._waiting.append(request)
+            self._max_depth = max(self._max_depth, len(self._waiting))
+        if self.threaded:
+            self._requests.put(request)
+        else:
+            self._clock.schedule(self._clock.seconds(),
+                                 lambda: self._take(request))
+        return True
+
+    def _capture(self, request):
+        """Takes a picture into a free buffer. Returns the buffer, or None
+        if the picture could not be taken."""
+
+        buffer = self._buffers.get()
+        with self._lock:
+            self._waiting.remove(request)
+        buffer.seek(0)
+        try:
+            with tracing.span('camera.capture'):
+                self._camera.capture(buffer, format='jpeg',
+                                     use_video_port=True)
+        except Exception as e:
+            log.error("Error taking picture %s: %s", request.path, e)
+            self._buffers.put(buffer)
+            return None
+        request.captured_ns = self._clock.monotonic_ns()
+        return buffer
+
+    def _write(self, request, buffer):
+        """Saves a picture and returns its buffer to the pool."""
+
+        size = buffer.tell()
+        try:
+            os.makedirs(os.path.dirname(request.path), exist_ok=True)
+            with open(request.path, 'wb') as file, \
+                 buffer.getbuffer() as view:
+                file.write(view[:size])
+        except Exception as e:
+            log.error("Error saving picture %s: %s", request.path, e)
+        finally:
+            self._buffers.put(buffer)
+        latency_ms = (request.captured_ns - request.requested_ns) / 1e6
+        with self._lock:
+            self._saved += 1
+            self._latency_sum += latency_ms
+            self._latency_max = max(self._latency_max, latency_ms)
+        return None
+
+    def _take(self, request):
+        """Takes and saves one picture. Used when not threaded."""
+
+        buffer = self._capture(request)
+        if buffer is not None:
+            self._write(request, buffer)
+        return None
+
+    def _capture_run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                self._full.put(None)
+                return None
+            buffer = self._capture(request)
+            if buffer is not None:
+                self._full.put((request, buffer))
+
+    def _writer_run(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                return None
+            self._write(*item)
+
+    def depth(self):
+        """The number of requests waiting to be taken."""
+
+        with self._lock:
+            return len(self._waiting)
+
+    def reset_stats(self):
+        """Clears the picture statistics."""
+
+        with self._lock:
+            self._saved = 0
+            self._coalesced = 0
+            self._dropped = 0
+            self._max_depth = 0
+            self._latency_sum = 0.0
+            self._latency_max = 0.0
+        return None
+
+    def stats(self):
+        """Statistics of the pictures since the last reset.
+
+        Returns:
+            A dict with 'saved', 'coalesced' (requests that shared a
+            picture), 'dropped' (requests refused because the queue was
+            full), 'max_depth' (most requests waiting at once), and
+            'mean_latency_ms' and 'max_latency_ms' (from request to picture)
+            as floats.
+        """
+
+        with self._lock:
+            n = self._saved
+            return {'saved': n, 'coalesced': self._coalesced,
+                    'dropped': self._dropped, 'max_depth': self._max_depth,
+                    'mean_latency_ms': self._latency_sum / n if n else 0.0,
+                    'max_latency_ms': self._latency_max}
+
+    def close(self):
+        """Takes and saves the requested pictures, then stops the threads.
+
+        Returns:
+            None.
+        """
+
+        if self.threaded:
+            self._requests.put(None)
+            self._capture_thread.join()
+            self._writer_thread.join()
+        return None
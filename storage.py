@@ -0,0 +1,736 @@
+"""Storage backends for PiDose event, weight, summary and mouse records.
+
+Two backends are provided, both with the same methods:
+
+    TextStorage - The original layout of tab-separated text files under the
+        data directory (one folder per mouse). This is the default.
+    SQLiteStorage - A single SQLite database in WAL mode holding all the
+        record types, indexed on (mouse, timestamp) so data can be queried
+        without parsing text files. Rows are buffered and committed in
+        batches, and the commit (and therefore fsync) interval is
+        configurable.
+
+Use open_storage() to create the backend named in the PiDose constants.
+
+AsyncWriter wraps either backend so that records are handed to a background
+thread through a bounded queue. Code running on the GPIO interrupt thread
+(the lick callback) then only enqueues a record and never waits on the SD
+card.
+
+"""
+
+import os
+import sqlite3
+import threading
+import collections
+import copy
+import queue
+import logging
+from concurrent.futures import Future
+from time import monotonic
+import numpy as np
+import weight_log
+from weight_histogram import WeightHistogram
+from timing import SystemClock
+
+log = logging.getLogger('piDose.storage')
+
+
+class TextStorage(object):
+    """Stores records in the per-mouse text files under the data directory.
+
+    Layout:
+        <data_dir>/<mouse>/<mouse>_data.txt
+        <data_dir>/<mouse>/<mouse>_summary.txt
+        <data_dir>/<mouse>/Weights/<mouse>_weights_day<N>.txt
+        <data_dir>/<mouse>/Weights/<mouse>_plateaus_day<N>.txt
+        <data_dir>/<mouse>/Weights/<mouse>_histogram_day<N>.npz
+
+    If weight_format is 'binary', weight logs are instead written in the
+    binary format of weight_log.py, as <mouse>_weights_day<N>.bin.
+
+    Data and weight files are kept open between writes (up to max_open_files
+    of them, least recently used are closed first) rather than being opened
+    and closed for every line. Lines are buffered until flush() is called.
+    """
+
+    def __init__(self, data_dir, weight_format='text', max_open_files=16):
+        """Args:
+            data_dir is a string containing the root data directory.
+            weight_format is either 'text' or 'binary'.
+            max_open_files is the number of file handles kept open.
+
+        Raises:
+            ValueError: weight_format is not a known format.
+        """
+
+        if weight_format not in ('text', 'binary'):
+            raise ValueError("Unknown weight log format '%s'."
+                             % (weight_format))
+        self.data_dir = data_dir
+        self.weight_format = weight_format
+        self.max_open_files = max_open_files
+        self._files = collections.OrderedDict()
+
+    def _mouse_path(self, mouse_name, filename):
+        return os.path.join(self.data_dir, mouse_name, filename)
+
+    def _weights_path(self, mouse_name, day_count):
+        return os.path.join(self.data_dir, mouse_name, 'Weights',
+                            '%s_weights_day%d.%s' % (mouse_name, day_count,
+                            'bin' if self.weight_format == 'binary'
+                            else 'txt'))
+
+    def record_event(self, mouse_name, timestamp, event):
+        """Appends an event line to the mouse's data file.
+
+        Args:
+            mouse_name is a string containing the name of the mouse.
+            timestamp is a datetime.datetime() object.
+            event is a string containing the event code.
+
+        Returns:
+            None.
+        """
+
+        file = self._open(self._mouse_path(mouse_name, '%s_data.txt'
+                                           % (mouse_name)))
+        file.write(str(timestamp) + '\t' + event + '\n')
+        return None
+
+    def record_weight(self, mouse_name, day_count, timestamp, weight):
+        """Appends a weight sample to the mouse's weight file for the day.
+
+        Args:
+            mouse_name is a string containing the name of the mouse.
+            day_count is an int giving the mouse's day in the cage.
+            timestamp is a datetime.datetime() object.
+            weight is a float containing the weight in grams.
+
+        Returns:
+            None.
+        """
+
+        path = self._weights_path(mouse_name, day_count)
+        if self.weight_format == 'binary':
+            self._open(path, weight_log.WeightLogWriter).write(timestamp,
+                                                               weight)
+        else:
+            self._open(path).write(str(timestamp) + '\t' + str(weight) + '\n')
+        return None
+
+    def record_plateau(self, mouse_name, day_count, start, end, n, mean, sd):
+        """Appends a weight plateau (see plateau.py) to the mouse's plateau
+        file for the day.
+
+        Args:
+            mouse_name is a string containing the name of the mouse.
+            day_count is an int giving the mouse's day in the cage.
+            start and end are datetime.datetime() objects giving the times
+            of the plateau's first and last samples.
+            n is the number of samples in the plateau.
+            mean and sd are floats containing the mean and standard
+            deviation of the samples in grams.
+
+        Returns:
+            None.
+        """
+
+        path = os.path.join(self.data_dir, mouse_name, 'Weights',
+                            '%s_plateaus_day%d.txt' % (mouse_name, day_count))
+        self._open(path).write('%s\t%s\t%i\t%.3f\t%.3f\n'
+                               % (start, end, n, mean, sd))
+        return None
+
+    def record_summary(self, mouse_name, day_count, water_drops, drug_drops,
+                       required_drug_drops, weight):
+        """Appends a line for the previous day to the mouse's summary file.
+
+        Args:
+            mouse_name is a string containing the name of the mouse.
+            day_count is an int giving the day being summarized.
+            water_drops, drug_drops and required_drug_drops are ints.
+            weight is a float containing the average weight for the day.
+
+        Returns:
+            None.
+        """
+
+        with open(self._mouse_path(mouse_name, '%s_summary.txt'
+                                   % (mouse_name)), 'a') as summary_file:
+            if day_count == 0:
+                summary_file.write("Summary file for %s\n\n" %(mouse_name))
+                summary_file.write("Day\tTotal Drops\tWater Drops\t"
+                                   "Drug Drops\tRequired Drug Drops\t"
+                                   "Average Weight\n")
+            data = (str(day_count) + '\t' + str(water_drops + drug_drops) +
+                    '\t\t' + str(water_drops) + '\t\t' + str(drug_drops) +
+                    '\t\t' + str(required_drug_drops) + '\t\t\t' +
+                    str(weight) + '\n')
+            summary_file.write(data)
+        return None
+
+    def save_mouse(self, mouse):
+        """Mouse state is kept in mice.cfg by the registry, nothing to do."""
+
+        return None
+
+    def read_weights(self, mouse_name, day_count):
+        """Reads every weight sample recorded for a mouse on a given day.
+
+        Args:
+            mouse_name is a string containing the name of the mouse.
+            day_count is an int giving the mouse's day in the cage.
+
+        Returns:
+            A list of weights in grams (as floats).
+        """
+
+        path = self._weights_path(mouse_name, day_count)
+        if path in self._files:
+            self._files[path].flush()
+        if self.weight_format == 'binary':
+            return weight_log.read_weights(path).tolist()
+        weights = []
+        with open(path, 'r') as weight_file:
+            for line in weight_file:
+                line = line.replace('\n', '').split('\t')
+                try:
+                    weights.append(float(line[1]))
+                except IndexError:
+                    continue
+        return weights
+
+    def _histogram_path(self, mouse_name, day_count):
+        return os.path.join(self.data_dir, mouse_name, 'Weights',
+                            '%s_histogram_day%d.npz' % (mouse_name, day_count))
+
+    def _log_size(self, mouse_name, day_count):
+        """Size in bytes of the mouse's weight log for the day (0 if there
+        is none), after flushing it."""
+
+        path = self._weights_path(mouse_name, day_count)
+        if path in self._files:
+            self._files[path].flush()
+        if not os.path.exists(path):
+            return 0
+        return os.path.getsize(path)
+
+    def save_histogram(self, mouse_name, day_count, histogram):
+        """Saves a mouse's weight histogram for a day, replacing the previous
+        one atomically. The size of the day's weight log is saved with it.
+
+        Args:
+            mouse_name is a string containing the name of the mouse.
+            day_count is an int giving the mouse's day in the cage.
+            histogram is a WeightHistogram() object.
+
+        Returns:
+            None.
+        """
+
+        path = self._histogram_path(mouse_name, day_count)
+        with open(path + '.tmp', 'wb') as file:
+            np.savez(file, lower=histogram.lower, upper=histogram.upper,
+                     counts=histogram.counts,
+                     log_size=self._log_size(mouse_name, day_count))
+        os.replace(path + '.tmp', path)
+        return None
+
+    def load_histogram(self, mouse_name, day_count, lower, upper):
+        """Loads a mouse's weight histogram for a day.
+
+        Args:
+            mouse_name is a string containing the name of the mouse.
+            day_count is an int giving the mouse's day in the cage.
+            lower and upper are the weight limits the histogram should have.
+
+        Returns:
+            A WeightHistogram() object, or None if there is no saved histogram
+            with the same weight limits, or if the weight log has changed
+            since it was saved (e.g. samples were recorded after the last
+            save before a crash), in which case the histogram should be
+            rebuilt from the log.
+        """
+
+        path = self._histogram_path(mouse_name, day_count)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if data['lower'] != lower or data['upper'] != upper:
+                return None
+            if ('log_size' not in data.files or
+                    data['log_size'] != self._log_size(mouse_name,
+                                                       day_count)):
+                return None
+            return WeightHistogram(lower, upper, data['counts'])
+
+    def _open(self, path, opener=None):
+        """Returns a cached append handle for path, opening it if needed.
+
+        Args:
+            path is a string containing the file location.
+            opener is called with path to open the file (defaults to opening
+            a text file for appending).
+        """
+
+        file = self._files.get(path)
+        if file is None:
+            if len(self._files) >= self.max_open_files:
+                self._files.popitem(last=False)[1].close()
+            if opener is None:
+                file = open(path, 'a')
+            else:
+                file = opener(path)
+            self._files[path] = file
+        else:
+            self._files.move_to_end(path)
+        return file
+
+    def flush(self):
+        """Writes buffered lines in all open files out to disk."""
+
+        for file in self._files.values():
+            file.flush()
+        return None
+
+    def tick(self):
+        """Called regularly by AsyncWriter. Writes buffered lines out, as
+        flush() does."""
+
+        return self.flush()
+
+    def close(self):
+        for file in self._files.values():
+            file.close()
+        self._files.clear()
+        return None
+
+
+class SQLiteStorage(object):
+    """Stores all records in a single SQLite database in WAL mode.
+
+    Timestamps are stored as integer microseconds since the epoch. Writes are
+    buffered and committed together once sync_interval seconds have passed
+    since the last commit, or once batch_size rows are waiting, whichever
+    comes first. The database runs with synchronous=FULL, so each commit is
+    one fsync and sync_interval directly sets how often the disk is synced
+    (and so how much data a power cut can lose).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            mouse TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            event TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS events_mouse_timestamp
+            ON events (mouse, timestamp);
+        CREATE TABLE IF NOT EXISTS weights (
+            mouse TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            weight REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS weights_mouse_timestamp
+            ON weights (mouse, timestamp);
+        CREATE INDEX IF NOT EXISTS weights_mouse_day ON weights (mouse, day);
+        CREATE TABLE IF NOT EXISTS plateaus (
+            mouse TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            start_timestamp INTEGER NOT NULL,
+            end_timestamp INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            mean REAL NOT NULL,
+            sd REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS plateaus_mouse_timestamp
+            ON plateaus (mouse, start_timestamp);
+        CREATE TABLE IF NOT EXISTS summaries (
+            mouse TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            water_drops INTEGER NOT NULL,
+            drug_drops INTEGER NOT NULL,
+            required_drug_drops INTEGER NOT NULL,
+            weight REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS summaries_mouse_timestamp
+            ON summaries (mouse, timestamp);
+        CREATE TABLE IF NOT EXISTS histograms (
+            mouse TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            lower REAL NOT NULL,
+            upper REAL NOT NULL,
+            counts BLOB NOT NULL,
+            samples INTEGER NOT NULL DEFAULT -1,
+            PRIMARY KEY (mouse, day));
+        CREATE TABLE IF NOT EXISTS mice (
+            tag TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            treatment TEXT NOT NULL,
+            mouse_day INTEGER NOT NULL,
+            day_count INTEGER NOT NULL,
+            drug_drops INTEGER NOT NULL,
+            water_drops INTEGER NOT NULL,
+            required_drug_drops INTEGER NOT NULL,
+            weight REAL NOT NULL,
+            timestamp INTEGER NOT NULL);
+        """
+
+    def __init__(self, path, sync_interval=5, batch_size=500, clock=None):
+        """Opens (creating if needed) the database.
+
+        Args:
+            path is a string containing the location of the database file.
+            sync_interval is the maximum time in seconds between commits.
+            batch_size is the maximum number of buffered rows before a commit.
+            clock is the clock that the times of summary and mouse rows are
+            taken from (defaults to timing.SystemClock()).
+        """
+
+        self.path = path
+        self.clock = SystemClock() if clock is None else clock
+        self.sync_interval = sync_interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.executescript(self.SCHEMA)
+        # Databases from before histograms were checked against the weights
+        columns = [row[1] for row in
+                   self._conn.execute('PRAGMA table_info(histograms)')]
+        if 'samples' not in columns:
+            self._conn.execute('ALTER TABLE histograms ADD COLUMN samples '
+                               'INTEGER NOT NULL DEFAULT -1')
+        self._pending = {'events': [], 'weights': [], 'plateaus': [],
+                         'summaries': [], 'histograms': [], 'mice': []}
+        self._n_pending = 0
+        self._last_commit = monotonic()
+
+    @staticmethod
+    def _epoch_us(timestamp):
+        return int(round(timestamp.timestamp() * 1e6))
+
+    def _add(self, table, row):
+        with self._lock:
+            self._pending[table].append(row)
+            self._n_pending += 1
+            if (self._n_pending >= self.batch_size or
+                monotonic() - self._last_commit >= self.sync_interval):
+                self._commit()
+        return None
+
+    def _commit(self):
+        """Writes all buffered rows in one transaction. Caller holds lock."""
+
+        if self._n_pending:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(
+                'INSERT INTO events VALUES (?, ?, ?)', self._pending['events'])
+            self._conn.executemany(
+                'INSERT INTO weights VALUES (?, ?, ?, ?)',
+                self._pending['weights'])
+            self._conn.executemany(
+                'INSERT INTO plateaus VALUES (?, ?, ?, ?, ?, ?, ?)',
+                self._pending['plateaus'])
+            self._conn.executemany(
+                'INSERT INTO summaries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                self._pending['summaries'])
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO histograms VALUES '
+                '(?, ?, ?, ?, ?, ?)',
+                self._pending['histograms'])
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO mice VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self._pending['mice'])
+            self._conn.execute('COMMIT')
+            for rows in self._pending.values():
+                del rows[:]
+            self._n_pending = 0
+        self._last_commit = monotonic()
+        return None
+
+    def record_event(self, mouse_name, timestamp, event):
+        self._add('events', (mouse_name, self._epoch_us(timestamp), event))
+        return None
+
+    def record_weight(self, mouse_name, day_count, timestamp, weight):
+        self._add('weights', (mouse_name, day_count,
+                              self._epoch_us(timestamp), weight))
+        return None
+
+    def record_plateau(self, mouse_name, day_count, start, end, n, mean, sd):
+        self._add('plateaus', (mouse_name, day_count, self._epoch_us(start),
+                               self._epoch_us(end), n, mean, sd))
+        return None
+
+    def record_summary(self, mouse_name, day_count, water_drops, drug_drops,
+                       required_drug_drops, weight):
+        self._add('summaries', (mouse_name, day_count,
+                                self._epoch_us(self.clock.now()), water_drops,
+                                drug_drops, required_drug_drops, weight))
+        return None
+
+    def save_mouse(self, mouse):
+        """Stores the current state of a mouse (a MouseRecord)."""
+
+        self._add('mice', (mouse.tag, mouse.name, mouse.treatment,
+                           mouse.mouse_day, mouse.day_count, mouse.drug_drops,
+                           mouse.water_drops, mouse.required_drug_drops,
+                           mouse.weight, self._epoch_us(self.clock.now())))
+        return None
+
+    def _count_weights(self, mouse_name, day_count):
+        """Number of weight rows for a mouse and day, counting the rows not
+        yet committed. Caller holds lock."""
+
+        committed = self._conn.execute(
+            'SELECT COUNT(*) FROM weights WHERE mouse = ? AND day = ?',
+            (mouse_name, day_count)).fetchone()[0]
+        return committed + sum(1 for row in self._pending['weights']
+                               if row[0] == mouse_name and
+                               row[1] == day_count)
+
+    def save_histogram(self, mouse_name, day_count, histogram):
+        """Stores a mouse's weight histogram for a day with the number of
+        weight rows it was saved after (see TextStorage.save_histogram())."""
+
+        with self._lock:
+            samples = self._count_weights(mouse_name, day_count)
+        self._add('histograms', (mouse_name, day_count, histogram.lower,
+                                 histogram.upper,
+                                 histogram.counts.astype('<i8').tobytes(),
+                                 samples))
+        return None
+
+    def load_histogram(self, mouse_name, day_count, lower, upper):
+        with self._lock:
+            samples = self._count_weights(mouse_name, day_count)
+            # The last histogram saved may not be committed yet
+            pending = [row[2:] for row in self._pending['histograms']
+                       if row[0] == mouse_name and row[1] == day_count]
+            if pending:
+                row = pending[-1]
+            else:
+                row = self._conn.execute(
+                    'SELECT lower, upper, counts, samples FROM histograms '
+                    'WHERE mouse = ? AND day = ?', (mouse_name, day_count)
+                    ).fetchone()
+        if (row is None or row[0] != lower or row[1] != upper or
+                row[3] != samples):
+            return None
+        return WeightHistogram(lower, upper, np.frombuffer(row[2], '<i8'))
+
+    def read_weights(self, mouse_name, day_count):
+        with self._lock:
+            self._commit()
+            rows = self._conn.execute(
+                'SELECT weight FROM weights WHERE mouse = ? AND day = ? '
+                'ORDER BY timestamp', (mouse_name, day_count)).fetchall()
+        return [row[0] for row in rows]
+
+    def flush(self):
+        """Commits any buffered rows."""
+
+        with self._lock:
+            self._commit()
+        return None
+
+    def tick(self):
+        """Called regularly by AsyncWriter. Commits any buffered rows once
+        sync_interval seconds have passed since the last commit, so rows
+        added during a quiet spell are not held back for long."""
+
+        with self._lock:
+            if (self._n_pending and
+                    monotonic() - self._last_commit >= self.sync_interval):
+                self._commit()
+        return None
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+        return None
+
+
+class AsyncWriter(object):
+    """Runs a storage backend on a background thread fed by a bounded queue.
+
+    Calls to the record methods only put the record on the queue and return.
+    The writer thread applies records to the backend in order and calls the
+    backend's tick() once flush_size records have been written or
+    flush_interval seconds have passed since the last tick, so bursts of
+    records are written out together. The backend decides what a tick does
+    (TextStorage writes out its buffered lines, SQLiteStorage commits only
+    when its own sync_interval is up). read_weights(), flush() and close()
+    are also run on the writer thread, after everything queued before them,
+    and wait for it to finish. flush() forces everything out to disk, and is
+    kept for rollover and shutdown.
+
+    If the queue is ever full, callers block until there is space rather than
+    losing records.
+    """
+
+    def __init__(self, backend, max_queue=10000, flush_size=100,
+                 flush_interval=1.0, timers=None):
+        """Starts the writer thread.
+
+        Args:
+            backend is a TextStorage or SQLiteStorage object.
+            max_queue is the maximum number of records waiting to be written.
+            flush_size is the number of records written between ticks.
+            flush_interval is the maximum time in seconds between ticks.
+            timers is a dict of backend method names (e.g. 'record_event')
+            and functions to call, on the writer thread, with the time in
+            seconds each call of that method took (e.g. the observe() of a
+            metrics histogram).
+        """
+
+        self.backend = backend
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.timers = timers or {}
+        self._queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run, name='AsyncWriter',
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        n_unflushed = 0
+        last_flush = monotonic()
+        while True:
+            timeout = max(0, self.flush_interval - (monotonic() - last_flush))
+            try:
+                method, args, future = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                method = None
+            if method is not None:
+                start = monotonic()
+                try:
+                    if callable(method):
+                        result = method(*args)
+                    else:
+                        result = getattr(self.backend, method)(*args)
+                except Exception as e:
+                    if future is None:
+                        log.error("Error writing %s record: %s",
+                                  getattr(method, '__name__', method), e)
+                    else:
+                        future.set_exception(e)
+                else:
+                    if method in self.timers:
+                        self.timers[method](monotonic() - start)
+                    if future is not None:
+                        future.set_result(result)
+                if method == 'close':
+                    return None
+                n_unflushed = 0 if method == 'flush' else n_unflushed + 1
+            if n_unflushed and (n_unflushed >= self.flush_size or
+                                monotonic() - last_flush >=
+                                self.flush_interval):
+                try:
+                    self.backend.tick()
+                except Exception as e:
+                    log.error("Error writing out records: %s", e)
+                n_unflushed = 0
+            if n_unflushed == 0:
+                last_flush = monotonic()
+
+    def _call(self, method, *args):
+        """Queues a method call and waits for its result."""
+
+        future = Future()
+        self._queue.put((method, args, future))
+        return future.result()
+
+    def call(self, function, *args):
+        """Queues a call of function(*args) on the writer thread, after the
+        records queued before it (e.g. a write that must not hold up the
+        lick callback). Returns straight away."""
+
+        self._queue.put((function, args, None))
+        return None
+
+    def record_event(self, mouse_name, timestamp, event):
+        self._queue.put(('record_event', (mouse_name, timestamp, event), None))
+        return None
+
+    def record_weight(self, mouse_name, day_count, timestamp, weight):
+        self._queue.put(('record_weight', (mouse_name, day_count, timestamp,
+                                           weight), None))
+        return None
+
+    def record_plateau(self, mouse_name, day_count, start, end, n, mean, sd):
+        self._queue.put(('record_plateau', (mouse_name, day_count, start, end,
+                                            n, mean, sd), None))
+        return None
+
+    def record_summary(self, mouse_name, day_count, water_drops, drug_drops,
+                       required_drug_drops, weight):
+        self._queue.put(('record_summary', (mouse_name, day_count,
+                         water_drops, drug_drops, required_drug_drops,
+                         weight), None))
+        return None
+
+    def save_mouse(self, mouse):
+        self._queue.put(('save_mouse', (copy.copy(mouse),), None))
+        return None
+
+    def save_histogram(self, mouse_name, day_count, histogram):
+        histogram = WeightHistogram(histogram.lower, histogram.upper,
+                                    histogram.counts)
+        self._queue.put(('save_histogram', (mouse_name, day_count, histogram),
+                         None))
+        return None
+
+    def load_histogram(self, mouse_name, day_count, lower, upper):
+        return self._call('load_histogram', mouse_name, day_count, lower,
+                          upper)
+
+    def read_weights(self, mouse_name, day_count):
+        return self._call('read_weights', mouse_name, day_count)
+
+    def flush(self):
+        """Waits until every queued record has been written and flushed."""
+
+        return self._call('flush')
+
+    def close(self):
+        """Writes all queued records, closes the backend and stops the
+        writer thread."""
+
+        if self._thread.is_alive():
+            self._call('flush')
+            self._call('close')
+            self._thread.join()
+        return None
+
+
+def open_storage(backend, data_dir, database=None, sync_interval=5,
+                 weight_format='text', clock=None):
+    """Creates the storage backend named by backend.
+
+    Args:
+        backend is either 'text' or 'sqlite'.
+        data_dir is a string containing the root data directory.
+        database is a string containing the SQLite database location (only
+        used by the 'sqlite' backend, defaults to <data_dir>/piDose.db).
+        sync_interval is the maximum time in seconds between SQLite commits.
+        weight_format is the format of weight logs for the 'text' backend,
+        either 'text' or 'binary'.
+        clock is the program's clock (a timing.SystemClock() or
+        simulator.SimClock(), only used by the 'sqlite' backend).
+
+    Returns:
+        A TextStorage or SQLiteStorage object.
+
+    Raises:
+        ValueError: backend is not a known storage backend.
+    """
+
+    if backend == 'text':
+        return TextStorage(data_dir, weight_format)
+    elif backend == 'sqlite':
+        if database is None:
+            database = os.path.join(data_dir, 'piDose.db')
+        return SQLiteStorage(database, sync_interval, clock=clock)
+    raise ValueError("Unknown storage backend '%s'." % (backend))
@@ -0,0 +1,121 @@
+"""Script for measuring the latency overhead of running several chambers from
+one Pi. The same kind of mouse traffic is simulated (see simulator.py) in 1,
+2 and 4 chambers, and for each chamber the delay from each scripted RFID entry
+and lick to its '00' or '01' event in the data file is measured on the
+virtual clock. The simulated devices take their real time to read (load cell,
+RFID reader, drops), so this shows how long one chamber's work holds up
+another's. The CPU time needed per simulated chamber-day is also reported.
+
+Usage: python3 chamber_latency_test.py [days] [mice per chamber]
+
+Run from the PiDose folder, or with it on the PYTHONPATH.
+"""
+import os
+import sys
+import bisect
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import simulator
+from replay import read_events
+
+DAYS = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+MICE = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+# Pins, port and spout electrode of each chamber
+PINS = [{'PIN_RFID_TIR': 27, 'PIN_SCALE_DAT': 17, 'PIN_SCALE_CLK': 22,
+         'PIN_SOLENOID': 6, 'PIN_MOTOR_STEP': 12, 'PIN_MOTOR_DIR': 16,
+         'RFID_PORT': '/dev/serial0', 'CAP_SPOUT_PIN': 0},
+        {'PIN_RFID_TIR': 5, 'PIN_SCALE_DAT': 4, 'PIN_SCALE_CLK': 18,
+         'PIN_SOLENOID': 7, 'PIN_MOTOR_STEP': 13, 'PIN_MOTOR_DIR': 0,
+         'RFID_PORT': '/dev/ttyUSB0', 'CAP_SPOUT_PIN': 1},
+        {'PIN_RFID_TIR': 19, 'PIN_SCALE_DAT': 20, 'PIN_SCALE_CLK': 21,
+         'PIN_SOLENOID': 8, 'PIN_MOTOR_STEP': 14, 'PIN_MOTOR_DIR': 1,
+         'RFID_PORT': '/dev/ttyUSB1', 'CAP_SPOUT_PIN': 2},
+        {'PIN_RFID_TIR': 25, 'PIN_SCALE_DAT': 9, 'PIN_SCALE_CLK': 10,
+         'PIN_SOLENOID': 11, 'PIN_MOTOR_STEP': 15, 'PIN_MOTOR_DIR': 2,
+         'RFID_PORT': '/dev/ttyUSB2', 'CAP_SPOUT_PIN': 3}]
+
+def latencies(recorded, scripted):
+    # Delay from the latest scripted time before each recorded event
+    delays = []
+    for timestamp in recorded:
+        j = bisect.bisect_right(scripted, timestamp) - 1
+        if j >= 0:
+            delays.append((timestamp - scripted[j]).total_seconds() * 1000)
+    return delays
+
+def run(n_chambers):
+    root = tempfile.mkdtemp(prefix='pidose_chambers_')
+    configs = []
+    sim_chambers = []
+    visits = []
+    for k in range(n_chambers):
+        chamber_root = os.path.join(root, 'chamber%i' % (k + 1))
+        tags = simulator.make_colony(chamber_root, MICE, seed=k)
+        for visit in simulator.random_script(tags, DAYS, seed=k):
+            visit.chamber = k
+            visits.append(visit)
+        config = dict(PINS[k])
+        config['MICE_CONFIG'] = os.path.join(chamber_root, 'mice.cfg')
+        config['DATA_DIR'] = os.path.join(chamber_root, 'data')
+        config['SQLITE_DATABASE'] = os.path.join(chamber_root, 'piDose.db')
+        config['TARE_LOG'] = os.path.join(chamber_root, 'tare_weights.txt')
+        configs.append(config)
+        sim_chambers.append(simulator.SimChamber(
+            config['PIN_RFID_TIR'], config['PIN_SCALE_DAT'],
+            config['RFID_PORT'], config['CAP_SPOUT_PIN']))
+    hardware = simulator.SimHardware(visits, chambers=sim_chambers)
+
+    stdout = sys.stdout
+    start = perf_counter()
+    with open(os.path.join(root, 'log.txt'), 'w') as log:
+        sys.stdout = log
+        try:
+            simulator.run(hardware, root, CHAMBERS=configs)
+        finally:
+            sys.stdout = stdout
+    cpu = perf_counter() - start
+
+    entry_delays = []
+    lick_delays = []
+    for k, config in enumerate(configs):
+        entries = {}
+        licks = {}
+        for visit in visits:
+            if visit.chamber != k:
+                continue
+            # Rounded to the microsecond the way SimClock.now() does
+            when = lambda t: hardware.clock.start + simulator.dt.timedelta(
+                microseconds=int((visit.start + t) * 1e9) // 1000)
+            entries.setdefault(visit.tag, []).append(when(0))
+            licks.setdefault(visit.tag, []).extend(when(t)
+                                                   for t in visit.licks)
+        for name in os.listdir(config['DATA_DIR']):
+            path = os.path.join(config['DATA_DIR'], name, name + '_data.txt')
+            if not os.path.exists(path):
+                continue
+            events = read_events(path)
+            with open(config['MICE_CONFIG'], 'r') as file:
+                tag = int([line.split('\t')[0] for line in file
+                           if line.split('\t')[1:2] == [name]][0])
+            entry_delays += latencies([t for t, e in events if e == '00'],
+                                      sorted(entries.get(tag, [])))
+            lick_delays += latencies([t for t, e in events if e == '01'],
+                                     sorted(licks.get(tag, [])))
+    n_licks = sum(len(visit.licks) for visit in visits)
+    return entry_delays, lick_delays, n_licks, cpu, hardware.clock.seconds()
+
+print("Simulating %g day(s) with %i mice per chamber..." % (DAYS, MICE))
+print("Chambers  Entry latency ms (mean/max)  Lick latency ms (mean/max)  "
+      "Licks detected  CPU s per chamber-day")
+for n_chambers in (1, 2, 4):
+    entry_delays, lick_delays, n_licks, cpu, simulated = run(n_chambers)
+    print("%8i  %14.1f / %-10.1f  %13.1f / %-10.1f  %7i / %-6i  %12.2f" % (
+          n_chambers, sum(entry_delays) / max(len(entry_delays), 1),
+          max(entry_delays or [0]),
+          sum(lick_delays) / max(len(lick_delays), 1),
+          max(lick_delays or [0]), len(lick_delays), n_licks,
+          cpu / (n_chambers * simulated / 86400)))
@@ -0,0 +1,48 @@
+"""Script for measuring the CPU usage of a running PiDose program, e.g. to 
+compare versions of piDose.py. Measure once with the chamber empty and once 
+with a mouse (or test tag and weight) in the chamber.
+
+Usage: python3 cpu_usage_test.py [seconds]
+
+Written for Linux (reads /proc).
+"""
+import os
+import sys
+from time import sleep, monotonic
+
+DURATION = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+def find_pidose():
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            with open('/proc/%s/cmdline' % (pid), 'rb') as file:
+                cmdline = file.read().split(b'\x00')
+        except IOError:
+            continue
+        if any(os.path.basename(arg).startswith(b'piDose') and 
+               arg.endswith(b'.py') for arg in cmdline):
+            return int(pid)
+    return None
+
+def cpu_ticks(pid):
+    with open('/proc/%i/stat' % (pid), 'r') as file:
+        fields = file.read().rsplit(')', 1)[1].split()
+    # utime and stime are fields 14 and 15 of /proc/<pid>/stat
+    return int(fields[11]) + int(fields[12])
+
+pid = find_pidose()
+if pid is None:
+    print("No running piDose program found.")
+    sys.exit(1)
+
+print("Measuring CPU usage of PID %i for %.0f seconds..." % (pid, DURATION))
+start_ticks = cpu_ticks(pid)
+start_time = monotonic()
+sleep(DURATION)
+used = (cpu_ticks(pid) - start_ticks) / CLOCK_TICKS
+elapsed = monotonic() - start_time
+print("CPU time used: %.2f s in %.1f s (%.1f%% of one core)." 
+      % (used, elapsed, 100 * used / elapsed))
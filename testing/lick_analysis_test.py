@@ -0,0 +1,198 @@
+"""Script for checking and benchmarking the lick bout analysis (see
+lick_analysis.py).
+
+Generates a colony's event logs for a number of days (visits of bouts of
+licks, with drops limited by WATER_TIMEOUT as in piDose.py), or reads them
+from an export folder (see export.py), then summarizes each mouse's days
+with lick_analysis.daily_summary() and with a plain Python loop over the
+events, checks that both give the same results, and reports the time each
+took.
+
+Usage: python3 lick_analysis_test.py [mice] [days] [export folder]
+
+Run from the PiDose folder, or with it on the PYTHONPATH.
+"""
+import os
+import sys
+from time import perf_counter
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import lick_analysis
+
+MICE = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+DAYS = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+EXPORT_DIR = sys.argv[3] if len(sys.argv) > 3 else None
+VISITS_PER_DAY = 30
+WATER_TIMEOUT = 10000
+DAY_MS = 86400000
+
+
+def generate(days, rng):
+    """Generates a mouse's events for a number of days.
+
+    Returns:
+        numpy arrays of the event times (ms), codes and days.
+    """
+
+    n_visits = days * VISITS_PER_DAY
+    slot = DAY_MS // VISITS_PER_DAY
+    entries = (np.arange(n_visits) * slot +
+               rng.integers(0, slot // 2, n_visits))
+    n_bouts = rng.poisson(8, n_visits)
+    bout_visit = np.repeat(np.arange(n_visits), n_bouts)
+    bout_sizes = rng.geometric(1 / 15, len(bout_visit))
+    lick_bout = np.repeat(np.arange(len(bout_visit)), bout_sizes)
+    lick_visit = bout_visit[lick_bout]
+
+    # Time since the previous lick (or the entry, for a visit's first lick)
+    steps = np.maximum(rng.normal(150, 20, len(lick_bout)), 50).astype(
+        np.int64)
+    first_of_bout = np.ones(len(lick_bout), bool)
+    first_of_bout[1:] = lick_bout[1:] != lick_bout[:-1]
+    steps[first_of_bout] = rng.integers(1500, 20000, first_of_bout.sum())
+    first_of_visit = np.ones(len(lick_bout), bool)
+    first_of_visit[1:] = lick_visit[1:] != lick_visit[:-1]
+    steps[first_of_visit] = (rng.exponential(3000, first_of_visit.sum())
+                             .astype(np.int64) + 200)
+    elapsed = np.cumsum(steps)
+    visit_start = np.maximum.accumulate(
+        np.where(first_of_visit, elapsed - steps, 0))
+    lick_times = entries[lick_visit] + elapsed - visit_start
+
+    # Drops, WATER_TIMEOUT ms apart at least
+    accepted = []
+    j = 0
+    while j < len(lick_times):
+        accepted.append(j)
+        j = np.searchsorted(lick_times, lick_times[j] + WATER_TIMEOUT)
+    accepted = np.array(accepted, np.int64)
+
+    exits = entries + 5000
+    last_lick = np.flatnonzero(np.append(first_of_visit[1:], True))
+    exits[lick_visit[last_lick]] = lick_times[last_lick] + 5000
+    times = np.concatenate((entries, lick_times, lick_times[accepted],
+                            exits))
+    codes = np.concatenate((np.zeros(n_visits, np.uint8),
+                            np.ones(len(lick_times), np.uint8),
+                            np.full(len(accepted), 2, np.uint8),
+                            np.full(n_visits, 99, np.uint8)))
+    order = np.lexsort((np.concatenate((
+        np.zeros(n_visits), np.ones(len(lick_times)),
+        np.full(len(accepted), 2), np.full(n_visits, 3))), times))
+    times = times[order]
+    return times, codes[order], times // DAY_MS
+
+
+def python_summary(times, codes, days, n_days, gap_ms):
+    """daily_summary(), one event at a time."""
+
+    visits = [0] * n_days
+    licks = [0] * n_days
+    rejected = [0] * n_days
+    bouts = [0] * n_days
+    bout_licks = [0] * n_days
+    bout_ms = [0] * n_days
+    rate_licks = [0] * n_days
+    rate_ms = [0] * n_days
+    interval_sum = [0] * n_days
+    interval_n = [0] * n_days
+    latency_sum = [0] * n_days
+    latency_n = [0] * n_days
+
+    def end_bout(bout):
+        day, size, first, last = bout
+        bout_licks[day] += size
+        bout_ms[day] += last - first
+        if size > 1:
+            rate_licks[day] += size - 1
+            rate_ms[day] += last - first
+        return None
+
+    entry = None
+    visit_licked = False
+    bout = None
+    previous = None
+    for time, code, day in zip(times, codes, days):
+        if code == 0:
+            visits[day] += 1
+            entry = (time, day)
+            visit_licked = False
+            if bout is not None:
+                end_bout(bout)
+                bout = None
+        elif code == 1:
+            licks[day] += 1
+            rejected[day] += 1
+            if entry is not None and not visit_licked:
+                latency_sum[entry[1]] += time - entry[0]
+                latency_n[entry[1]] += 1
+            visit_licked = True
+            if bout is not None and time - bout[3] <= gap_ms:
+                interval_sum[day] += time - bout[3]
+                interval_n[day] += 1
+                bout[1] += 1
+                bout[3] = time
+            else:
+                if bout is not None:
+                    end_bout(bout)
+                bouts[day] += 1
+                bout = [day, 1, time, time]
+        elif code in (2, 3) and previous == 1:
+            rejected[day] -= 1
+        previous = code
+    if bout is not None:
+        end_bout(bout)
+
+    def ratio(top, bottom, scale=1):
+        return [scale * a / b if b else float('nan')
+                for a, b in zip(top, bottom)]
+
+    return {'visits': visits, 'licks': licks, 'rejected': rejected,
+            'bouts': bouts, 'bout_licks': ratio(bout_licks, bouts),
+            'bout_seconds': ratio(bout_ms, bouts, 1 / 1000),
+            'lick_rate': ratio(rate_licks, rate_ms, 1000),
+            'interval': ratio(interval_sum, interval_n),
+            'first_lick': ratio(latency_sum, latency_n, 1 / 1000)}
+
+
+colony = []
+if EXPORT_DIR is None:
+    rng = np.random.default_rng(1)
+    start = perf_counter()
+    for j in range(MICE):
+        times, codes, days = generate(DAYS, rng)
+        colony.append((times, codes, days, DAYS))
+    print("Generated %i mice for %i days (%i events) in %.1f s."
+          % (MICE, DAYS, sum(len(mouse[0]) for mouse in colony),
+             perf_counter() - start))
+else:
+    for name in sorted(os.listdir(EXPORT_DIR)):
+        dates, times, codes, days = lick_analysis.load_events(EXPORT_DIR,
+                                                              name)
+        if dates:
+            colony.append((times, codes, days, len(dates)))
+    print("Loaded %i mice (%i events) from %s."
+          % (len(colony), sum(len(mouse[0]) for mouse in colony),
+             EXPORT_DIR))
+
+start = perf_counter()
+summaries = [lick_analysis.daily_summary(*mouse) for mouse in colony]
+numpy_time = perf_counter() - start
+
+lists = [(times.tolist(), codes.tolist(), days.tolist(), n_days)
+         for times, codes, days, n_days in colony]
+start = perf_counter()
+baselines = [python_summary(*mouse, lick_analysis.BOUT_GAP_MS)
+             for mouse in lists]
+python_time = perf_counter() - start
+
+mismatches = 0
+for summary, baseline in zip(summaries, baselines):
+    for name, values in summary.items():
+        if not np.allclose(values, baseline[name], equal_nan=True):
+            mismatches += 1
+            print("Mismatch in %s:" % (name), values[:5], baseline[name][:5])
+print("numpy: %.2f s, Python: %.2f s (%.0fx faster), %i mismatches."
+      % (numpy_time, python_time, python_time / numpy_time, mismatches))
@@ -0,0 +1,146 @@
+"""Script for checking and timing the mice.cfg journal (see mouse_registry.py).
+
+For a colony of mice in a temporary folder, this measures the cost of
+recording one drop by appending to the journal (with and without fsync, see
+MICE_JOURNAL_SYNC) against the cost of saving mice.cfg (the only way to make
+a drop count durable before), then simulates a crash after a day's worth
+of drops (leaving a partly written last line) and checks that loading the
+registry recovers the exact counts, reporting how long recovery took. It
+also checks that a crash between saving mice.cfg and starting the new
+journal does not count any drops twice, and that drops whose journal
+lines are appended on another thread (as the lick callback does) are neither
+lost nor counted twice when mice.cfg is saved before they are appended,
+and that a slow journal append in update() does not hold up add().
+
+Run it with the data folder on the SD card to see the times on the Pi.
+
+Usage: python3 mice_journal_test.py [mice] [drops] [folder]
+
+Run from the PiDose folder, or with it on the PYTHONPATH.
+"""
+import os
+import sys
+import random
+import shutil
+import tempfile
+import threading
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from mouse_registry import MouseRegistry
+
+MICE = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+DROPS = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+FOLDER = sys.argv[3] if len(sys.argv) > 3 else None
+
+directory = tempfile.mkdtemp(dir=FOLDER)
+path = os.path.join(directory, 'mice.cfg')
+journal_path = path + '.journal'
+tags = [str(2006010000 + j) for j in range(MICE)]
+with open(path, 'w') as file:
+    file.write('RFID_Tag\tName\tTreat.\tD.ofM.\tD.inC.\tDrugD.\tWaterD.\t'
+               'ReqD.D.\tWeight\n')
+    for j, tag in enumerate(tags):
+        file.write('%s\tM%i\tDRUG\t1\t0\t0\t0\t30\t25.0\n' % (tag, j + 1))
+
+random.seed(1)
+expected = {tag: [0, 0] for tag in tags}
+failures = 0
+
+# Per-drop cost: journal append against a full save
+for sync in (False, True):
+    mice = MouseRegistry(path, journal_path, sync)
+    start = perf_counter()
+    for j in range(DROPS):
+        tag = random.choice(tags)
+        drug = random.random() < 0.2
+        mice.add(tag, 'drug_drops' if drug else 'water_drops')
+        expected[tag][0 if drug else 1] += 1
+    journal_ms = (perf_counter() - start) / DROPS * 1000
+    n = min(DROPS, 200)
+    start = perf_counter()
+    for j in range(n):
+        mice.update(tags[0], weight=25.0)
+        mice.save()
+    save_ms = (perf_counter() - start) / n * 1000
+    print("Recording a drop (sync=%s): %.3f ms (journal), %.3f ms (saving "
+          "mice.cfg), %.0fx faster." % (sync, journal_ms, save_ms,
+                                         save_ms / journal_ms))
+
+# Crash after a day of drops, the last record cut short
+for j in range(DROPS):
+    tag = random.choice(tags)
+    mice.add(tag, 'water_drops')
+    expected[tag][1] += 1
+mice.journal.close()
+with open(journal_path, 'a') as file:
+    file.write('%s\tdrug_dr' % (tags[0]))
+mice = MouseRegistry(path, journal_path)
+ok = all([mice[tag].drug_drops, mice[tag].water_drops] == expected[tag]
+         for tag in tags)
+print("Recovered %i changes in %.1f ms: counts %s." % (
+    mice.recovered, mice.recovery_ms, 'exact' if ok else 'WRONG'))
+failures += not ok
+
+# Crash after replacing mice.cfg, before the new journal was started
+for tag in tags:
+    mice.add(tag, 'water_drops')
+    expected[tag][1] += 1
+old_journal = journal_path + '.old'
+shutil.copy(journal_path, old_journal)
+mice.save()
+mice.journal.close()
+os.replace(old_journal, journal_path)
+mice = MouseRegistry(path, journal_path)
+ok = all([mice[tag].drug_drops, mice[tag].water_drops] == expected[tag]
+         for tag in tags)
+print("Crash during compaction: %i changes replayed, counts %s." % (
+    mice.recovered, 'exact' if ok else 'WRONG'))
+failures += not ok
+
+# Journal lines appended later on another thread, some after a save
+deferred = []
+for j, tag in enumerate(tags):
+    mice.add(tag, 'drug_drops', defer=lambda *call: deferred.append(call))
+    expected[tag][0] += 1
+    if j == len(tags) // 2:
+        mice.save()
+for call in deferred:
+    call[0](*call[1:])
+mice.journal.close()
+mice = MouseRegistry(path, journal_path)
+ok = all([mice[tag].drug_drops, mice[tag].water_drops] == expected[tag]
+         for tag in tags)
+print("Deferred journal lines: %i of %i appended, counts %s." % (
+    mice.recovered, len(deferred), 'exact' if ok else 'WRONG'))
+failures += not ok
+
+# A lick while update() is appending to a slow journal (e.g. an fsync on a
+# busy SD card)
+append = mice.journal.append
+appending = threading.Event()
+
+
+def slow_append(tag, changes):
+    appending.set()
+    sleep(0.2)
+    return append(tag, changes)
+
+
+mice.journal.append = slow_append
+update = threading.Thread(target=mice.update, args=(tags[0],),
+                          kwargs={'weight': 26.0})
+update.start()
+appending.wait()
+start = perf_counter()
+mice.add(tags[1], 'water_drops', defer=lambda *call: None)
+add_ms = (perf_counter() - start) * 1000
+update.join()
+mice.journal.append = append
+print("add() during a 200 ms journal append in update(): %.3f ms, %s." % (
+    add_ms, 'not held up' if add_ms < 100 else 'HELD UP'))
+failures += add_ms >= 100
+mice.close()
+shutil.rmtree(directory)
+sys.exit(1 if failures else 0)
@@ -2,30 +2,36 @@
 
 Written by Cameron Woodard
 """
-import RPi.GPIO as GPIO
-from time import sleep
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from hardware import PiHardware
+from stepper import StepperDriver
 
 PIN_MOTOR_STEP = 12
 PIN_MOTOR_DIR = 16
 PIN_MOTOR_MS1 = 23
 PIN_MOTOR_MS2 = 24
+MOTOR_STEP_FREQUENCY = 500
+MOTOR_START_FREQUENCY = 500
+MOTOR_RAMP_STEPS = 0
+MOTOR_MICROSTEP = 8
 
+hw = PiHardware()
+GPIO = hw.gpio
 GPIO.setmode(GPIO.BCM)
-GPIO.setup(PIN_MOTOR_STEP, GPIO.OUT)
-GPIO.setup(PIN_MOTOR_DIR, GPIO.OUT)
-GPIO.setup(PIN_MOTOR_MS1, GPIO.OUT)
-GPIO.setup(PIN_MOTOR_MS2, GPIO.OUT)
-GPIO.output(PIN_MOTOR_STEP, False)
-GPIO.output(PIN_MOTOR_DIR, False)
-GPIO.output(PIN_MOTOR_MS1,True)
-GPIO.output(PIN_MOTOR_MS2,True)
+motor = StepperDriver(GPIO, hw.pulses(), PIN_MOTOR_STEP, PIN_MOTOR_DIR,
+                      PIN_MOTOR_MS1, PIN_MOTOR_MS2, MOTOR_STEP_FREQUENCY,
+                      MOTOR_START_FREQUENCY, MOTOR_RAMP_STEPS, MOTOR_MICROSTEP)
 
 def spin_motor(num_steps):
-    for y in range(num_steps):
-        GPIO.output(PIN_MOTOR_STEP, True)
-        sleep(0.001)
-        GPIO.output(PIN_MOTOR_STEP, False)
-        sleep(0.001)
+    timing = motor.move(num_steps)
+    print("%i steps in %.1f ms (requested %.1f ms, mean error %.1f us, max "
+          "error %.1f us)." % (timing['steps'], timing['actual_ms'],
+          timing['requested_ms'], timing['mean_error_us'],
+          timing['max_error_us']))
 
 num_steps = int(input('Please enter the number of steps: '))
 
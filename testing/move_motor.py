@@ -3,35 +3,36 @@ continuously in order to get it to the correct position.
 
 Written by Cameron Woodard.
 """
-import RPi.GPIO as GPIO
-from time import sleep
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from hardware import PiHardware
+from stepper import StepperDriver
 
 PIN_MOTOR_STEP = 12
 PIN_MOTOR_DIR = 16
 PIN_MOTOR_MS1 = 23
 PIN_MOTOR_MS2 = 24
+MOTOR_STEP_FREQUENCY = 1000
+MOTOR_MICROSTEP = 8
 
+hw = PiHardware()
+GPIO = hw.gpio
 GPIO.setmode(GPIO.BCM)
-GPIO.setup(PIN_MOTOR_STEP, GPIO.OUT)
-GPIO.setup(PIN_MOTOR_DIR, GPIO.OUT)
-GPIO.setup(PIN_MOTOR_MS1, GPIO.OUT)
-GPIO.setup(PIN_MOTOR_MS2, GPIO.OUT)
-GPIO.output(PIN_MOTOR_STEP, False)
-GPIO.output(PIN_MOTOR_DIR, False)
-GPIO.output(PIN_MOTOR_MS1,True)
-GPIO.output(PIN_MOTOR_MS2,True)
+motor = StepperDriver(GPIO, hw.pulses(), PIN_MOTOR_STEP, PIN_MOTOR_DIR,
+                      PIN_MOTOR_MS1, PIN_MOTOR_MS2, MOTOR_STEP_FREQUENCY,
+                      microstep=MOTOR_MICROSTEP)
 
 try:
     ans = input("Would you like to move motor forward (f) or backwards (b): ")
     if ans.lower() == 'f':
-        GPIO.output(PIN_MOTOR_DIR, False)
+        direction = StepperDriver.FORWARD
     else:
-        GPIO.output(PIN_MOTOR_DIR, True)
+        direction = StepperDriver.BACKWARD
     input("Press enter to begin spinning motor, and then CTRL-C to stop.")
     while True:
-        GPIO.output(PIN_MOTOR_STEP, True)
-        sleep(0.0005)
-        GPIO.output(PIN_MOTOR_STEP, False)
-        sleep(0.0005)
+        motor.move(MOTOR_STEP_FREQUENCY // 10, direction)
 except KeyboardInterrupt:
-    GPIO.cleanup()
\ No newline at end of file
+    GPIO.cleanup()
@@ -3,37 +3,43 @@ syringe pump in order to calibrate drop size.
 
 Written by Cameron Woodard
 """
-import RPi.GPIO as GPIO
+import os
+import sys
 from time import sleep
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from hardware import PiHardware
+from stepper import StepperDriver
+
 PIN_MOTOR_STEP = 12
 PIN_MOTOR_DIR = 16
 PIN_MOTOR_MS1 = 23
 PIN_MOTOR_MS2 = 24
+MOTOR_STEP_FREQUENCY = 500
+MOTOR_START_FREQUENCY = 500
+MOTOR_RAMP_STEPS = 0
+MOTOR_MICROSTEP = 8
 
+hw = PiHardware()
+GPIO = hw.gpio
 GPIO.setmode(GPIO.BCM)
-GPIO.setup(PIN_MOTOR_STEP, GPIO.OUT)
-GPIO.setup(PIN_MOTOR_DIR, GPIO.OUT)
-GPIO.setup(PIN_MOTOR_MS1, GPIO.OUT)
-GPIO.setup(PIN_MOTOR_MS2, GPIO.OUT)
-GPIO.output(PIN_MOTOR_STEP, False)
-GPIO.output(PIN_MOTOR_DIR, False)
-GPIO.output(PIN_MOTOR_MS1,True)
-GPIO.output(PIN_MOTOR_MS2,True)
-
-def spin_motor(num_steps):
-    for y in range(num_steps):
-        GPIO.output(PIN_MOTOR_STEP, True)
-        sleep(0.001)
-        GPIO.output(PIN_MOTOR_STEP, False)
-        sleep(0.001)
+motor = StepperDriver(GPIO, hw.pulses(), PIN_MOTOR_STEP, PIN_MOTOR_DIR,
+                      PIN_MOTOR_MS1, PIN_MOTOR_MS2, MOTOR_STEP_FREQUENCY,
+                      MOTOR_START_FREQUENCY, MOTOR_RAMP_STEPS, MOTOR_MICROSTEP)
 
 try:
     num_steps = int(input('Please enter the number of steps per drop:'))
     num_times = int(input ('Please enter the number of drops to dispense:'))
+    durations = []
     for x in range(num_times):
         print("Drop " + str(x+1) +'.')
-        spin_motor(num_steps)
+        timing = motor.move(num_steps)
+        durations.append(timing['actual_ms'])
         sleep(0.2)
+    mean = sum(durations) / len(durations)
+    print("Drop duration %.2f ms on average (requested %.2f ms), range "
+          "%.2f - %.2f ms." % (mean, timing['requested_ms'], min(durations),
+                               max(durations)))
 except KeyboardInterrupt:
-    GPIO.cleanup()
\ No newline at end of file
+    GPIO.cleanup()
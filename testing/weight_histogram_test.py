@@ -0,0 +1,193 @@
+"""Script for checking that the weight histogram gives exactly the same daily
+average weight as the original calculation (rounding every weight in the
+day's weight file to 0.1g and taking the mode with scipy), using recorded 
+weight files. Samples are counted both one at a time (add_many()) and all at
+once (add_array(), used by report.py). Without a data directory, a few days
+of weight files are generated in a temporary folder and checked instead.
+
+Also checks that a saved histogram is not used once more samples have been
+added to the weight file (as when the program crashes during a visit), and
+that it is rebuilt from the file instead, and that SQLiteStorage saves and
+loads histograms without committing the rows it has buffered.
+
+Usage: python3 weight_histogram_test.py [data directory]
+
+Run from the PiDose folder, or with it on the PYTHONPATH.
+"""
+import os
+import sys
+import glob
+import sqlite3
+import tempfile
+import datetime as dt
+import numpy as np
+from scipy import stats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from weight_histogram import WeightHistogram
+from storage import TextStorage, SQLiteStorage
+
+UPPER_WEIGHT = 60
+LOWER_WEIGHT = 20
+
+MICE = 3
+DAYS = 4
+SAMPLES_PER_DAY = 2000
+
+
+def generate(data_dir):
+    """Writes weight files for a few mice and days, with samples inside and
+    outside the weight limits and a few malformed lines."""
+
+    rng = np.random.default_rng(1)
+    start = dt.datetime(2020, 1, 1, 9)
+    for j in range(MICE):
+        name = 'mouse%i' % (j + 1)
+        os.makedirs(os.path.join(data_dir, name, 'Weights'))
+        for day in range(DAYS):
+            weights = np.concatenate((
+                rng.normal(25 + j, 0.5, SAMPLES_PER_DAY),
+                rng.uniform(0, 80, SAMPLES_PER_DAY // 10)))
+            rng.shuffle(weights)
+            path = os.path.join(data_dir, name, 'Weights',
+                                '%s_weights_day%i.txt' % (name, day))
+            with open(path, 'w') as weight_file:
+                for k, weight in enumerate(weights.tolist()):
+                    timestamp = start + dt.timedelta(days=day,
+                                                     milliseconds=k * 100)
+                    weight_file.write(str(timestamp) + '\t' + str(weight) +
+                                      '\n')
+                weight_file.write('\n' + str(start) + '\n')
+    return None
+
+
+def check_saved(data_dir):
+    """Saves a histogram, adds samples to the weight file as a crash during
+    a visit would leave it, and checks that the saved histogram is only
+    used while the file is unchanged.
+
+    Returns:
+        The number of failed checks.
+    """
+
+    storage = TextStorage(data_dir)
+    name = 'saved'
+    os.makedirs(os.path.join(data_dir, name, 'Weights'))
+    histogram = WeightHistogram(LOWER_WEIGHT, UPPER_WEIGHT)
+    timestamp = dt.datetime(2020, 1, 1, 9)
+    for weight in (24.1, 24.1, 24.3):
+        storage.record_weight(name, 0, timestamp, weight)
+        histogram.add(weight)
+    storage.save_histogram(name, 0, histogram)
+    failures = 0
+    saved = storage.load_histogram(name, 0, LOWER_WEIGHT, UPPER_WEIGHT)
+    if saved is None or not np.array_equal(saved.counts, histogram.counts):
+        failures += 1
+        print("MISMATCH: saved histogram not loaded.")
+    for weight in (24.3, 24.3):
+        storage.record_weight(name, 0, timestamp, weight)
+    storage.close()
+    storage = TextStorage(data_dir)
+    if storage.load_histogram(name, 0, LOWER_WEIGHT, UPPER_WEIGHT) is not None:
+        failures += 1
+        print("MISMATCH: stale histogram loaded after the weight file "
+              "grew.")
+    rebuilt = WeightHistogram(LOWER_WEIGHT, UPPER_WEIGHT)
+    rebuilt.add_many(storage.read_weights(name, 0))
+    if rebuilt.mode() != (5, 24.3):
+        failures += 1
+        print("MISMATCH: rebuilt histogram gives %s from %i weights."
+              % (str(rebuilt.mode()[1]), rebuilt.mode()[0]))
+    storage.close()
+    print("Saved histogram checks: %i failed." % (failures))
+    return failures
+
+
+def check_saved_sqlite(data_dir):
+    """Saves and loads a histogram in SQLiteStorage with the weights still
+    buffered, and checks that nothing was committed to do so.
+
+    Returns:
+        The number of failed checks.
+    """
+
+    path = os.path.join(data_dir, 'pidose.db')
+    storage = SQLiteStorage(path, sync_interval=3600, batch_size=1000)
+    histogram = WeightHistogram(LOWER_WEIGHT, UPPER_WEIGHT)
+    timestamp = dt.datetime(2020, 1, 1, 9)
+    for weight in (24.1, 24.1, 24.3):
+        storage.record_weight('saved', 0, timestamp, weight)
+        histogram.add(weight)
+    storage.save_histogram('saved', 0, histogram)
+    failures = 0
+    saved = storage.load_histogram('saved', 0, LOWER_WEIGHT, UPPER_WEIGHT)
+    if saved is None or not np.array_equal(saved.counts, histogram.counts):
+        failures += 1
+        print("MISMATCH: buffered SQLite histogram not loaded.")
+    reader = sqlite3.connect(path)
+    committed = reader.execute('SELECT COUNT(*) FROM weights').fetchone()[0]
+    reader.close()
+    if committed:
+        failures += 1
+        print("MISMATCH: saving and loading a histogram committed %i weight "
+              "rows." % (committed))
+    storage.record_weight('saved', 0, timestamp, 24.3)
+    storage.flush()
+    if storage.load_histogram('saved', 0, LOWER_WEIGHT,
+                              UPPER_WEIGHT) is not None:
+        failures += 1
+        print("MISMATCH: stale SQLite histogram loaded after more weights.")
+    storage.close()
+    print("Saved SQLite histogram checks: %i failed." % (failures))
+    return failures
+
+
+def mode_weight(path):
+    weight_list = []
+    weights = []
+    with open(path, 'r') as weight_file:
+        for line in weight_file:
+            line = line.replace('\n', '')
+            line = line.split('\t')
+            try:
+                weights.append(float(line[1]))
+                if (float(line[1]) <= UPPER_WEIGHT and float(line[1]) >= 
+                    LOWER_WEIGHT):
+                    weight_list.append(round(float(line[1]), 1))
+            except IndexError:
+                continue
+    if not weight_list:
+        return weights, 0, None
+    weight = np.ravel(stats.mode(np.array(weight_list))[0])[0]
+    return weights, len(weight_list), weight
+
+
+if len(sys.argv) > 1:
+    data_dir = sys.argv[1]
+else:
+    data_dir = tempfile.mkdtemp()
+    generate(data_dir)
+
+paths = sorted(glob.glob(os.path.join(data_dir, '*', 'Weights', 
+                                      '*_weights_day*.txt')))
+if not paths:
+    sys.exit("No weight files found in %s." % (data_dir))
+print("Comparing %i weight files in %s." % (len(paths), data_dir))
+failures = 0
+for path in paths:
+    weights, n_expected, expected = mode_weight(path)
+    histogram = WeightHistogram(LOWER_WEIGHT, UPPER_WEIGHT)
+    histogram.add_many(weights)
+    n, weight = histogram.mode()
+    array_histogram = WeightHistogram(LOWER_WEIGHT, UPPER_WEIGHT)
+    array_histogram.add_array(np.array(weights))
+    if (n != n_expected or weight != expected or
+            not np.array_equal(histogram.counts, array_histogram.counts)):
+        failures += 1
+        print("MISMATCH %s: mode %s from %i weights, histogram %s from %i "
+              "weights." % (path, str(expected), n_expected, str(weight), n))
+print("%i of %i weight files matched." % (len(paths) - failures, len(paths)))
+failures += check_saved(tempfile.mkdtemp())
+failures += check_saved_sqlite(tempfile.mkdtemp())
+sys.exit(1 if failures else 0)
@@ -0,0 +1,199 @@
+"""Script for checking the weight plateau detection (see plateau.py).
+
+Makes visits of mice of known weight that step on, move about and step off
+the scale (simulator.movement_trace()), weighs them at WEIGH_FREQUENCY, and
+compares storing every sample ('raw' WEIGHT_LOG_MODE) with storing only the
+samples in plateaus and a summary of each plateau ('plateaus'): the number
+of lines and bytes written, the error of the daily weight (the mode of the
+stored samples, as in get_average_weight()) against each mouse's real
+weight, and the share of the samples counted (those within the weight
+limits) that are within 0.2 g of the real weight. Also reports how long
+each sample takes to add to the detector, and checks that no sample is
+returned twice when a plateau starts right after another ends, including
+when the clock is set back in between.
+
+Exits with status 1 if, for any mouse, the daily weight from plateau
+samples is more than MODE_TOLERANCE from the one from all samples, if
+plateau mode stores more than MAX_STORED_SHARE of the bytes, or if any
+sample is returned twice or left out.
+
+If a folder of recorded text weight logs is given, also reports the share
+of their samples that would have been kept (visits are split where samples
+are more than a second apart).
+
+Usage: python3 weight_plateau_test.py [mice] [visits] [weights folder]
+
+Run from the PiDose folder, or with it on the PYTHONPATH.
+"""
+import os
+import sys
+import random
+import datetime as dt
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from plateau import PlateauDetector
+from simulator import movement_trace
+from weight_histogram import WeightHistogram
+
+MICE = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+VISITS = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+FOLDER = sys.argv[3] if len(sys.argv) > 3 else None
+WEIGH_FREQUENCY = 5
+PLATEAU_WINDOW = 5
+PLATEAU_MAX_SD = 0.1
+LOWER_WEIGHT = 20
+UPPER_WEIGHT = 60
+MODE_TOLERANCE = 0.1
+MAX_STORED_SHARE = 0.8
+
+
+def detector():
+    return PlateauDetector(PLATEAU_WINDOW, PLATEAU_MAX_SD, LOWER_WEIGHT,
+                           UPPER_WEIGHT)
+
+
+def sample_line(timestamp, weight):
+    return str(timestamp) + '\t' + str(weight) + '\n'
+
+
+def plateau_line(plateau):
+    return '%s\t%s\t%i\t%.3f\t%.3f\n' % (plateau.start, plateau.end,
+                                         plateau.n, plateau.mean(),
+                                         plateau.std())
+
+
+rng = random.Random(0)
+start = dt.datetime(2020, 1, 1, 8)
+totals = {'raw': [0, 0], 'plateaus': [0, 0]}
+errors = {'raw': [], 'plateaus': []}
+close = {'raw': [0, 0], 'plateaus': [0, 0]}
+mode_differences = []
+add_time = 0
+n_samples = 0
+for mouse in range(MICE):
+    weight = rng.uniform(22, 32)
+    histograms = {mode: WeightHistogram(LOWER_WEIGHT, UPPER_WEIGHT)
+                  for mode in totals}
+    plateaus = detector()
+    for visit in range(VISITS):
+        entry = start + dt.timedelta(hours=visit)
+        trace = movement_trace(weight, rng.uniform(10, 120), rng)
+        # Latest reading at each weighing, as in SimScale
+        readings = []
+        for j in range(int(trace[-1][0] * WEIGH_FREQUENCY)):
+            t = j / WEIGH_FREQUENCY
+            k = min(int(t * 20), len(trace) - 1)
+            readings.append((entry + dt.timedelta(seconds=t), trace[k][1]))
+
+        tick = perf_counter()
+        results = [plateaus.add(*reading) for reading in readings]
+        add_time += perf_counter() - tick
+        n_samples += len(readings)
+        ended = [plateau for samples, plateau in results
+                 if plateau is not None] + [plateaus.reset()]
+
+        for timestamp, grams in readings:
+            histograms['raw'].add(grams)
+            totals['raw'][0] += 1
+            totals['raw'][1] += len(sample_line(timestamp, grams))
+        for samples, plateau in results:
+            for timestamp, grams in samples:
+                histograms['plateaus'].add(grams)
+                totals['plateaus'][0] += 1
+                totals['plateaus'][1] += len(sample_line(timestamp, grams))
+        for plateau in ended:
+            if plateau is not None:
+                totals['plateaus'][0] += 1
+                totals['plateaus'][1] += len(plateau_line(plateau))
+    mode_differences.append(abs(histograms['plateaus'].mode()[1] -
+                                histograms['raw'].mode()[1]))
+    for mode, histogram in histograms.items():
+        n, mode_weight = histogram.mode()
+        errors[mode].append(abs(mode_weight - round(weight, 1)))
+        j = int(round(round(weight, 1) * 10)) - int(round(LOWER_WEIGHT * 10))
+        close[mode][0] += int(histogram.counts[j - 2:j + 3].sum())
+        close[mode][1] += n
+
+for mode in ('raw', 'plateaus'):
+    print("%-8s %7i lines %9i bytes, daily weight error: mean %.2f g, max "
+          "%.2f g, %.0f%% of counted samples within 0.2 g"
+          % (mode, totals[mode][0], totals[mode][1],
+             sum(errors[mode]) / len(errors[mode]), max(errors[mode]),
+             100.0 * close[mode][0] / close[mode][1]))
+stored_share = totals['plateaus'][1] / totals['raw'][1]
+print("Plateau mode stores %.0f%% of the bytes. %.1f us per sample added."
+      % (100.0 * stored_share, 1e6 * add_time / n_samples))
+print("Daily weight from plateau samples against all samples: max "
+      "difference %.2f g." % (max(mode_differences)))
+failures = 0
+if max(mode_differences) > MODE_TOLERANCE:
+    failures += 1
+    print("MISMATCH: daily weight differs by more than %.2f g."
+          % (MODE_TOLERANCE))
+if stored_share > MAX_STORED_SHARE:
+    failures += 1
+    print("MISMATCH: plateau mode stores more than %.0f%% of the bytes."
+          % (100.0 * MAX_STORED_SHARE))
+
+# A plateau that starts just after one ends (samples 5 to 7 were in both
+# windows)
+plateaus = detector()
+weights = [25.0] * 4 + [24.8, 25.0, 25.0, 25.0, 25.15, 25.0, 25.0]
+returned = []
+for j, grams in enumerate(weights):
+    returned += plateaus.add(start + dt.timedelta(seconds=j), grams)[0]
+times = [timestamp for timestamp, grams in returned]
+print("Back to back plateaus: %i samples returned, %s."
+      % (len(times), 'each once' if len(times) == len(set(times))
+         else 'SOME TWICE'))
+if len(times) != len(set(times)) or len(times) != 11:
+    failures += 1
+    print("MISMATCH: expected samples 0 to 10 each returned once.")
+
+# Two plateaus in one visit, with the clock set back an hour (e.g. at the
+# end of daylight saving time) just after the first one ends
+plateaus = detector()
+returned = []
+ended = []
+for j, grams in enumerate([25.0] * 5 + [30.0] + [25.0] * 5):
+    timestamp = start + dt.timedelta(seconds=j)
+    if j >= 6:
+        timestamp -= dt.timedelta(hours=1)
+    samples, plateau = plateaus.add(timestamp, grams)
+    returned += samples
+    ended.append(plateau)
+ended.append(plateaus.reset())
+counts = [plateau.n for plateau in ended if plateau is not None]
+print("Back to back plateaus with the clock set back: %i samples returned, "
+      "plateaus of %s samples." % (len(returned), counts))
+if len(returned) != 10 or counts != [5, 5]:
+    failures += 1
+    print("MISMATCH: expected two plateaus of 5 samples.")
+
+if FOLDER is not None:
+    kept = total = 0
+    for name in sorted(os.listdir(FOLDER)):
+        if not name.endswith('.txt') or '_weights_day' not in name:
+            continue
+        plateaus = detector()
+        last = None
+        with open(os.path.join(FOLDER, name), 'r') as file:
+            for line in file:
+                fields = line.rstrip('\n').split('\t')
+                try:
+                    timestamp = dt.datetime.fromisoformat(fields[0])
+                    grams = float(fields[1])
+                except (IndexError, ValueError):
+                    continue
+                if (last is not None and
+                        (timestamp - last).total_seconds() > 1):
+                    plateaus.reset()
+                last = timestamp
+                kept += len(plateaus.add(timestamp, grams)[0])
+                total += 1
+    print("Recorded logs in %s: %i of %i samples (%.0f%%) in plateaus."
+          % (FOLDER, kept, total, 100.0 * kept / max(total, 1)))
+
+sys.exit(1 if failures else 0)
@@ -0,0 +1,142 @@
+"""Monotonic timing for PiDose.
+
+All of the timers in PiDose (weighing, re-taring, the grace period and the
+water timeout) are measured on the monotonic clock, which unlike time() is
+never stepped backwards or forwards when NTP corrects the system time.
+
+RateScheduler keeps a fixed-rate cadence for periodic work such as weighing.
+Deadlines are start + k * period rather than "one period after the last
+sample", so the time spent taking each sample does not add up into drift.
+It also keeps statistics on how late each tick was (jitter) and how many
+deadlines were missed entirely (overruns).
+
+PiDose reads the time through a clock object (SystemClock here, or the
+virtual clock in simulator.py) so that the control logic can be run faster
+than real time off the Pi.
+
+"""
+
+import datetime as dt
+from time import monotonic_ns, sleep
+
+
+class SystemClock(object):
+    """The real clock. Other clocks (e.g. simulator.SimClock) provide the same
+    methods."""
+
+    def now(self):
+        """Local wall clock time as a datetime.datetime() object, used for
+        timestamps in the data files."""
+
+        return dt.datetime.now()
+
+    def monotonic_ns(self):
+        """Monotonic time in integer nanoseconds, used for timers."""
+
+        return monotonic_ns()
+
+    def sleep(self, seconds):
+        sleep(seconds)
+        return None
+
+    def select(self, selector, timeout):
+        """Waits on a selectors.BaseSelector() for up to timeout seconds.
+
+        Returns:
+            The list of (key, events) pairs that are ready.
+        """
+
+        return selector.select(timeout)
+
+
+class RateScheduler(object):
+    """Runs something at a fixed rate on the monotonic clock.
+
+    Call start(), then check due() and call tick() for each period. If a tick is late by a whole period or more, the missed
+    deadlines are counted as overruns and skipped, rather than being run back
+    to back to catch up.
+    """
+
+    def __init__(self, frequency, clock=monotonic_ns):
+        """Args:
+            frequency is the rate in Hz.
+            clock is a function returning the time in integer nanoseconds.
+        """
+
+        self.period_ns = int(round(1e9 / frequency))
+        self._clock = clock
+        self._next = None
+        self._last_tick = None
+        self.period = None
+        self.reset_stats()
+
+    def start(self, delay=0):
+        """Starts (or restarts) the cadence, keeping the statistics.
+
+        Args:
+            delay is the time in seconds until the first tick is due.
+
+        Returns:
+            None.
+        """
+
+        self._next = self._clock() + int(delay * 1e9)
+        self._last_tick = None
+        return None
+
+    def reset_stats(self):
+        """Clears the jitter and overrun statistics."""
+
+        self.ticks = 0
+        self.overruns = 0
+        self._jitter_sum = 0
+        self._jitter_max = 0
+        return None
+
+    def time_until_next(self):
+        """Time in seconds until the next tick is due (negative if overdue)."""
+
+        return (self._next - self._clock()) / 1e9
+
+    def due(self):
+        """True if the next tick is due."""
+
+        return self._clock() >= self._next
+
+    def tick(self):
+        """Records a tick and moves on to the next deadline. The time since
+        the previous tick is kept in period (in seconds, None for the first
+        tick after start()).
+
+        Returns:
+            The jitter of this tick (how late it was) in seconds.
+        """
+
+        now = self._clock()
+        self.period = (None if self._last_tick is None
+                       else (now - self._last_tick) / 1e9)
+        self._last_tick = now
+        jitter = now - self._next
+        if jitter >= self.period_ns:
+            missed = jitter // self.period_ns
+            self.overruns += missed
+            self._next += missed * self.period_ns
+            jitter -= missed * self.period_ns
+        self._next += self.period_ns
+        self.ticks += 1
+        self._jitter_sum += jitter
+        self._jitter_max = max(self._jitter_max, jitter)
+        return jitter / 1e9
+
+    def stats(self):
+        """Jitter and overrun statistics since the last reset.
+
+        Returns:
+            A dict with 'ticks', 'overruns', and 'mean_jitter_ms' and
+            'max_jitter_ms' (floats).
+        """
+
+        return {'ticks': self.ticks, 'overruns': self.overruns,
+                'mean_jitter_ms': (self._jitter_sum / self.ticks / 1e6
+                                   if self.ticks else 0.0),
+                'max_jitter_ms': self._jitter_max / 1e6}
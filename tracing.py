@@ -0,0 +1,244 @@
+"""Tracing spans and a sampling profiler for finding where time goes.
+
+Hot paths (reading the MPR121, recording events, logging, stepping the
+syringe pump, taking pictures...) are wrapped in spans:
+
+    with tracing.span('cap.touched'):
+        touched = cap.touched()
+
+or, for whole functions, decorated with @tracing.traced. While tracing is
+off, span() only checks a flag and returns a shared object that does
+nothing, so spans can stay in the code. While it is on, each span adds a
+(name, start, end, thread) tuple to a ring buffer holding the last
+capacity spans, which dump() writes as a Chrome trace (JSON) file that can
+be opened in Perfetto (ui.perfetto.dev) or chrome://tracing. Spans are
+timed on time.perf_counter_ns(), so on the simulated cage they show the
+real time the code takes rather than simulated time.
+
+SamplingProfiler takes the stack of every thread at a fixed interval and
+counts them, and writes the counts in the folded format read by flame
+graph tools (e.g. speedscope.app or flamegraph.pl).
+
+In piDose.py, SIGUSR1 turns tracing on (or, if it is on, dumps the spans
+so far) and SIGUSR2 starts and stops the profiler, e.g.
+kill -USR1 $(pgrep -f piDose.py).
+
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import collections
+import functools
+
+log = logging.getLogger('piDose.tracing')
+
+
+class _NullSpan(object):
+    """Span used while tracing is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Span(object):
+    """Span used while tracing is on."""
+
+    __slots__ = ('_name', '_start')
+
+    def __init__(self, name):
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        _spans.append((self._name, self._start, time.perf_counter_ns(),
+                       threading.get_ident()))
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+_spans = collections.deque(maxlen=100000)
+_enabled = False
+
+
+def span(name):
+    """A context manager timing the code in its with block as a span.
+
+    Args:
+        name is a string naming the span (e.g. 'record_event').
+
+    Returns:
+        The context manager.
+    """
+
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def traced(function):
+    """Decorator that times every call of a function as a span named after
+    it."""
+
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        with _Span(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def enable(capacity=None):
+    """Starts recording spans.
+
+    Args:
+        capacity is the number of spans the ring buffer holds (the oldest
+        are dropped), or None to keep the current size (100000 at first).
+
+    Returns:
+        None.
+    """
+
+    global _enabled, _spans
+
+    if capacity is not None and capacity != _spans.maxlen:
+        _spans = collections.deque(_spans, maxlen=capacity)
+    _enabled = True
+    return None
+
+
+def disable():
+    """Stops recording spans (keeping those recorded).
+
+    Returns:
+        None.
+    """
+
+    global _enabled
+
+    _enabled = False
+    return None
+
+
+def is_enabled():
+    return _enabled
+
+
+def dump(path):
+    """Writes the spans in the ring buffer to a Chrome trace file.
+
+    Args:
+        path is a string containing the location of the file.
+
+    Returns:
+        The number of spans written.
+    """
+
+    spans = list(_spans)
+    pid = os.getpid()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': ident,
+               'args': {'name': names.get(ident, str(ident))}}
+              for ident in set(span[3] for span in spans)]
+    for name, start, end, ident in spans:
+        events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': ident,
+                       'ts': start / 1e3, 'dur': (end - start) / 1e3})
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+    return len(spans)
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of every thread on a background thread."""
+
+    def __init__(self, interval=0.005):
+        """Args:
+            interval is the time in seconds between samples.
+        """
+
+        self.interval = interval
+        self.samples = 0
+        self._stacks = collections.Counter()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Clears the counts and starts sampling.
+
+        Returns:
+            None.
+        """
+
+        self._stacks.clear()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='SamplingProfiler', daemon=True)
+        self._thread.start()
+        return None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name
+                     for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (os.path.basename(
+                        code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+        return None
+
+    def stop(self, path=None):
+        """Stops sampling, and writes the counts if a path is given.
+
+        Args:
+            path is a string containing the location of the folded stacks
+            file (one 'thread;outer;...;inner count' line per stack), or
+            None.
+
+        Returns:
+            A list of the (stack, count) tuples sampled most often, most
+            first (at most 10).
+        """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, 'w') as file:
+                for stack, count in self._stacks.items():
+                    file.write('%s %i\n' % (stack, count))
+        return self._stacks.most_common(10)
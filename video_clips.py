@@ -0,0 +1,277 @@
+"""Video clips of drops from a continuous in-memory recording.
+
+The camera records low-resolution H.264 continuously into a circular buffer
+in memory (picamera.PiCameraCircularIO), which holds the last few seconds of
+video and never touches the SD card. When a drop is delivered, the lick
+callback only asks a ClipRecorder for a clip. A clip thread waits until
+CLIP_POST_SECONDS after the drop and then copies the buffered video, from
+CLIP_PRE_SECONDS before the drop, into a clip file. The frames to copy are
+chosen by their timestamps (the camera records with clock_mode 'raw', so
+they are on the camera's clock), so a clip written late, e.g. behind
+another clip, still ends CLIP_POST_SECONDS after its drop.
+
+The cost to the SD card is bounded. A drop within an earlier clip extends
+that clip (up to the length of the buffer) instead of starting a new one. At
+most max_queue clips can be waiting to be written, and further drops are
+not filmed.
+
+On the simulated cage (threaded=False), clips are written by events on the
+virtual clock instead of by a thread.
+
+"""
+
+import os
+import logging
+import threading
+import collections
+import tracing
+
+log = logging.getLogger('piDose.camera')
+
+# Frame types (as in picamera.PiVideoFrameType)
+FRAME = 0
+KEY_FRAME = 1
+SPS_HEADER = 2
+
+
+def copy_frames(buffer, output, start_us, end_us):
+    """Copies the frames recorded between two times out of a circular buffer.
+
+    The copy starts at the last SPS header before start_us (or the first
+    one still in the buffer), which the clip must start with to be decoded,
+    and ends with the last complete frame at or before end_us.
+
+    Args:
+        buffer is a picamera.PiCameraCircularIO() (see
+        Hardware.video_buffer()).
+        output is a string containing the location to save the frames to.
+        start_us and end_us are frame timestamps in microseconds.
+
+    Returns:
+        The number of bytes copied (nothing is saved if there were none).
+    """
+
+    start = None
+    end = None
+    with buffer.lock:
+        started = False
+        for frame in buffer.frames:
+            if frame.timestamp is not None:
+                if frame.timestamp > end_us:
+                    break
+                if frame.timestamp >= start_us:
+                    started = True
+            if frame.frame_type == SPS_HEADER and (start is None or
+                                                   not started):
+                start = frame.position
+            if (start is not None and frame.timestamp is not None and
+                    frame.complete):
+                end = frame.position + frame.frame_size
+        if end is None:
+            return 0
+        position = buffer.tell()
+        try:
+            buffer.seek(start)
+            data = buffer.read(end - start)
+        finally:
+            buffer.seek(position)
+    with open(output, 'wb') as file:
+        file.write(data)
+    return len(data)
+
+
+class Clip(object):
+    """A clip waiting to be written, from start_ns to end_ns on the
+    monotonic clock."""
+
+    def __init__(self, path, start_ns, end_ns):
+        self.path = path
+        self.start_ns = start_ns
+        self.end_ns = end_ns
+        self.drops = 1
+
+
+class ClipRecorder(object):
+    """Records continuously into a circular buffer and saves clips around
+    drops."""
+
+    def __init__(self, camera, buffer, clock, pre_seconds, post_seconds,
+                 max_seconds, max_queue=4, threaded=True, resolution=None,
+                 bitrate=None):
+        """Starts recording.
+
+        Args:
+            camera is the picamera.PiCamera() (or CameraBackend) to record
+            from.
+            buffer is the circular buffer to record into (see
+            Hardware.video_buffer()).
+            clock is the clock (a timing.SystemClock() or
+            simulator.SimClock()).
+            pre_seconds and post_seconds are the lengths of video to save
+            before and after each drop.
+            max_seconds is the longest clip to save, which must be less than
+            the buffer holds (and at least pre_seconds + post_seconds).
+            max_queue is the most clips that can wait to be written.
+            threaded is False to write clips from events on the clock (which
+            must then have schedule(), as SimClock does).
+            resolution is the (width, height) to record at (defaults to the
+            camera's resolution).
+            bitrate is the H.264 bitrate in bits per second (defaults to the
+            camera's default).
+        """
+
+        self._camera = camera
+        self._buffer = buffer
+        self._clock = clock
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_queue = max_queue
+        self.threaded = threaded
+        self.max_seconds = max_seconds
+        self._clips = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self.written = 0
+        self.extended = 0
+        self.dropped = 0
+        self.write_ms_max = 0.0
+
+        camera.clock_mode = 'raw'
+        options = {'format': 'h264',
+                   'intra_period': int(round(getattr(camera, 'framerate',
+                                                     30)))}
+        if resolution is not None:
+            options['resize'] = resolution
+        if bitrate is not None:
+            options['bitrate'] = bitrate
+        camera.start_recording(buffer, **options)
+        if threaded:
+            self._thread = threading.Thread(target=self._run,
+                                            name='ClipRecorder', daemon=True)
+            self._thread.start()
+
+    def request(self, path):
+        """Asks for a clip around now. Returns straight away.
+
+        Args:
+            path is a string containing the location to save the clip to.
+
+        Returns:
+            True if the clip will be saved (possibly as part of an earlier
+            clip), False if it was dropped because the queue was full.
+        """
+
+        now_ns = self._clock.monotonic_ns()
+        start_ns = now_ns - int(self.pre_seconds * 1e9)
+        end_ns = now_ns + int(self.post_seconds * 1e9)
+        with self._condition:
+            if self._clips:
+                last = self._clips[-1]
+                if (start_ns <= last.end_ns and
+                    end_ns - last.start_ns <= self.max_seconds * 1e9):
+                    last.end_ns = end_ns
+                    last.drops += 1
+                    self.extended += 1
+                    self._schedule(last)
+                    return True
+            if len(self._clips) >= self.max_queue:
+                self.dropped += 1
+                return False
+            clip = Clip(path, start_ns, end_ns)
+            self._clips.append(clip)
+            self._schedule(clip)
+        return True
+
+    def _schedule(self, clip):
+        """Wakes up the clip thread (or schedules a clock event) for the
+        clip's new end. Called with the condition held."""
+
+        if self.threaded:
+            self._condition.notify()
+        else:
+            # SimClock times events from the same zero as monotonic_ns()
+            self._clock.schedule((clip.end_ns + 1) / 1e9, self._write_due)
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._clips and not self._closed:
+                    self._condition.wait()
+                if not self._clips:
+                    return None
+                remaining = ((self._clips[0].end_ns -
+                              self._clock.monotonic_ns()) / 1e9)
+                if remaining > 0 and not self._closed:
+                    self._condition.wait(remaining)
+                    continue
+                clip = self._clips.popleft()
+            self._write(clip)
+
+    def _write_due(self):
+        """Writes every clip that has ended. Used when not threaded."""
+
+        while (not self._closed and self._clips and
+               self._clips[0].end_ns <= self._clock.monotonic_ns()):
+            self._write(self._clips.popleft())
+        return None
+
+    def _write(self, clip):
+        """Copies a clip out of the circular buffer."""
+
+        start = self._clock.monotonic_ns()
+        end_ns = min(clip.end_ns, start)
+        seconds = (end_ns - clip.start_ns) / 1e9
+        try:
+            # Raises any error the encoder has had
+            self._camera.wait_recording(0)
+            # The clip's times on the camera's clock
+            camera_us = self._camera.timestamp
+            start_us = camera_us - (start - clip.start_ns) // 1000
+            end_us = camera_us - (start - end_ns) // 1000
+            os.makedirs(os.path.dirname(clip.path), exist_ok=True)
+            with tracing.span('clip.copy'):
+                size = copy_frames(self._buffer, clip.path, start_us, end_us)
+        except Exception as e:
+            log.error("Error saving clip %s: %s", clip.path, e)
+            return None
+        if not size:
+            log.error("No video in the buffer for clip %s.", clip.path)
+            return None
+        write_ms = (self._clock.monotonic_ns() - start) / 1e6
+        self.written += 1
+        self.write_ms_max = max(self.write_ms_max, write_ms)
+        log.info("Saved %.1f s clip of %i drop(s) to %s (%.0f ms).", seconds,
+                 clip.drops, clip.path, write_ms)
+        return None
+
+    def stats(self):
+        """Returns a dict with the number of clips 'written', drops that
+        'extended' an earlier clip, drops 'dropped' because the queue was
+        full, clips 'queued' now and 'write_ms_max'."""
+
+        with self._condition:
+            return {'written': self.written, 'extended': self.extended,
+                    'dropped': self.dropped, 'queued': len(self._clips),
+                    'write_ms_max': self.write_ms_max}
+
+    def close(self):
+        """Saves the clips waiting to be written (with whatever video there
+        is so far) and stops recording.
+
+        Returns:
+            None.
+        """
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self.threaded:
+            self._thread.join()
+        while self._clips:
+            self._write(self._clips.popleft())
+        try:
+            self._camera.stop_recording()
+        except Exception as e:
+            log.error("Error stopping recording: %s", e)
+        return None
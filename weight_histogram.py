@@ -0,0 +1,106 @@
+"""Running histogram of a mouse's weight samples for one day.
+
+get_average_weight() takes every weight sample of the day between
+LOWER_WEIGHT and UPPER_WEIGHT, rounds it to 0.1g and takes the mode. Keeping a
+count for each 0.1g bin as samples arrive gives the same answer at rollover
+from an argmax over a few hundred counts, instead of re-reading the day's
+weight log.
+
+"""
+
+import numpy as np
+
+
+class WeightHistogram(object):
+    """Counts of weight samples in 0.1g bins from lower to upper
+    (inclusive)."""
+
+    def __init__(self, lower, upper, counts=None):
+        """Args:
+            lower is the lowest weight in grams that is counted.
+            upper is the highest weight in grams that is counted.
+            counts is an optional array of existing bin counts.
+
+        Raises:
+            ValueError: counts does not have one entry per bin.
+        """
+
+        self.lower = lower
+        self.upper = upper
+        # Every counted sample rounds to a value between these (in 0.1g)
+        self._first_bin = int(round(round(lower, 1) * 10))
+        n_bins = int(round(round(upper, 1) * 10)) - self._first_bin + 1
+        if counts is None:
+            self.counts = np.zeros(n_bins, np.int64)
+        elif len(counts) != n_bins:
+            raise ValueError("Expected %i bins, got %i." % (n_bins,
+                                                            len(counts)))
+        else:
+            self.counts = np.array(counts, np.int64)
+
+    def add(self, weight):
+        """Counts a weight sample if it is within the weight limits.
+
+        Args:
+            weight is a float containing the weight in grams.
+
+        Returns:
+            True if the sample was counted, False otherwise.
+        """
+
+        if weight <= self.upper and weight >= self.lower:
+            self.counts[int(round(round(weight, 1) * 10)) -
+                        self._first_bin] += 1
+            return True
+        return False
+
+    def add_many(self, weights):
+        """Counts each of an iterable of weight samples."""
+
+        for weight in weights:
+            self.add(weight)
+        return None
+
+    def add_array(self, weights):
+        """Counts a numpy array of weight samples at once, into the same bins
+        as add().
+
+        Args:
+            weights is a numpy array (or sequence) of weights in grams.
+
+        Returns:
+            The number of samples counted.
+        """
+
+        weights = np.asarray(weights, np.float64)
+        weights = weights[(weights >= self.lower) & (weights <= self.upper)]
+        scaled = weights * 10
+        bins = np.rint(scaled)
+        # np.rint() can round differently from round(weight, 1) when a
+        # sample is within float error of a half bin, so redo those singly
+        close = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+        if close.any():
+            bins[close] = [round(round(weight, 1) * 10)
+                           for weight in weights[close].tolist()]
+        self.counts += np.bincount(bins.astype(np.int64) - self._first_bin,
+                                   minlength=len(self.counts))
+        return len(weights)
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def mode(self):
+        """Finds the most common weight, rounded to 0.1g.
+
+        Ties go to the lowest weight, as with scipy.stats.mode().
+
+        Returns:
+            The number of samples counted (as an int) and the most common
+            weight (as a float), or None if no samples have been counted.
+        """
+
+        n = len(self)
+        if n == 0:
+            return 0, None
+        # Same float as round(weight, 1) for the samples in this bin
+        return n, (self._first_bin + int(np.argmax(self.counts))) / 10
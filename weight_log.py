@@ -0,0 +1,316 @@
+"""Compact binary format for the daily weight logs.
+
+Each weight log holds one mouse-day of samples as fixed-size records after a
+short header, so a file can be appended to one record at a time while the
+mouse is in the chamber and read back later without any parsing, using
+numpy.memmap.
+
+Header (32 bytes, little-endian):
+    magic           4s   b'PDWL'
+    version         u2   1
+    kind            1s   b'g' (float32 grams) or b'r' (int32 raw load cell
+                         units)
+    padding         1x
+    base_ms         i8   Epoch time in milliseconds that offsets count from
+    grams_per_unit  f8   Grams per load cell unit (raw logs only, else 0)
+    reserved        8x
+
+Record (8 bytes):
+    offset_ms       u4   Milliseconds since base_ms
+    value           f4   Weight in grams (kind 'g'), or
+                    i4   Raw load cell units (kind 'r')
+
+Compared to a text line of str(datetime.now()) and str(weight) this is about
+a fifth of the size. Timestamps are kept to the millisecond and grams to
+float32 precision, so a text log of microsecond timestamps and float64
+weights (as PiDose writes) cannot be stored exactly. text_to_binary()
+refuses to convert a log unless every line would be written back
+byte-for-byte by binary_to_text(), or it is told that rounding is
+acceptable. Converting binary to text and back again is always exact.
+
+Running this file converts between the two formats:
+
+    python3 weight_log.py to-binary M1_weights_day3.txt M1_weights_day3.bin
+    python3 weight_log.py to-text M1_weights_day3.bin M1_weights_day3.txt
+
+Add --lossy to to-binary to round samples to the binary resolution.
+
+"""
+
+import os
+import sys
+import struct
+import argparse
+import datetime as dt
+import numpy as np
+
+
+MAGIC = b'PDWL'
+VERSION = 1
+HEADER = struct.Struct('<4sHcxqd8x')
+HEADER_SIZE = HEADER.size
+KIND_GRAMS = b'g'
+KIND_RAW = b'r'
+RECORD_DTYPES = {
+    KIND_GRAMS: np.dtype([('offset_ms', '<u4'), ('value', '<f4')]),
+    KIND_RAW: np.dtype([('offset_ms', '<u4'), ('value', '<i4')]),
+}
+MAX_OFFSET_MS = 2**32 - 1
+
+
+def epoch_ms(timestamp):
+    """Converts a (local time) datetime.datetime() object to epoch ms."""
+
+    return int(round(timestamp.timestamp() * 1000))
+
+
+def from_epoch_ms(ms):
+    """Converts epoch ms back to a (local time) datetime.datetime() object."""
+
+    return dt.datetime.fromtimestamp(ms // 1000).replace(
+        microsecond=(ms % 1000) * 1000)
+
+
+def read_header(path):
+    """Reads the header of a binary weight log.
+
+    Args:
+        path is a string containing the location of the log.
+
+    Returns:
+        A dict with keys 'kind', 'base_ms' and 'grams_per_unit'.
+
+    Raises:
+        ValueError: path is not a binary weight log.
+    """
+
+    with open(path, 'rb') as file:
+        data = file.read(HEADER_SIZE)
+    if len(data) < HEADER_SIZE:
+        raise ValueError("%s is too short to be a weight log." % (path))
+    magic, version, kind, base_ms, grams_per_unit = HEADER.unpack(data)
+    if magic != MAGIC or version != VERSION or kind not in RECORD_DTYPES:
+        raise ValueError("%s is not a version %i weight log."
+                         % (path, VERSION))
+    return {'kind': kind, 'base_ms': base_ms,
+            'grams_per_unit': grams_per_unit}
+
+
+class WeightLogWriter(object):
+    """Appends samples to a binary weight log, creating it if needed."""
+
+    def __init__(self, path, kind=KIND_GRAMS, grams_per_unit=0.0):
+        """Opens the log for appending.
+
+        The header is written with the first sample if the file is new. If
+        the file already exists, its kind and base time are used and any
+        partial record left by a crash is cut off.
+
+        Args:
+            path is a string containing the location of the log.
+            kind is KIND_GRAMS or KIND_RAW.
+            grams_per_unit is a float, stored in the header of raw logs.
+        """
+
+        self.path = path
+        self.kind = kind
+        self.grams_per_unit = grams_per_unit
+        self.base_ms = None
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE:
+            header = read_header(path)
+            self.kind = header['kind']
+            self.grams_per_unit = header['grams_per_unit']
+            self.base_ms = header['base_ms']
+            record_size = RECORD_DTYPES[self.kind].itemsize
+            size = os.path.getsize(path)
+            extra = (size - HEADER_SIZE) % record_size
+            if extra:
+                os.truncate(path, size - extra)
+        elif os.path.exists(path):
+            os.truncate(path, 0)
+        self._record = struct.Struct('<Lf' if self.kind == KIND_GRAMS
+                                     else '<Ll')
+        self._file = open(path, 'ab')
+
+    def write(self, timestamp, value):
+        """Appends one sample.
+
+        Args:
+            timestamp is a datetime.datetime() object.
+            value is the weight in grams (float) for KIND_GRAMS logs, or the
+            load cell reading in raw units (int) for KIND_RAW logs.
+
+        Returns:
+            None.
+
+        Raises:
+            ValueError: timestamp is before the start of the log or too far
+            after it to be stored.
+        """
+
+        ms = epoch_ms(timestamp)
+        if self.base_ms is None:
+            self.base_ms = ms
+            self._file.write(HEADER.pack(MAGIC, VERSION, self.kind, ms,
+                                         self.grams_per_unit))
+        offset = ms - self.base_ms
+        if offset < 0 or offset > MAX_OFFSET_MS:
+            raise ValueError("Sample at %s is outside the time range of %s."
+                             % (str(timestamp), self.path))
+        if self.kind == KIND_RAW:
+            value = int(value)
+        self._file.write(self._record.pack(offset, value))
+        return None
+
+    def flush(self):
+        self._file.flush()
+        return None
+
+    def close(self):
+        self._file.close()
+        return None
+
+
+def open_weight_log(path):
+    """Maps a binary weight log into memory without copying it.
+
+    Args:
+        path is a string containing the location of the log.
+
+    Returns:
+        The header (as returned by read_header()), and a structured
+        numpy.memmap with fields 'offset_ms' and 'value' (an empty array if
+        the log holds no samples).
+    """
+
+    header = read_header(path)
+    dtype = RECORD_DTYPES[header['kind']]
+    n = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if n == 0:
+        return header, np.zeros(0, dtype)
+    return header, np.memmap(path, dtype, mode='r', offset=HEADER_SIZE,
+                             shape=(n,))
+
+
+def read_weights(path):
+    """Returns every sample in a binary weight log in grams.
+
+    Args:
+        path is a string containing the location of the log.
+
+    Returns:
+        A numpy array of weights in grams (float64).
+    """
+
+    header, records = open_weight_log(path)
+    values = records['value'].astype(np.float64)
+    if header['kind'] == KIND_RAW:
+        values *= header['grams_per_unit']
+    return values
+
+
+def read_times(path):
+    """Returns the epoch ms timestamp of every sample in a binary weight log
+    as a numpy int64 array."""
+
+    header, records = open_weight_log(path)
+    return header['base_ms'] + records['offset_ms'].astype(np.int64)
+
+
+def text_to_binary(text_path, binary_path, exact=True):
+    """Converts a text weight log to a (float32 grams) binary weight log.
+
+    Lines that do not hold a timestamp and weight are skipped, as they are by
+    get_average_weight(). A sample is exact if binary_to_text() would write
+    its line back unchanged, i.e. its timestamp is a whole number of
+    milliseconds and its weight is written as str() of a float32.
+
+    Args:
+        text_path is a string containing the location of the text log.
+        binary_path is a string containing the location of the new log.
+        exact is True to refuse to convert a log with any sample that is
+        not exact, False to round such samples.
+
+    Returns:
+        The number of samples converted and the number of them that were
+        rounded (as ints).
+
+    Raises:
+        ValueError: exact is True and a sample is not exact (nothing is
+        written).
+    """
+
+    samples = []
+    n_rounded = 0
+    with open(text_path, 'r') as file:
+        for j, line in enumerate(file):
+            fields = line.replace('\n', '').split('\t')
+            try:
+                timestamp = dt.datetime.fromisoformat(fields[0])
+                weight = float(fields[1])
+            except (IndexError, ValueError):
+                continue
+            if (str(from_epoch_ms(epoch_ms(timestamp))) != fields[0] or
+                    str(np.float32(weight)) != fields[1]):
+                if exact:
+                    raise ValueError("Line %i of %s (%s) cannot be stored "
+                                     "exactly in a binary weight log."
+                                     % (j + 1, text_path, line.strip()))
+                n_rounded += 1
+            samples.append((timestamp, weight))
+
+    if os.path.exists(binary_path):
+        os.remove(binary_path)
+    writer = WeightLogWriter(binary_path)
+    for timestamp, weight in samples:
+        writer.write(timestamp, weight)
+    writer.close()
+    return len(samples), n_rounded
+
+
+def binary_to_text(binary_path, text_path):
+    """Converts a binary weight log to the text format written by PiDose.
+
+    Args:
+        binary_path is a string containing the location of the binary log.
+        text_path is a string containing the location of the new text log.
+
+    Returns:
+        The number of samples converted (as an int).
+    """
+
+    header, records = open_weight_log(binary_path)
+    times = header['base_ms'] + records['offset_ms'].astype(np.int64)
+    if header['kind'] == KIND_GRAMS:
+        # str() of a float32 is the shortest string that reads back as the
+        # same float32, so converting back to binary is exact
+        weights = [str(weight) for weight in records['value']]
+    else:
+        weights = [str(weight) for weight in read_weights(binary_path)]
+    with open(text_path, 'w') as file:
+        for ms, weight in zip(times.tolist(), weights):
+            file.write(str(from_epoch_ms(ms)) + '\t' + weight + '\n')
+    return len(weights)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert PiDose weight "
+                                     "logs between text and binary formats.")
+    parser.add_argument('direction', choices=['to-binary', 'to-text'])
+    parser.add_argument('source')
+    parser.add_argument('destination')
+    parser.add_argument('--lossy', action='store_true',
+                        help="to-binary: round timestamps to the millisecond "
+                        "and weights to float32 rather than refuse to "
+                        "convert")
+    args = parser.parse_args()
+    if args.direction == 'to-binary':
+        try:
+            n, n_rounded = text_to_binary(args.source, args.destination,
+                                          not args.lossy)
+        except ValueError as e:
+            sys.exit("%s Use --lossy to round it." % (e))
+        print("Converted %i samples (%i rounded)." % (n, n_rounded))
+    else:
+        n = binary_to_text(args.source, args.destination)
+        print("Converted %i samples." % (n))